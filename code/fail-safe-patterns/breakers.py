@@ -0,0 +1,318 @@
+"""
+Circuit breakers beyond pybreaker's in-process one:
+
+- CircuitMmapStorage and SharedCircuitBreaker keep the breaker state in a
+  small memory-mapped file, so every worker process on a host trips and
+  recovers one breaker together
+- AsyncCircuitBreaker is an asyncio-native breaker with pybreaker's knobs,
+  listeners and state storage
+"""
+import contextlib
+import fcntl
+import functools
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Iterable, Optional
+
+from pybreaker import (CircuitBreaker, CircuitBreakerError, CircuitBreakerStorage, CircuitMemoryStorage)
+
+
+# --- Shared Circuit Breaker State ---
+
+class CircuitMmapStorage(CircuitBreakerStorage):
+    """
+    pybreaker state storage in a memory-mapped file shared by every process on the host.
+    
+    All breakers pointing at the same file see one failure counter and one
+    state, so a trip in any worker stops traffic in all of them.
+    
+    Reads are plain loads from the mapping with no lock, since every field is
+    an aligned 8-byte slot. Writes take a thread lock plus an flock on the
+    file so read-modify-write updates stay atomic across processes.
+    reset_counter, called after every successful call, skips the lock when
+    the counter is already zero, which keeps the success path read-only.
+    """
+    
+    _STATES = ("closed", "open", "half-open")
+    _STATE, _FAIL_COUNTER, _SUCCESS_COUNTER, _OPENED_AT, _PROBE_OWNER, _PROBE_AT = range(0, 48, 8)
+    _SIZE = 64
+    
+    def __init__(self, path: str, state: str = "closed", name: str = "mmap"):
+        super().__init__(name)
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self._file_lock():
+            if os.fstat(self._fd).st_size < self._SIZE:
+                os.ftruncate(self._fd, self._SIZE)
+                new_file = True
+            else:
+                new_file = False
+            self._map = mmap.mmap(self._fd, self._SIZE)
+            if new_file:
+                self._write_int(self._STATE, self._STATES.index(state))
+    
+    @contextlib.contextmanager
+    def _file_lock(self):
+        with self._thread_lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+    
+    def _read_int(self, offset: int) -> int:
+        return struct.unpack_from("q", self._map, offset)[0]
+    
+    def _write_int(self, offset: int, value: int) -> None:
+        struct.pack_into("q", self._map, offset, value)
+    
+    def _read_float(self, offset: int) -> float:
+        return struct.unpack_from("d", self._map, offset)[0]
+    
+    def _write_float(self, offset: int, value: float) -> None:
+        struct.pack_into("d", self._map, offset, value)
+    
+    @property
+    def state(self) -> str:
+        return self._STATES[self._read_int(self._STATE)]
+    
+    @state.setter
+    def state(self, state: str) -> None:
+        with self._file_lock():
+            self._write_int(self._STATE, self._STATES.index(state))
+    
+    def increment_counter(self) -> None:
+        with self._file_lock():
+            self._write_int(self._FAIL_COUNTER, self._read_int(self._FAIL_COUNTER) + 1)
+    
+    def reset_counter(self) -> None:
+        if self._read_int(self._FAIL_COUNTER) == 0:
+            return
+        with self._file_lock():
+            self._write_int(self._FAIL_COUNTER, 0)
+    
+    def increment_success_counter(self) -> None:
+        with self._file_lock():
+            self._write_int(self._SUCCESS_COUNTER, self._read_int(self._SUCCESS_COUNTER) + 1)
+    
+    def reset_success_counter(self) -> None:
+        if self._read_int(self._SUCCESS_COUNTER) == 0:
+            return
+        with self._file_lock():
+            self._write_int(self._SUCCESS_COUNTER, 0)
+    
+    @property
+    def counter(self) -> int:
+        return self._read_int(self._FAIL_COUNTER)
+    
+    @property
+    def success_counter(self) -> int:
+        return self._read_int(self._SUCCESS_COUNTER)
+    
+    @property
+    def opened_at(self) -> Optional[datetime]:
+        timestamp = self._read_float(self._OPENED_AT)
+        return datetime.fromtimestamp(timestamp, timezone.utc) if timestamp else None
+    
+    @opened_at.setter
+    def opened_at(self, now: datetime) -> None:
+        with self._file_lock():
+            self._write_float(self._OPENED_AT, now.timestamp())
+    
+    def try_acquire_probe(self, stale_after: float) -> Optional[int]:
+        """Claim the single host-wide half-open trial. Returns a token, or None if another caller holds it."""
+        token = random.getrandbits(62) + 1
+        with self._file_lock():
+            owner = self._read_int(self._PROBE_OWNER)
+            if owner and time.time() - self._read_float(self._PROBE_AT) < stale_after:
+                return None
+            self._write_int(self._PROBE_OWNER, token)
+            self._write_float(self._PROBE_AT, time.time())
+        return token
+    
+    def release_probe(self, token: int) -> None:
+        with self._file_lock():
+            if self._read_int(self._PROBE_OWNER) == token:
+                self._write_int(self._PROBE_OWNER, 0)
+
+class SharedCircuitBreaker(CircuitBreaker):
+    """
+    CircuitBreaker over CircuitMmapStorage that lets exactly one trial call
+    through per host once `reset_timeout` has elapsed. Every other caller, in
+    this process or any other, fails fast until the trial settles the state.
+    A trial holder that dies is replaced after another `reset_timeout`.
+    """
+    
+    def __init__(self, *args, state_storage: CircuitMmapStorage, **kwargs):
+        super().__init__(*args, state_storage=state_storage, **kwargs)
+        self._probing = threading.local()
+    
+    def call(self, func, *args, **kwargs):
+        # pybreaker's open state switches to half-open and then calls call()
+        # again; that nested call is the trial this thread already holds
+        if getattr(self._probing, "active", False) or not self._needs_probe():
+            return super().call(func, *args, **kwargs)
+        token = self._state_storage.try_acquire_probe(stale_after=self.reset_timeout)
+        if token is None:
+            raise CircuitBreakerError("Trial call in progress, circuit breaker half-open")
+        self._probing.active = True
+        try:
+            return super().call(func, *args, **kwargs)
+        finally:
+            self._probing.active = False
+            self._state_storage.release_probe(token)
+    
+    def _needs_probe(self) -> bool:
+        state = self._state_storage.state
+        if state == "half-open":
+            return True
+        if state == "open":
+            opened_at = self._state_storage.opened_at
+            return opened_at is None or datetime.now(timezone.utc) >= opened_at + timedelta(seconds=self.reset_timeout)
+        return False
+
+
+# --- Async Circuit Breaker ---
+
+class AsyncCircuitBreaker:
+    """
+    asyncio-native circuit breaker with the same knobs as pybreaker.CircuitBreaker.
+    
+    - closed: calls go through; `fail_max` consecutive failures open the circuit
+    - open: calls fail fast with CircuitBreakerError until `reset_timeout` elapses
+    - half-open: exactly one trial call is let through, concurrent callers fail
+      fast; success closes the circuit, failure opens it again
+    
+    Exceptions matching `exclude` (types or predicates) are treated as
+    successes, as in pybreaker. State changes are reported to listeners with
+    pybreaker's `state_change(cb, old_state, new_state)` signature.
+    
+    All bookkeeping happens between awaits on a single event loop, so no
+    lock is held while the protected call runs. Retries compose with
+    tenacity's @retry, which awaits its wait policy for coroutine functions.
+    
+    State lives in a pybreaker storage. Pass a CircuitMmapStorage as
+    `state_storage` to share it with every process on the host, as
+    SharedCircuitBreaker does for the sync path: one failure counter, one
+    state and one half-open trial across all workers. Its file lock is only
+    held for the few microseconds of each update, never across an await.
+    """
+    
+    def __init__(self,
+                 fail_max: int = 5,
+                 reset_timeout: float = 60,
+                 exclude: Iterable[Any] = (),
+                 listeners: Iterable[Any] = (),
+                 name: Optional[str] = None,
+                 state_storage: Optional[CircuitBreakerStorage] = None):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self.excluded_exceptions = list(exclude)
+        self.listeners = list(listeners)
+        self.name = name
+        self._state_storage = state_storage or CircuitMemoryStorage("closed")
+        self._trial_in_flight = False
+        self._probe_token: Optional[int] = None
+    
+    @property
+    def current_state(self) -> str:
+        return self._state_storage.state
+    
+    @property
+    def fail_counter(self) -> int:
+        return self._state_storage.counter
+    
+    def __call__(self, func: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await self.call(func, *args, **kwargs)
+        return wrapper
+    
+    def close(self) -> None:
+        """Close the circuit and reset the failure counter, as pybreaker's close()."""
+        self._state_storage.reset_counter()
+        if self.current_state != "closed":
+            self._set_state("closed")
+    
+    async def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        trial = self._before_call()
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException as e:
+            if trial:
+                self._end_trial()
+            if not isinstance(e, Exception):
+                raise  # cancellation: neither a success nor a failure
+            if self._is_excluded(e):
+                self._on_success()
+                raise
+            self._on_failure(e, trial)
+            raise
+        if trial:
+            self._end_trial()
+        self._on_success()
+        return result
+    
+    def _before_call(self) -> bool:
+        """Admit or reject a call; returns True if it is the half-open trial."""
+        if self.current_state == "open":
+            opened_at = self._state_storage.opened_at
+            if opened_at and datetime.now(timezone.utc) < opened_at + timedelta(seconds=self.reset_timeout):
+                raise CircuitBreakerError("Timeout not elapsed yet, circuit breaker still open")
+            self._set_state("half-open")
+        if self.current_state == "half-open":
+            if self._trial_in_flight:
+                raise CircuitBreakerError("Trial call in progress, circuit breaker half-open")
+            if isinstance(self._state_storage, CircuitMmapStorage):
+                # Another process may hold the host-wide trial
+                self._probe_token = self._state_storage.try_acquire_probe(stale_after=self.reset_timeout)
+                if self._probe_token is None:
+                    raise CircuitBreakerError("Trial call in progress, circuit breaker half-open")
+            self._trial_in_flight = True
+            return True
+        return False
+    
+    def _end_trial(self) -> None:
+        self._trial_in_flight = False
+        if self._probe_token is not None:
+            self._state_storage.release_probe(self._probe_token)
+            self._probe_token = None
+    
+    def _on_success(self) -> None:
+        self._state_storage.reset_counter()
+        if self.current_state == "half-open":
+            self._set_state("closed")
+    
+    def _on_failure(self, error: Exception, trial: bool) -> None:
+        self._state_storage.increment_counter()
+        if trial:
+            self._open()
+            raise CircuitBreakerError("Trial call failed, circuit breaker opened") from error
+        if self.current_state == "closed" and self.fail_counter >= self.fail_max:
+            self._open()
+            raise CircuitBreakerError("Failures threshold reached, circuit breaker opened") from error
+    
+    def _open(self) -> None:
+        self._state_storage.opened_at = datetime.now(timezone.utc)
+        self._set_state("open")
+    
+    def _set_state(self, new_state: str) -> None:
+        old_state = self.current_state
+        self._state_storage.state = new_state
+        for listener in self.listeners:
+            listener.state_change(self, old_state, new_state)
+    
+    def _is_excluded(self, error: Exception) -> bool:
+        for excluded in self.excluded_exceptions:
+            if isinstance(excluded, type):
+                if isinstance(error, excluded):
+                    return True
+            elif excluded(error):
+                return True
+        return False
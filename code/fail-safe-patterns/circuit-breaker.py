@@ -1,9 +1,34 @@
 import pybreaker
+import os
 import random
+import tempfile
 import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import retry as retry_policy
+from concurrency_limiter import AdaptiveConcurrencyLimiter, ConcurrencyLimitExceeded
+from metrics import MetricsRegistry
+
+class HedgeCancelled(Exception):
+    """The hedge answered first, so the GPT-4 call was abandoned."""
+
+# Bounds in-flight GPT-4 calls from the request threads and hedge pool;
+# an abandoned hedge loser neither grows nor shrinks the limit
+gpt4_limiter = AdaptiveConcurrencyLimiter(initial_limit=4, max_limit=8, latency_threshold=1.0,
+                                          ignore=[HedgeCancelled], name="gpt4")
 
 # Simulate GPT-4 API call
-def call_gpt4_api(request):
+@gpt4_limiter
+def call_gpt4_api(request, cancelled=None):
+    # Most calls are quick, but a slow tail sets the p99 latency
+    delay = random.uniform(0.05, 0.15) if random.random() < 0.9 else random.uniform(1.0, 2.0)
+    if cancelled is None:
+        time.sleep(delay)
+    elif cancelled.wait(delay):
+        # A real client would close the connection here
+        raise HedgeCancelled(request)
     # Randomly fail to simulate API downtime
     if random.random() < 0.7:  # 70% chance of success
         return f"GPT-4 Response for '{request}'"
@@ -12,12 +37,21 @@ def call_gpt4_api(request):
 
 # Fallback model call (local)
 def call_local_llama(request):
+    time.sleep(0.2)
     return f"Llama Degraded Response for '{request}'"
 
+# Counters exported in Prometheus text format at the end of the run
+breaker_metrics = MetricsRegistry()
+breaker_metrics.describe("breaker_transitions_total", "counter", "Circuit breaker state transitions")
+breaker_metrics.describe("breaker_rejections_total", "counter", "GPT-4 calls rejected by the open circuit breaker")
+breaker_metrics.describe("fallbacks_total", "counter", "Requests answered by the local Llama fallback, by reason")
+
 # Listener to track state changes (optional)
 class CircuitBreakerListener(pybreaker.CircuitBreakerListener):
     def state_change(self, cb, old_state, new_state):
         print(f"[Circuit Breaker] State changed from {old_state} to {new_state}")
+        breaker_metrics.inc("breaker_transitions_total",
+                            from_state=getattr(old_state, "name", old_state), to_state=new_state.name)
 
 # Create a circuit breaker
 breaker = pybreaker.CircuitBreaker(
@@ -35,11 +69,14 @@ def client_request(request):
     except pybreaker.CircuitBreakerError:
         # Circuit is open, use fallback
         print("[Client] Circuit Open. Using fallback.")
+        breaker_metrics.inc("breaker_rejections_total")
+        breaker_metrics.inc("fallbacks_total", reason="circuit_open")
         result = call_local_llama(request)
         print(f"[Client] Got fallback result: {result}")
     except Exception as e:
         # API failed but circuit still closed
         print(f"[Client] GPT-4 failed: {e}. Using fallback.")
+        breaker_metrics.inc("fallbacks_total", reason="primary_error")
         result = call_local_llama(request)
         print(f"[Client] Got fallback result: {result}")
 
@@ -48,3 +85,120 @@ for i in range(10):
     print(f"\nRequest {i+1}:")
     client_request(f"My request {i+1}")
     time.sleep(1)
+
+
+# --- Hedged requests ---
+# Instead of waiting for a slow GPT-4 call to finish, start the fallback
+# speculatively once the primary is slower than its recent p-th percentile,
+# and take whichever acceptable answer arrives first.
+
+class LatencyTracker:
+    """Sliding window of recent primary latencies."""
+    def __init__(self, window=200, min_samples=20, default=0.5):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.default = default
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, p):
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return self.default
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+primary_latency = LatencyTracker()
+# Every request earns a fifth of a hedge; at most 5 are banked
+hedge_budget = retry_policy.RetryBudget(ratio=0.2, min_per_second=0.0, max_tokens=5)
+hedge_pool = ThreadPoolExecutor(max_workers=8)
+
+def _replay(outcome):
+    if isinstance(outcome, Exception):
+        raise outcome
+    return outcome
+
+def timed_gpt4_call(request, cancelled=None):
+    start = time.monotonic()
+    try:
+        return call_gpt4_api(request, cancelled)
+    finally:
+        # An abandoned call says nothing about GPT-4 latency
+        if cancelled is None or not cancelled.is_set():
+            primary_latency.record(time.monotonic() - start)
+
+def protected_gpt4_call(request, cancelled=None):
+    if breaker.current_state != pybreaker.STATE_CLOSED:
+        # Open or half-open: pybreaker fails fast or runs the single trial call
+        return breaker.call(timed_gpt4_call, request)
+    # pybreaker holds its lock for the whole protected call, which would make a
+    # slow loser block the next request. Run the call outside the breaker and
+    # report its outcome afterwards.
+    try:
+        outcome = timed_gpt4_call(request, cancelled)
+    except (HedgeCancelled, ConcurrencyLimitExceeded):
+        raise  # not a GPT-4 failure, so the breaker does not hear about it
+    except Exception as e:
+        outcome = e
+    try:
+        return breaker.call(_replay, outcome)
+    except pybreaker.CircuitBreakerError:
+        # Another request opened the breaker while this one ran; the answer
+        # already arrived, so use it rather than fall back
+        if isinstance(outcome, Exception):
+            raise
+        return outcome
+
+def hedged_client_request(request, hedge_percentile=90):
+    hedge_budget.deposit()
+    cancelled = threading.Event()
+    primary = hedge_pool.submit(protected_gpt4_call, request, cancelled)
+    pending = {primary}
+    done, _ = wait(pending, timeout=primary_latency.percentile(hedge_percentile))
+
+    if not done and hedge_budget.try_spend():
+        print(f"[Client] GPT-4 slower than p{hedge_percentile}. Hedging with fallback.")
+        pending.add(hedge_pool.submit(call_local_llama, request))
+
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                for loser in pending:
+                    loser.cancel()  # not started yet: dropped
+                cancelled.set()  # a running GPT-4 call gives up and frees its pool slot
+                source = "GPT-4" if future is primary else "fallback"
+                if future is not primary:
+                    breaker_metrics.inc("fallbacks_total", reason="hedge_won")
+                print(f"[Client] Got {source} result: {future.result()}")
+                return future.result()
+            if future is primary:
+                print(f"[Client] GPT-4 failed: {future.exception()}.")
+                if isinstance(future.exception(), pybreaker.CircuitBreakerError):
+                    breaker_metrics.inc("breaker_rejections_total")
+                if not pending:
+                    # Hedge was never started: fall back as the plain client does
+                    pending.add(hedge_pool.submit(call_local_llama, request))
+
+# Simulate multiple hedged requests and compare tail latency
+latencies = []
+for i in range(50):
+    print(f"\nHedged request {i+1}:")
+    start = time.monotonic()
+    hedged_client_request(f"My request {i+1}")
+    latencies.append(time.monotonic() - start)
+
+latencies.sort()
+print(f"\n[Hedging] p50 {latencies[len(latencies) // 2]:.2f}s, "
+      f"p99 {latencies[int(len(latencies) * 0.99)]:.2f}s, hedge tokens left {hedge_budget.remaining:.1f}")
+hedge_pool.shutdown(wait=False)
+
+# Print metrics and write them for a node_exporter textfile collector
+# (point CIRCUIT_BREAKER_METRICS_FILE into its directory; defaults to the temp directory)
+print("\n" + breaker_metrics.render())
+metrics_path = os.environ.get("CIRCUIT_BREAKER_METRICS_FILE") or os.path.join(tempfile.gettempdir(), "circuit-breaker.prom")
+breaker_metrics.write_textfile(metrics_path)
+print(f"Metrics written to {metrics_path}")
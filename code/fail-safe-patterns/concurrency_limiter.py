@@ -0,0 +1,196 @@
+"""
+Adaptive concurrency limiter (bulkhead) for calls to a backend.
+
+The limit grows while calls are fast and shrinks when they slow down or
+fail, and callers over the limit wait in a bounded queue or are shed, so a
+slow dependency cannot tie up every worker. One limiter can guard both
+coroutines and blocking calls made from worker threads.
+"""
+import asyncio
+import functools
+import inspect
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Iterable, Optional
+
+
+# --- Adaptive Concurrency Limiter (Bulkhead) ---
+
+class ConcurrencyLimitExceeded(Exception):
+    """Raised when a call is shed because the limiter's queue is full or the wait timed out."""
+
+class _Waiter:
+    """A queued caller: an asyncio future on its own loop, or a threading.Event for a blocking caller."""
+    
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.loop = loop
+        self.future = loop.create_future() if loop else None
+        self.event = None if loop else threading.Event()
+    
+    def grant(self) -> None:
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+    
+    def _resolve(self) -> None:
+        if not self.future.done():
+            self.future.set_result(None)
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Bulkhead whose concurrency limit adapts to the backend (AIMD).
+    
+    - a call that succeeds within `latency_threshold` while the limiter is
+      at least half used raises the limit additively (+1 per limit's worth of calls)
+    - a failure or a call slower than `latency_threshold` cuts the limit
+      multiplicatively by `backoff_ratio`, at most once per round of calls:
+      drops from calls started before the last cut are not counted again
+    - exceptions in `ignore` (e.g. an open circuit breaker) release the slot
+      without moving the limit
+    
+    Calls over the limit wait in a FIFO queue of at most `max_queue` entries
+    for up to `queue_timeout` seconds; anything beyond that is shed with
+    ConcurrencyLimitExceeded, so excess load fails fast instead of piling up
+    into timeouts at the backend. With `queue_timeout=None` a queued call
+    waits as long as it takes, for callers that already bound their own
+    concurrency.
+    
+    Coroutine functions go through call(), blocking ones through
+    call_sync(); decorating picks the right one, and both share one limit.
+    Never call_sync() on an event loop thread: it blocks the loop while it waits.
+    """
+    
+    def __init__(self,
+                 initial_limit: int = 10,
+                 min_limit: int = 1,
+                 max_limit: int = 200,
+                 backoff_ratio: float = 0.9,
+                 latency_threshold: float = 2.0,
+                 max_queue: int = 100,
+                 queue_timeout: Optional[float] = 1.0,
+                 ignore: Iterable[type] = (),
+                 name: Optional[str] = None):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_threshold = latency_threshold
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.ignore = tuple(ignore)
+        self.name = name
+        self.inflight = 0
+        self.shed_count = 0
+        self._limit = float(initial_limit)
+        self._last_backoff = 0.0
+        self._waiters: "deque[_Waiter]" = deque()
+        self._lock = threading.Lock()
+    
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+    
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+    
+    def __call__(self, func: Callable[..., Any]) -> Callable[..., Any]:
+        if not inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            def sync_wrapper(*args, **kwargs):
+                return self.call_sync(func, *args, **kwargs)
+            return sync_wrapper
+        
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await self.call(func, *args, **kwargs)
+        return wrapper
+    
+    async def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        await self._acquire()
+        start = time.monotonic()
+        try:
+            result = await func(*args, **kwargs)
+        except self.ignore:
+            self._release(None, start)
+            raise
+        except BaseException as e:
+            self._release(None if not isinstance(e, Exception) else False, start)
+            raise
+        self._release(time.monotonic() - start <= self.latency_threshold, start)
+        return result
+    
+    def call_sync(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Blocking counterpart of call() for worker threads; waits for a slot on a threading.Event."""
+        self._acquire_sync()
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except self.ignore:
+            self._release(None, start)
+            raise
+        except BaseException as e:
+            self._release(None if not isinstance(e, Exception) else False, start)
+            raise
+        self._release(time.monotonic() - start <= self.latency_threshold, start)
+        return result
+    
+    async def _acquire(self) -> None:
+        waiter = self._enqueue(asyncio.get_running_loop())
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(waiter.future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            if self._discard_waiter(waiter):
+                self.shed_count += 1
+                raise ConcurrencyLimitExceeded(f"Timed out after {self.queue_timeout}s waiting for a slot")
+            # The slot was handed over just as the wait gave up: keep it
+        except asyncio.CancelledError:
+            if not self._discard_waiter(waiter):
+                self._release(None, time.monotonic())
+            raise
+    
+    def _acquire_sync(self) -> None:
+        waiter = self._enqueue(None)
+        if waiter is not None and not waiter.event.wait(self.queue_timeout) and self._discard_waiter(waiter):
+            self.shed_count += 1
+            raise ConcurrencyLimitExceeded(f"Timed out after {self.queue_timeout}s waiting for a slot")
+    
+    def _enqueue(self, loop: Optional[asyncio.AbstractEventLoop]) -> Optional[_Waiter]:
+        """Take a free slot (returns None) or queue a waiter for one."""
+        with self._lock:
+            if self.inflight < self.limit and not self._waiters:
+                self.inflight += 1
+                return None
+            if len(self._waiters) >= self.max_queue:
+                self.shed_count += 1
+                raise ConcurrencyLimitExceeded(f"Concurrency limit {self.limit} reached and queue is full")
+            waiter = _Waiter(loop)
+            self._waiters.append(waiter)
+            return waiter
+    
+    def _discard_waiter(self, waiter: _Waiter) -> bool:
+        """Drop a waiter that gave up; False if it was already granted a slot."""
+        with self._lock:
+            if waiter not in self._waiters:
+                return False
+            self._waiters.remove(waiter)
+            return True
+    
+    def _release(self, ok: Optional[bool], started_at: float) -> None:
+        """ok=True: on-time success, False: drop signal, None: no signal."""
+        with self._lock:
+            self.inflight -= 1
+            if ok is True and (self.inflight + 1) * 2 >= self._limit:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            elif ok is False and started_at >= self._last_backoff:
+                self._limit = max(self.min_limit, self._limit * self.backoff_ratio)
+                self._last_backoff = time.monotonic()
+            granted = []
+            while self._waiters and self.inflight < self.limit:
+                self.inflight += 1
+                granted.append(self._waiters.popleft())
+        for waiter in granted:
+            waiter.grant()
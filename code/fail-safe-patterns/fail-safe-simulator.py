@@ -0,0 +1,371 @@
+"""
+Seeded discrete-event simulator for the circuit breaker and retry patterns.
+
+circuit-breaker.py and the __main__ block of ai-refund-agent.py exercise the
+fail-safe code with real time.sleep() calls and random.random() failures, so
+one experiment takes minutes and no two runs agree. Here time is virtual:
+requests, backend responses, timeouts and retry waits are events on a heap,
+the clock jumps from one event to the next, and every random draw comes from
+a seeded generator. Ten virtual minutes at 1000 requests/s run in seconds.
+
+The backends are stand-ins for call_gpt4_api (circuit-breaker.py) and
+mock_payment_gateway_api (payment_gateway.py): the same latency shapes, a
+base failure rate, and a capacity past which latency and failures grow with
+load. A fault scenario layers outages on top:
+
+- steady:         base failure rate only
+- bursts:         3-second full outages every 10% of the run
+- brownout:       40% failures and 5x latency for 30% of the run
+- slow_recovery:  a full outage, then failures fall back to the base rate
+                  over 40% of the run
+
+Client policies combine the patterns as the scripts use them: the breaker
+(fail_max consecutive failures open it, reset_timeout later one trial call
+is let through, as in pybreaker and AsyncCircuitBreaker), retries with fixed,
+exponential or decorrelated-jitter waits, and the shared retry budget from
+retry.py. A call that is rejected, trips the breaker or runs out of retries
+takes the fallback (call_local_llama, or the refund outbox).
+
+For every policy it reports success rate, fallback rate, latency
+percentiles and backend load (attempts per request, peak attempts/s).
+
+    python fail-safe-simulator.py
+    python fail-safe-simulator.py --backend payment_gateway --scenario brownout --rate 2000
+    python fail-safe-simulator.py --sweep --scenario slow_recovery   # fail_max x reset_timeout grid
+"""
+import argparse
+import heapq
+import itertools
+import json
+import random
+import time
+from dataclasses import asdict, dataclass, field, replace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# The retry budget and jitter used by the payment gateway calls in payment_gateway.py
+import retry as retry_policy
+
+
+# --- Backends ---
+
+@dataclass
+class Backend:
+    name: str
+    latency: Callable[[random.Random, bool], float]  # (rng, failed) -> seconds
+    failure_rate: float       # outside fault phases
+    capacity: int             # concurrent calls before it slows down and sheds
+    fallback_latency: float   # cost of the fallback path
+
+def gpt4_latency(rng: random.Random, failed: bool) -> float:
+    # call_gpt4_api: mostly 50-150 ms, with a slow 10% tail of 1-2 s
+    return rng.uniform(0.05, 0.15) if rng.random() < 0.9 else rng.uniform(1.0, 2.0)
+
+def payment_gateway_latency(rng: random.Random, failed: bool) -> float:
+    # mock_payment_gateway_api: 200 ms on success, 500 ms before a failure
+    return (0.5 if failed else 0.2) * rng.uniform(0.9, 1.1)
+
+BACKENDS = {
+    # Fallback: call_local_llama takes 200 ms
+    "gpt4": Backend("gpt4", gpt4_latency, failure_rate=0.02, capacity=400, fallback_latency=0.2),
+    # Fallback: one local write to the refund outbox
+    "payment_gateway": Backend("payment_gateway", payment_gateway_latency, failure_rate=0.01,
+                               capacity=400, fallback_latency=0.005),
+}
+
+
+# --- Fault scenarios ---
+
+@dataclass
+class Phase:
+    """Failure rate moves linearly from failure_start to failure_end; times are fractions of the run."""
+    start: float
+    end: float
+    failure_start: float
+    failure_end: float
+    latency_factor: float = 1.0
+
+def scenario_phases(name: str, duration: float, base_failure: float) -> List[Phase]:
+    if name == "steady":
+        return []
+    if name == "bursts":
+        burst = 3.0 / duration
+        return [Phase(k / 10, k / 10 + burst, 1.0, 1.0) for k in range(1, 10)]
+    if name == "brownout":
+        return [Phase(0.2, 0.5, 0.4, 0.4, latency_factor=5.0)]
+    if name == "slow_recovery":
+        return [Phase(0.2, 0.3, 1.0, 1.0), Phase(0.3, 0.7, 1.0, base_failure, latency_factor=2.0)]
+    raise ValueError(f"Unknown scenario: {name}")
+
+SCENARIOS = ("steady", "bursts", "brownout", "slow_recovery")
+
+
+# --- Client policies ---
+
+@dataclass
+class Policy:
+    name: str
+    breaker: bool = False
+    fail_max: int = 3
+    reset_timeout: float = 5.0
+    attempts: int = 1              # total attempts, including the first
+    backoff: str = "none"          # none | fixed | exponential | jitter
+    retry_wait: float = 1.0        # fixed wait, exponential minimum, or jitter base
+    retry_cap: float = 10.0
+    budget_ratio: Optional[float] = None  # retry budget (retry.RetryBudget) if set
+    timeout: float = 2.0
+
+POLICIES = {
+    "none": Policy("no protection"),
+    # safe_payment_gateway_call before the retry budget: two attempts, wait_fixed(1)
+    "retry-fixed": Policy("retry, fixed 1s", attempts=2, backoff="fixed"),
+    # retry.py before the retry budget: three attempts, wait_exponential(min=2, max=10)
+    "retry-exponential": Policy("retry, exponential", attempts=3, backoff="exponential", retry_wait=2.0),
+    # circuit-breaker.py and payment_gateway_breaker
+    "breaker": Policy("breaker", breaker=True),
+    "breaker+retry": Policy("breaker + fixed retry", breaker=True, attempts=2, backoff="fixed"),
+    # safe_payment_gateway_call today
+    "breaker+budget": Policy("breaker + budgeted jitter", breaker=True, attempts=2, backoff="jitter",
+                             retry_wait=0.5, retry_cap=5.0, budget_ratio=0.1),
+}
+
+
+# --- Simulation ---
+
+ARRIVAL, DONE, RETRY, FREE = range(4)
+CLOSED, OPEN, HALF_OPEN = range(3)
+
+@dataclass
+class SimulationResult:
+    policy: str
+    requests: int
+    success_rate: float
+    fallback_rate: float
+    fallbacks: Dict[str, int]
+    latency_ms: Dict[str, float]
+    attempts_per_request: float
+    peak_attempts_per_s: int
+    peak_in_flight: int
+    breaker_opens: int
+    retries: int
+    retries_denied: int
+    wall_s: float
+    config: Dict[str, Any] = field(default_factory=dict)
+
+def simulate(backend: Backend, scenario: str, policy: Policy, rate: float, duration: float,
+             seed: int = 0) -> SimulationResult:
+    """Run one policy against one scenario; the same seed gives the same arrivals for every policy."""
+    wall_start = time.perf_counter()
+    arrivals_rng, backend_rng, retry_rng = (random.Random(seed * 3 + i) for i in range(3))
+    phases = scenario_phases(scenario, duration, backend.failure_rate)
+    for phase in phases:
+        phase.start *= duration
+        phase.end *= duration
+
+    now = 0.0
+    budget = None
+    if policy.budget_ratio is not None:
+        budget = retry_policy.RetryBudget(ratio=policy.budget_ratio, clock=lambda: now)
+
+    events: List[Tuple[float, int, int, Any]] = []
+    seq = itertools.count()
+    push, pop = heapq.heappush, heapq.heappop
+
+    # Breaker state, with AsyncCircuitBreaker's transitions
+    state, fail_counter, opened_at, trial_in_flight, opens = CLOSED, 0, 0.0, False, 0
+
+    in_flight = peak_in_flight = requests = successes = attempts_total = retries = 0
+    fallbacks = {"circuit_open": 0, "primary_error": 0}
+    latencies: List[float] = []
+    # Retries and slow responses can land after the last arrival; the tail shares the final bucket
+    per_second = [0] * (int(duration) + 60)
+    last_second = len(per_second) - 1
+
+    def conditions(t: float) -> Tuple[float, float]:
+        for phase in phases:
+            if phase.start <= t < phase.end:
+                progress = (t - phase.start) / (phase.end - phase.start)
+                failure = phase.failure_start + (phase.failure_end - phase.failure_start) * progress
+                return max(failure, backend.failure_rate), phase.latency_factor
+        return backend.failure_rate, 1.0
+
+    def fallback(request: list, t: float, reason: str) -> None:
+        fallbacks[reason] += 1
+        latencies.append(t + backend.fallback_latency - request[0])
+
+    def backoff(request: list) -> float:
+        if policy.backoff == "fixed":
+            return policy.retry_wait
+        if policy.backoff == "exponential":
+            return min(policy.retry_cap, max(policy.retry_wait, 2.0 ** (request[1] - 1)))
+        request[2] = retry_policy.decorrelated_jitter(policy.retry_wait, policy.retry_cap, request[2], retry_rng)
+        return request[2]
+
+    def attempt(request: list, t: float) -> None:
+        nonlocal state, trial_in_flight, in_flight, peak_in_flight, attempts_total
+        trial = False
+        if policy.breaker:
+            if state == OPEN:
+                if t - opened_at < policy.reset_timeout:
+                    fallback(request, t, "circuit_open")
+                    return
+                state = HALF_OPEN
+            if state == HALF_OPEN:
+                if trial_in_flight:
+                    fallback(request, t, "circuit_open")
+                    return
+                trial_in_flight = trial = True
+        request[1] += 1
+        attempts_total += 1
+        per_second[min(int(t), last_second)] += 1
+        in_flight += 1
+        peak_in_flight = max(peak_in_flight, in_flight)
+
+        failure, latency_factor = conditions(t)
+        if in_flight > backend.capacity:
+            # Overloaded: everything slows down and the excess is shed
+            latency_factor *= in_flight / backend.capacity
+            failure = max(failure, 1 - backend.capacity / in_flight)
+        failed = backend_rng.random() < failure
+        latency = backend.latency(backend_rng, failed) * latency_factor
+        if latency > policy.timeout:
+            # The client gives up; the backend keeps working on it
+            push(events, (t + policy.timeout, next(seq), DONE, (request, False, trial, False)))
+            push(events, (t + latency, next(seq), FREE, None))
+        else:
+            push(events, (t + latency, next(seq), DONE, (request, not failed, trial, True)))
+
+    def finish(request: list, ok: bool, trial: bool, t: float) -> None:
+        nonlocal state, fail_counter, opened_at, trial_in_flight, opens, successes, retries
+        tripped = False
+        if policy.breaker:
+            if trial:
+                trial_in_flight = False
+            if ok:
+                fail_counter = 0
+                if state == HALF_OPEN:
+                    state = CLOSED
+            else:
+                fail_counter += 1
+                if trial or (state == CLOSED and fail_counter >= policy.fail_max):
+                    state, opened_at, tripped = OPEN, t, True
+                    opens += 1
+        if ok:
+            successes += 1
+            latencies.append(t - request[0])
+            if budget is not None:
+                budget.deposit()
+        elif tripped:
+            # The tripping call raises CircuitBreakerError, which is not retried
+            fallback(request, t, "circuit_open")
+        elif request[1] < policy.attempts and (budget is None or budget.try_spend()):
+            retries += 1
+            push(events, (t + backoff(request), next(seq), RETRY, request))
+        else:
+            fallback(request, t, "primary_error")
+
+    push(events, (arrivals_rng.expovariate(rate), next(seq), ARRIVAL, None))
+    while events:
+        now, _, kind, payload = pop(events)
+        if kind == ARRIVAL:
+            requests += 1
+            next_arrival = now + arrivals_rng.expovariate(rate)
+            if next_arrival < duration:
+                push(events, (next_arrival, next(seq), ARRIVAL, None))
+            # [arrived at, attempts made, previous jitter wait]
+            attempt([now, 0, 0.0], now)
+        elif kind == DONE:
+            request, ok, trial, frees = payload
+            if frees:
+                in_flight -= 1
+            finish(request, ok, trial, now)
+        elif kind == RETRY:
+            attempt(payload, now)
+        else:
+            in_flight -= 1
+
+    latencies.sort()
+
+    def percentile(p: float) -> float:
+        return 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] if latencies else 0.0
+
+    total_fallbacks = sum(fallbacks.values())
+    return SimulationResult(
+        policy=policy.name,
+        requests=requests,
+        success_rate=successes / requests,
+        fallback_rate=total_fallbacks / requests,
+        fallbacks=fallbacks,
+        latency_ms={f"p{p}": percentile(p) for p in (50, 95, 99, 99.9)},
+        attempts_per_request=attempts_total / requests,
+        peak_attempts_per_s=max(per_second),
+        peak_in_flight=peak_in_flight,
+        breaker_opens=opens,
+        retries=retries,
+        retries_denied=budget.denied if budget is not None else 0,
+        wall_s=time.perf_counter() - wall_start,
+        config=asdict(policy),
+    )
+
+
+# --- Report ---
+
+def print_results(results: List[SimulationResult]) -> None:
+    print(f"{'policy':<28}{'success':>9}{'fallback':>10}{'p50':>9}{'p99':>9}{'p99.9':>9}"
+          f"{'attempts/req':>14}{'peak/s':>8}{'opens':>7}{'retries':>9}{'denied':>8}")
+    for r in results:
+        print(f"{r.policy:<28}{100 * r.success_rate:>8.2f}%{100 * r.fallback_rate:>9.2f}%"
+              f"{r.latency_ms['p50']:>7.0f}ms{r.latency_ms['p99']:>7.0f}ms{r.latency_ms['p99.9']:>7.0f}ms"
+              f"{r.attempts_per_request:>14.3f}{r.peak_attempts_per_s:>8}{r.breaker_opens:>7}"
+              f"{r.retries:>9}{r.retries_denied:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", default="gpt4", choices=list(BACKENDS))
+    parser.add_argument("--scenario", default="all", help=f"one of {', '.join(SCENARIOS)}, or all")
+    parser.add_argument("--policies", default=",".join(POLICIES), help="comma-separated keys of POLICIES")
+    parser.add_argument("--rate", type=float, default=1000, help="requests per virtual second")
+    parser.add_argument("--duration", type=float, default=120, help="virtual seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fail-max", type=int, help="override fail_max for breaker policies")
+    parser.add_argument("--reset-timeout", type=float, help="override reset_timeout for breaker policies")
+    parser.add_argument("--sweep", action="store_true",
+                        help="grid of fail_max x reset_timeout for the breaker+budget policy")
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    backend = BACKENDS[args.backend]
+    scenarios = SCENARIOS if args.scenario == "all" else tuple(args.scenario.split(","))
+    overrides = {key: value for key, value in [("fail_max", args.fail_max), ("reset_timeout", args.reset_timeout)]
+                 if value is not None}
+
+    if args.sweep:
+        base = POLICIES["breaker+budget"]
+        policies = [replace(base, name=f"fail_max={f} reset={r:g}s", fail_max=f, reset_timeout=r)
+                    for f in (3, 5, 10, 20) for r in (1.0, 5.0, 15.0, 30.0)]
+    else:
+        policies = [replace(POLICIES[key], **(overrides if POLICIES[key].breaker else {}))
+                    for key in args.policies.split(",")]
+
+    report = {}
+    wall_start = time.perf_counter()
+    simulated = 0
+    for scenario in scenarios:
+        print(f"\n--- {args.backend}, {scenario}: {args.rate:g} requests/s for {args.duration:g} virtual s, "
+              f"seed {args.seed} ---")
+        results = [simulate(backend, scenario, policy, args.rate, args.duration, args.seed) for policy in policies]
+        print_results(results)
+        report[scenario] = [asdict(r) for r in results]
+        simulated += sum(r.requests for r in results)
+
+    elapsed = time.perf_counter() - wall_start
+    print(f"\nSimulated {simulated:,} requests in {elapsed:.1f}s "
+          f"({60 * simulated / elapsed / 1e6:.1f} million requests per minute)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": report}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
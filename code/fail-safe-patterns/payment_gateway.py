@@ -0,0 +1,442 @@
+"""
+The payment gateway side of the refund pipeline: a mock gateway (in
+process and as a local HTTP stand-in), the breaker-, retry- and
+limiter-protected calls to it, and a pooled client that coalesces refunds
+into bulk requests.
+"""
+import asyncio
+import http.client
+import itertools
+import json
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from pybreaker import CircuitBreaker, CircuitBreakerError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt
+
+import retry as retry_policy
+from breakers import AsyncCircuitBreaker, CircuitMmapStorage, SharedCircuitBreaker
+from concurrency_limiter import AdaptiveConcurrencyLimiter
+from refund_metrics import (BreakerMetricsListener, payment_gateway_retry_budget, record_retry_budget,
+                            record_retry_wait, refund_metrics)
+
+
+# --- Mock Payment Gateway (Enhanced) ---
+
+# Refunds the mock gateway has paid, by idempotency key, as a real gateway keeps them
+_gateway_refunds: Dict[str, Dict[str, Any]] = {}
+
+def _already_refunded(idempotency_key: Optional[str]) -> Optional[Dict[str, Any]]:
+    previous = _gateway_refunds.get(idempotency_key) if idempotency_key else None
+    if previous is not None:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Payment Gateway: {idempotency_key} already refunded "
+              f"as {previous['transaction_id']}")
+    return previous
+
+def mock_payment_gateway_api(amount: float, user_id: str, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Enhanced mock payment gateway with more realistic behavior. A refund
+    sent again under the same idempotency key gets the first result back
+    instead of being paid twice.
+    """
+    previous = _already_refunded(idempotency_key)
+    if previous is not None:
+        return previous
+    if random.random() < 0.7:  # 70% failure rate for demonstration
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Payment Gateway: Processing refund for {user_id} of ${amount:.2f}...")
+        time.sleep(0.5)
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Payment Gateway: FAILED!")
+        raise ConnectionError("Mock Payment Gateway API is unavailable or timed out.")
+    else:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Payment Gateway: Processing refund for {user_id} of ${amount:.2f}...")
+        time.sleep(0.2)
+        transaction_id = f"TXN-{random.randint(10000, 99999)}"
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Payment Gateway: SUCCESS for {user_id}! Transaction: {transaction_id}")
+        result = {"status": "success", "transaction_id": transaction_id, "amount": amount}
+        if idempotency_key:
+            _gateway_refunds[idempotency_key] = result
+        return result
+
+
+async def amock_payment_gateway_api(amount: float, user_id: str,
+                                    idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+    """Async twin of mock_payment_gateway_api; latency is awaited instead of slept."""
+    previous = _already_refunded(idempotency_key)
+    if previous is not None:
+        return previous
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] Payment Gateway: Processing refund for {user_id} of ${amount:.2f}...")
+    if random.random() < 0.7:  # 70% failure rate for demonstration
+        await asyncio.sleep(0.5)
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Payment Gateway: FAILED!")
+        raise ConnectionError("Mock Payment Gateway API is unavailable or timed out.")
+    await asyncio.sleep(0.2)
+    transaction_id = f"TXN-{random.randint(10000, 99999)}"
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] Payment Gateway: SUCCESS for {user_id}! Transaction: {transaction_id}")
+    result = {"status": "success", "transaction_id": transaction_id, "amount": amount}
+    if idempotency_key:
+        _gateway_refunds[idempotency_key] = result
+    return result
+
+
+# --- Local Stand-in Payment Gateway Server ---
+
+class MockGatewayRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP stand-in for the payment gateway, so batching can be measured offline.
+    
+    POST /refunds/bulk  {"refunds": [{"id", "user_id", "amount", "idempotency_key"}, ...]}
+    -> {"results": [{"id", "status": "success", "transaction_id"} | {"id", "status": "failed", "error"}]}
+    
+    Every request costs one round trip of latency regardless of how many
+    refunds it carries, which is what makes coalescing pay off. A refund whose
+    idempotency key was already paid gets the earlier transaction back.
+    """
+    protocol_version = "HTTP/1.1"  # keep-alive, so pooled client connections are reused
+    
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != "/refunds/bulk":
+            self._reply(404, {"error": "not found"})
+            return
+        
+        config = self.server.gateway_config
+        time.sleep(random.uniform(*config["latency"]))
+        if random.random() < config["outage_rate"]:
+            self._reply(503, {"error": "Mock Payment Gateway API is unavailable or timed out."})
+            return
+        
+        results = []
+        for item in json.loads(body)["refunds"]:
+            previous = self.server.refunds.get(item.get("idempotency_key"))
+            if previous is not None:
+                results.append({**previous, "id": item["id"]})
+            elif random.random() < config["item_failure_rate"]:
+                results.append({"id": item["id"], "status": "failed", "error": "Refund declined by processor."})
+            else:
+                results.append({"id": item["id"], "status": "success",
+                                "transaction_id": f"TXN-{random.randint(10000, 99999)}", "amount": item["amount"]})
+                if item.get("idempotency_key"):
+                    self.server.refunds[item["idempotency_key"]] = results[-1]
+        self.server.batches_served += 1
+        self._reply(200, {"results": results})
+    
+    def _reply(self, status: int, payload: Dict[str, Any]) -> None:
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def log_message(self, format, *args):
+        pass
+
+def start_mock_gateway_server(port: int = 0,
+                              latency: Tuple[float, float] = (0.2, 0.5),
+                              item_failure_rate: float = 0.1,
+                              outage_rate: float = 0.0) -> ThreadingHTTPServer:
+    """Start the stand-in gateway on a background thread. Call .shutdown() to stop it."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockGatewayRequestHandler)
+    server.daemon_threads = True
+    server.gateway_config = {"latency": latency, "item_failure_rate": item_failure_rate, "outage_rate": outage_rate}
+    server.batches_served = 0
+    server.refunds = {}
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- Adaptive Concurrency Limiter (Bulkhead) ---
+
+# Shared by the sync and async gateway calls: both count against one limit
+payment_gateway_limiter = AdaptiveConcurrencyLimiter(
+    initial_limit=10,
+    max_limit=100,
+    latency_threshold=1.0,
+    ignore=[CircuitBreakerError, ValueError],
+    name="payment_gateway"
+)
+
+
+# --- Circuit Breaker Setup ---
+
+# Point PAYMENT_GATEWAY_BREAKER_STATE at a file to share breaker state between worker processes.
+# The async breaker below shares its own state through the same path plus ".async"
+_breaker_state_path = os.environ.get("PAYMENT_GATEWAY_BREAKER_STATE")
+if _breaker_state_path:
+    payment_gateway_breaker = SharedCircuitBreaker(
+        fail_max=3,
+        reset_timeout=5,
+        exclude=[ValueError],
+        listeners=[BreakerMetricsListener("payment_gateway")],
+        state_storage=CircuitMmapStorage(_breaker_state_path)
+    )
+else:
+    payment_gateway_breaker = CircuitBreaker(
+        fail_max=3,
+        reset_timeout=5,
+        exclude=[ValueError],
+        listeners=[BreakerMetricsListener("payment_gateway")]
+    )
+
+@retry(stop=stop_after_attempt(2) | retry_policy.stop_when_budget_exhausted(payment_gateway_retry_budget),
+       wait=retry_policy.wait_decorrelated_jitter(base=0.5, cap=5.0),
+       retry=retry_if_exception_type(ConnectionError),
+       before_sleep=record_retry_wait,
+       reraise=True)
+@payment_gateway_retry_budget.track
+@payment_gateway_limiter
+@payment_gateway_breaker
+def safe_payment_gateway_call(amount: float, user_id: str, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Circuit breaker, limiter and retry-protected payment gateway call; retries reuse the idempotency key.
+    The limiter sits inside the retry so a backing-off call does not hold a slot.
+    """
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] Attempting payment gateway call for {user_id}...")
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        result = mock_payment_gateway_api(amount, user_id, idempotency_key)
+        outcome = "success"
+        return result
+    finally:
+        refund_metrics.observe("refund_gateway_attempt_seconds", time.perf_counter() - start, outcome=outcome)
+        record_retry_budget()
+
+
+# --- Async Circuit Breaker and Retry ---
+
+async_payment_gateway_breaker = AsyncCircuitBreaker(
+    fail_max=3,
+    reset_timeout=5,
+    exclude=[ValueError],
+    listeners=[BreakerMetricsListener("payment_gateway_async")],
+    state_storage=CircuitMmapStorage(f"{_breaker_state_path}.async") if _breaker_state_path else None
+)
+
+@retry(stop=stop_after_attempt(2) | retry_policy.stop_when_budget_exhausted(payment_gateway_retry_budget),
+       wait=retry_policy.wait_decorrelated_jitter(base=0.5, cap=5.0),
+       retry=retry_if_exception_type(ConnectionError),
+       before_sleep=record_retry_wait,
+       reraise=True)
+@payment_gateway_retry_budget.track
+@payment_gateway_limiter
+@async_payment_gateway_breaker
+async def asafe_payment_gateway_call(amount: float, user_id: str,
+                                     idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Async circuit breaker and retry-protected payment gateway call; backoff is awaited, not slept.
+    The limiter sits inside the retry so a backing-off call does not hold a slot.
+    """
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] Attempting payment gateway call for {user_id}...")
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        result = await amock_payment_gateway_api(amount, user_id, idempotency_key)
+        outcome = "success"
+        return result
+    finally:
+        refund_metrics.observe("refund_gateway_attempt_seconds", time.perf_counter() - start, outcome=outcome)
+        record_retry_budget()
+
+
+# --- Pooled, Batching Payment Gateway Client ---
+
+class RefundDeclinedError(ValueError):
+    """The processor refused the refund. The gateway is healthy, so this is not retried or counted by the breaker."""
+
+class BatchingPaymentGatewayClient:
+    """
+    Payment gateway client that coalesces refunds into bulk submissions.
+    
+    Refunds submitted within `max_wait` seconds of each other (up to
+    `max_batch_size`) are sent as one POST over a pooled keep-alive
+    connection, and each refund gets its own result back.
+    
+    Fail-safe semantics match safe_payment_gateway_call:
+    - each bulk submission goes through the circuit breaker; a transport
+      error or a 5xx counts as one failure
+    - while the breaker is open every refund in the batch fails fast with
+      CircuitBreakerError and is not retried
+    - a refund the processor declines fails with RefundDeclinedError; it is
+      an answer, not a gateway fault, so it is not retried or counted
+    - a refund whose batch failed with a ConnectionError, or that got no
+      result back, is retried up to `max_attempts` in total while
+      `retry_budget` allows it, after a decorrelated-jitter wait of at least
+      `retry_wait`
+    
+    pybreaker.call() holds the breaker's lock for the whole protected call.
+    While the circuit is closed, submissions use breaker.calling() instead,
+    which takes the lock only to admit the call, so up to `pool_size`
+    senders have a round trip in flight at once over kept-alive connections.
+    In any other state they go through call(), so the half-open trial is the
+    only submission in flight.
+    """
+    
+    def __init__(self,
+                 base_url: str,
+                 breaker: CircuitBreaker = payment_gateway_breaker,
+                 max_batch_size: int = 50,
+                 max_wait: float = 0.02,
+                 pool_size: int = 4,
+                 max_attempts: int = 2,
+                 retry_wait: float = 1.0,
+                 timeout: float = 10.0,
+                 retry_budget: Optional["retry_policy.RetryBudget"] = None):
+        parsed = urlsplit(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.breaker = breaker
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_attempts = max_attempts
+        self.retry_wait = retry_wait
+        self.timeout = timeout
+        self.retry_budget = retry_budget or payment_gateway_retry_budget
+        self.batches_sent = 0
+        
+        # Idle keep-alive connections; at most pool_size senders ever check one out
+        self._connections: "queue.LifoQueue[http.client.HTTPConnection]" = queue.LifoQueue()
+        self._senders = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="gateway-sender")
+        self._pending: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+        self._ids = itertools.count(1)
+        self._closed = False
+        # Refunds waiting out a retry backoff: id -> (timer, item, error), failed by close()
+        self._retrying: Dict[int, Tuple[threading.Timer, Dict[str, Any], Exception]] = {}
+        self._lock = threading.Lock()
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="gateway-dispatcher", daemon=True)
+        self._dispatcher.start()
+    
+    def submit(self, amount: float, user_id: str, idempotency_key: Optional[str] = None) -> Future:
+        """Queue a refund for the next bulk submission. The future resolves to the gateway result dict."""
+        future: Future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Payment gateway client is closed")
+            self._pending.put({"id": next(self._ids), "user_id": user_id, "amount": amount,
+                               "idempotency_key": idempotency_key, "attempts": 0, "wait": 0.0, "future": future})
+        return future
+    
+    def refund(self, amount: float, user_id: str, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """Blocking drop-in for safe_payment_gateway_call."""
+        return self.submit(amount, user_id, idempotency_key).result()
+    
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            retrying, self._retrying = list(self._retrying.values()), {}
+        # Nothing is queued after the sentinel: submit() and _requeue() check _closed under the lock
+        self._pending.put(None)
+        for timer, item, error in retrying:
+            timer.cancel()
+            item["future"].set_exception(error)
+        self._dispatcher.join()
+        self._senders.shutdown(wait=True)
+        while not self._connections.empty():
+            self._connections.get_nowait().close()
+    
+    def _dispatch_loop(self) -> None:
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._senders.submit(self._send_batch, batch)
+                    return
+                batch.append(item)
+            self._senders.submit(self._send_batch, batch)
+    
+    def _send_batch(self, batch: List[Dict[str, Any]]) -> None:
+        for item in batch:
+            item["attempts"] += 1
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Submitting bulk refund of {len(batch)} item(s)...")
+        try:
+            results = self._protected_post(batch)
+        except CircuitBreakerError as e:
+            for item in batch:
+                item["future"].set_exception(e)
+            return
+        except ConnectionError as e:
+            for item in batch:
+                self._retry_or_fail(item, e)
+            return
+        except Exception as e:
+            for item in batch:
+                item["future"].set_exception(e)
+            return
+        
+        for item in batch:
+            result = results.get(item["id"])
+            if result is None:
+                self._retry_or_fail(item, ConnectionError("Gateway returned no result for refund."))
+            elif result["status"] == "success":
+                self.retry_budget.deposit()
+                item["future"].set_result(result)
+            else:
+                item["future"].set_exception(RefundDeclinedError(result.get("error", "Refund declined.")))
+    
+    def _protected_post(self, batch: List[Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
+        if self.breaker.current_state == "closed":
+            with self.breaker.calling():
+                return self._post_bulk(batch)
+        return self.breaker.call(self._post_bulk, batch)
+    
+    def _post_bulk(self, batch: List[Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
+        """One bulk round trip; raises ConnectionError for anything the breaker should count."""
+        self.batches_sent += 1
+        body = json.dumps({"refunds": [{"id": item["id"], "user_id": item["user_id"], "amount": item["amount"],
+                                        "idempotency_key": item["idempotency_key"]} for item in batch]})
+        try:
+            connection = self._connections.get_nowait()
+        except queue.Empty:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.request("POST", "/refunds/bulk", body=body, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            payload = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()
+            raise ConnectionError(f"Payment gateway request failed: {e}") from e
+        self._connections.put(connection)
+        
+        if response.status >= 500:
+            raise ConnectionError(f"Payment gateway returned HTTP {response.status}")
+        if response.status != 200:
+            raise ValueError(f"Payment gateway rejected bulk request: HTTP {response.status}")
+        
+        return {result["id"]: result for result in json.loads(payload)["results"]}
+    
+    def _retry_or_fail(self, item: Dict[str, Any], error: Exception) -> None:
+        with self._lock:
+            if item["attempts"] < self.max_attempts and not self._closed and self.retry_budget.try_spend():
+                item["wait"] = retry_policy.decorrelated_jitter(self.retry_wait, 10 * self.retry_wait, item["wait"])
+                timer = threading.Timer(item["wait"], self._requeue, args=(item,))
+                timer.daemon = True
+                self._retrying[item["id"]] = (timer, item, error)
+                timer.start()
+                return
+        item["future"].set_exception(error)
+    
+    def _requeue(self, item: Dict[str, Any]) -> None:
+        with self._lock:
+            # Gone if close() already failed it
+            if self._retrying.pop(item["id"], None) is not None:
+                self._pending.put(item)
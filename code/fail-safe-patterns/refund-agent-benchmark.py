@@ -0,0 +1,227 @@
+"""
+Offline benchmark for the refund agent pipeline in refund_agent.py.
+
+No OpenAI key is needed: the LLM is a scripted chat model that drives the
+same function-calling loop as the real agent (analyze -> gateway or review ->
+final answer), or answers the single structured call of
+decision_mode="structured", and the payment gateway is replaced by a stand-in with
+configurable latency and failure rate. The circuit breaker, retry, rule
+engine and review queue are the real ones.
+
+Reports throughput, p50/p95/p99 latency, time per stage (LLM, each tool,
+gateway attempts, retry waits) and allocations per request, for request
+mixes built from the demo scenarios, and saves everything as JSON:
+
+    python refund-agent-benchmark.py --requests 200 --output results.json
+    python refund-agent-benchmark.py --compare results.json
+    python refund-agent-benchmark.py --decision-modes agent,structured
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import payment_gateway
+from refund_agent import RefundAgent
+from refund_fakes import ScriptedRefundChatModel, StageTimer, install_fake_gateway
+from refund_models import DEMO_SCENARIOS
+from refund_storage import RefundOutbox, ReviewQueue
+
+
+# --- Request mixes ---
+
+def build_mixes(num_requests, rng):
+    routine, damaged, not_described, suspicious = DEMO_SCENARIOS
+    weights = {
+        "routine": [(routine, 1.0)],
+        "mixed": [(s, 1.0) for s in DEMO_SCENARIOS],
+        "review_heavy": [(routine, 0.2), (damaged, 0.4), (suspicious, 0.4)],
+    }
+    mixes = {}
+    for name, choices in weights.items():
+        scenarios, probabilities = zip(*choices)
+        picks = rng.choices(scenarios, probabilities, k=num_requests)
+        mixes[name] = [s.model_copy(update={"user_id": f"{s.user_id}_{i}", "order_id": f"{s.order_id}-{i}"})
+                       for i, s in enumerate(picks)]
+    return mixes
+
+
+# --- Runs ---
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def make_agent(args, timer, review_path, decision_mode):
+    agent = RefundAgent(llm=ScriptedRefundChatModel(latency=args.llm_latency, callbacks=[timer]),
+                               decision_mode=decision_mode,
+                               review_queue=ReviewQueue(review_path),
+                               outbox=RefundOutbox(review_path.replace(".db", "-outbox.db")))
+    agent.agent_executor.verbose = False
+    for tool in agent.tools:
+        tool.callbacks = [timer]
+    return agent
+
+
+def reset_breakers():
+    payment_gateway.payment_gateway_breaker.close()
+    payment_gateway.async_payment_gateway_breaker.close()
+
+
+def run_sync(agent, requests):
+    latencies, results = [], []
+    for request in requests:
+        start = time.perf_counter()
+        results.append(agent.process_refund_request(request))
+        latencies.append(time.perf_counter() - start)
+    return latencies, results
+
+
+def run_async(agent, requests, concurrency):
+    latencies = []
+    process = agent._aprocess
+
+    async def timed(refund_request, analysis=None):
+        start = time.perf_counter()
+        try:
+            return await process(refund_request, analysis)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    agent._aprocess = timed
+    try:
+        results = asyncio.run(agent.aprocess_refund_requests(requests, max_concurrency=concurrency))
+    finally:
+        del agent._aprocess
+    return latencies, results
+
+
+def measure(args, mode, decision_mode, requests, review_path, seed):
+    timer = StageTimer()
+    install_fake_gateway(timer, args.gateway_latency, args.gateway_failure_rate, random.Random(seed))
+    agent = make_agent(args, timer, review_path, decision_mode)
+    reset_breakers()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        if mode == "sync":
+            latencies, results = run_sync(agent, requests)
+        else:
+            latencies, results = run_async(agent, requests, args.concurrency)
+        elapsed = time.perf_counter() - start
+        stages = timer.summary(len(requests))
+        latency_ms = {f"p{p}": round(1000 * percentile(latencies, p), 2) for p in (50, 95, 99)}
+        latency_mean_ms = round(1000 * statistics.fmean(latencies), 2)
+
+        # Allocation pass on a slice, separately so tracemalloc does not skew timings
+        sample = requests[:args.alloc_sample]
+        reset_breakers()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        if mode == "sync":
+            run_sync(agent, sample)
+        else:
+            run_async(agent, sample, args.concurrency)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    # The agent runs with its default model limiter; none of these should be
+    # shed by it (or fail any other way) with the stand-in LLM and gateway
+    errors = [r.notes for r in results if r.decision_maker == "System Error"]
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename") if stat.size_diff > 0)
+    return {
+        "requests": len(requests),
+        "elapsed_s": round(elapsed, 4),
+        "throughput_rps": round(len(requests) / elapsed, 2),
+        "latency_ms": latency_ms,
+        "latency_mean_ms": latency_mean_ms,
+        "stages": stages,
+        "alloc_retained_kb_per_request": round(allocated / 1024 / len(sample), 2),
+        "alloc_peak_kb": round(peak / 1024, 1),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+    }
+
+
+def compare(current, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nComparison against {baseline_path} ({baseline['timestamp']}):")
+    print(f"{'mix/mode':<33}{'throughput':>22}{'p95 ms':>24}")
+    for key, result in current["results"].items():
+        old = baseline["results"].get(key)
+        if not old:
+            continue
+        dt = 100 * (result["throughput_rps"] / old["throughput_rps"] - 1)
+        dp = 100 * (result["latency_ms"]["p95"] / old["latency_ms"]["p95"] - 1)
+        print(f"{key:<33}{old['throughput_rps']:>8.1f} -> {result['throughput_rps']:>6.1f} ({dt:+5.1f}%)"
+              f"{old['latency_ms']['p95']:>8.1f} -> {result['latency_ms']['p95']:>6.1f} ({dp:+5.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100, help="requests per mix")
+    parser.add_argument("--concurrency", type=int, default=16, help="max concurrency for the async mode")
+    parser.add_argument("--modes", default="sync,async")
+    parser.add_argument("--mixes", default="routine,mixed,review_heavy")
+    parser.add_argument("--decision-modes", default="agent", help="agent and/or structured")
+    parser.add_argument("--llm-latency", type=float, default=0.02, help="seconds per scripted LLM turn")
+    parser.add_argument("--gateway-latency", type=float, default=0.02, help="seconds per gateway attempt")
+    parser.add_argument("--gateway-failure-rate", type=float, default=0.0)
+    parser.add_argument("--alloc-sample", type=int, default=20, help="requests traced for allocations")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", default="refund-agent-benchmark.json")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    mixes = build_mixes(args.requests, random.Random(args.seed))
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": vars(args),
+        "results": {},
+    }
+
+    failed = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for mix in args.mixes.split(","):
+            for mode, decision_mode in itertools.product(args.modes.split(","), args.decision_modes.split(",")):
+                # Agent-mode keys stay "mix/mode" so older result files still compare
+                key = f"{mix}/{mode}" if decision_mode == "agent" else f"{mix}/{mode}/{decision_mode}"
+                result = measure(args, mode, decision_mode, mixes[mix],
+                                 os.path.join(tmp, f"{mix}-{mode}-{decision_mode}.db"), args.seed)
+                report["results"][key] = result
+                latency = result["latency_ms"]
+                print(f"{key:<33} {result['throughput_rps']:>8.1f} req/s   "
+                      f"p50 {latency['p50']:>7.1f} ms  p95 {latency['p95']:>7.1f} ms  p99 {latency['p99']:>7.1f} ms  "
+                      f"{result['alloc_retained_kb_per_request']:>7.1f} KB/req")
+                if result["errors"]:
+                    failed.append(f"{key}: {result['errors']} System Errors, e.g. {result['first_error']}")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare(report, args.compare)
+    if failed:
+        sys.exit("\n".join(["\nRequests failed:"] + failed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Startup benchmark for the refund agent modules (refund_agent.py and what it imports).
+
+Cold start is what autoscaled workers and short-lived jobs pay, so every run
+happens in a fresh interpreter and reports:
+
+- module import time, and whether LangChain got imported (it should not: the
+  breaker, retry and gateway code must stay usable without it)
+- the time to load LangChain and build the first agent
+- the time to the first processed refund, end to end from interpreter start
+- per-agent construction cost: a new RefundAgent vs RefundAgentFactory.create()
+
+The LLM and payment gateway are the offline stand-ins from refund_fakes.py,
+with zero latency, so only startup work is timed.
+
+    python refund-agent-startup-benchmark.py --runs 5 --output startup.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def child(agents):
+    """One cold start; prints a JSON line of timings in seconds."""
+    start = time.perf_counter()
+    import refund_agent
+    imported = time.perf_counter()
+    langchain_on_import = any(name.split(".")[0] == "langchain" for name in sys.modules)
+
+    # Imported after the measurement: the stand-ins import langchain_core themselves
+    import refund_fakes
+    from refund_models import DEMO_SCENARIOS
+    from refund_storage import ReviewQueue
+    refund_fakes.install_fake_gateway(refund_fakes.StageTimer(), 0.0, 0.0, random.Random(0))
+
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        review_queue = ReviewQueue(os.path.join(tmp, "reviews.db"))
+
+        def build():
+            return refund_agent.RefundAgent(llm=refund_fakes.ScriptedRefundChatModel(latency=0.0),
+                                            review_queue=review_queue)
+
+        agent = build()
+        agent.agent_executor.verbose = False
+        first_agent = time.perf_counter()
+        agent.process_refund_request(DEMO_SCENARIOS[0])
+        first_refund = time.perf_counter()
+
+        t0 = time.perf_counter()
+        for _ in range(agents):
+            build()
+        t1 = time.perf_counter()
+        factory = refund_agent.RefundAgentFactory(llm=refund_fakes.ScriptedRefundChatModel(latency=0.0),
+                                                  review_queue=review_queue)
+        t2 = time.perf_counter()
+        for _ in range(agents):
+            factory.create()
+        t3 = time.perf_counter()
+
+    print(json.dumps({
+        "import_s": imported - start,
+        "langchain_on_import": langchain_on_import,
+        "first_agent_s": first_agent - start,
+        "first_refund_s": first_refund - start,
+        "new_agent_ms": 1000 * (t1 - t0) / agents,
+        "factory_create_ms": 1000 * (t3 - t2) / agents,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="cold starts to measure")
+    parser.add_argument("--agents", type=int, default=20, help="agents built per construction timing")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.agents)
+        return
+
+    runs = []
+    for _ in range(args.runs):
+        interpreter_start = time.perf_counter()
+        out = subprocess.run([sys.executable, __file__, "--child", "--agents", str(args.agents)],
+                             capture_output=True, text=True, check=True, cwd=HERE).stdout
+        run = json.loads(out.strip().splitlines()[-1])
+        run["process_s"] = time.perf_counter() - interpreter_start
+        runs.append(run)
+
+    summary = {key: round(statistics.median(run[key] for run in runs), 4)
+               for key in runs[0] if key != "langchain_on_import"}
+    summary["langchain_on_import"] = any(run["langchain_on_import"] for run in runs)
+
+    print(f"Median of {args.runs} cold starts:")
+    print(f"  module import            {1000 * summary['import_s']:8.1f} ms"
+          f"  (LangChain imported: {summary['langchain_on_import']})")
+    print(f"  first agent built        {1000 * summary['first_agent_s']:8.1f} ms")
+    print(f"  first refund processed   {1000 * summary['first_refund_s']:8.1f} ms")
+    print(f"  whole process            {1000 * summary['process_s']:8.1f} ms")
+    print(f"  new RefundAgent          {summary['new_agent_ms']:8.2f} ms/agent")
+    print(f"  RefundAgentFactory       {summary['factory_create_ms']:8.2f} ms/agent")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version.split()[0], "runs": runs, "median": summary}, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,874 @@
+"""
+The LangChain refund agent: RefundAgent, which decides and carries out
+refunds through the tools in refund_tools.py with the fail-safe patterns of
+the other modules, and a factory and pool that share one prototype's
+expensive parts.
+
+LangChain itself is imported on first use, see load_langchain().
+"""
+import asyncio
+import contextlib
+import copy
+import hashlib
+import importlib
+import json
+import queue
+import re
+import types
+from concurrent.futures import Future
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from concurrency_limiter import AdaptiveConcurrencyLimiter
+from payment_gateway import BatchingPaymentGatewayClient
+from refund_models import RefundAnalysis, RefundDecision, RefundRequest, RefundResult
+from refund_risk import DecisionCache, RiskRuleEngine, default_risk_engine, refund_cache_key
+from refund_storage import (RefundIdempotencyIndex, RefundOutbox, ReviewQueue, default_review_queue,
+                            refund_idempotency_key)
+
+if TYPE_CHECKING:
+    from langchain_core.language_models import BaseChatModel
+
+
+# --- LangChain Tools ---
+# Importing LangChain takes a couple of seconds, which every autoscaled worker,
+# short-lived job and spawned process would pay even when it only needs the
+# breaker, retry or gateway code. So the tools and callback built on it live
+# in refund_tools.py, imported on first use by load_langchain(); module
+# attribute access (refund_agent.PaymentGatewayTool etc.) loads it too.
+
+_LANGCHAIN_EXPORTS = (
+    "AgentExecutor", "create_openai_functions_agent", "BaseTool", "StructuredTool",
+    "BaseMessage", "HumanMessage", "AIMessage", "ConversationBufferMemory",
+    "ConversationBufferWindowMemory", "ConversationSummaryBufferMemory", "ChatOpenAI",
+    "BaseChatModel", "ChatPromptTemplate", "MessagesPlaceholder", "BaseCallbackHandler",
+    "RunnableConfig", "PaymentGatewayTool", "HumanReviewTool", "RefundAnalysisTool",
+    "RefundAgentCallback",
+)
+
+def load_langchain() -> types.ModuleType:
+    """Import refund_tools (and with it LangChain); later calls return the already imported module."""
+    return importlib.import_module("refund_tools")
+
+def __getattr__(name: str) -> Any:
+    if name in _LANGCHAIN_EXPORTS:
+        return getattr(load_langchain(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# --- LangChain Agent Setup ---
+
+
+class RefundAgent:
+    """
+    LangChain-based AI Refund Agent with failsafe patterns.
+    
+    This agent combines:
+    1. Circuit breaker pattern for payment gateway resilience
+    2. Retry logic for transient failures
+    3. Human-in-the-loop for complex decisions
+    4. Risk analysis for fraud detection
+    """
+    
+    def __init__(self, 
+                 model_name: str = "gpt-3.5-turbo",
+                 confidence_threshold: float = 0.7,
+                 high_value_threshold: float = 500,
+                 pre_triage: bool = False,
+                 risk_engine: Optional[RiskRuleEngine] = None,
+                 gateway_client: Optional[BatchingPaymentGatewayClient] = None,
+                 review_queue: Optional[ReviewQueue] = None,
+                 outbox: Optional[RefundOutbox] = None,
+                 on_review_complete: Optional[Callable[[str, RefundResult], None]] = None,
+                 model_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                 decision_cache: Optional[DecisionCache] = None,
+                 idempotency_index: Optional[RefundIdempotencyIndex] = None,
+                 policy_version: Optional[str] = None,
+                 memory_mode: str = "per_request",
+                 memory_window: int = 3,
+                 memory_token_budget: int = 1000,
+                 llm: Optional["BaseChatModel"] = None,
+                 decision_mode: str = "agent"):
+        
+        refund_tools = load_langchain()
+        
+        self.confidence_threshold = confidence_threshold
+        self.high_value_threshold = high_value_threshold
+        
+        # With pre_triage on, the rule engine settles clear-cut requests
+        # (approve, or policy-mandated review) without an LLM round trip
+        self.pre_triage = pre_triage
+        self.risk_engine = risk_engine or default_risk_engine()
+        
+        # How a refund is decided:
+        # - "agent": the LLM drives the tools through the function-calling loop
+        #   (several round trips) and the outcome is read back from its answer
+        # - "structured": the rules run locally, the LLM is asked once for a
+        #   RefundAnalysis, and code carries out the decision
+        if decision_mode not in ("agent", "structured"):
+            raise ValueError(f"Unknown decision_mode: {decision_mode}")
+        self.decision_mode = decision_mode
+        
+        # Bounds in-flight agent runs (and their LLM calls) on both paths.
+        # The default one never sheds on a timeout: aprocess_refund_requests
+        # already bounds its workers, and they should queue for a slot rather
+        # than fail as System Errors while the limit is below max_concurrency
+        self._default_model_limiter = model_limiter is None
+        self.model_limiter = model_limiter or AdaptiveConcurrencyLimiter(
+            initial_limit=8, max_limit=64, latency_threshold=30.0, queue_timeout=None, name="llm")
+        
+        # Escalations are parked in the review queue; decisions resume the refund
+        # through on_review_complete (push) or resume_reviewed_refunds (poll)
+        self.review_queue = review_queue or default_review_queue()
+        self.on_review_complete = on_review_complete
+        if on_review_complete is not None:
+            self.review_queue.add_listener(self._on_review_decision)
+        
+        # Logs agent steps and times LLM and tool calls into refund_metrics
+        self.callback = refund_tools.RefundAgentCallback()
+        
+        # Initialize LLM (Note: You'll need to set OPENAI_API_KEY environment variable)
+        # Any LangChain chat model with function calling can be passed in instead
+        self.llm = llm or refund_tools.ChatOpenAI(
+            model=model_name,
+            temperature=0.1,  # Low temperature for consistent decisions
+            callbacks=[self.callback]
+        )
+        
+        # Initialize tools
+        self.tools = [
+            refund_tools.RefundAnalysisTool(cache=decision_cache, risk_engine=self.risk_engine),
+            refund_tools.PaymentGatewayTool(gateway_client=gateway_client, outbox=outbox),
+            refund_tools.HumanReviewTool(review_queue=self.review_queue)
+        ]
+        self._tools_by_name = {tool.name: tool for tool in self.tools}
+        
+        # Create agent prompt
+        self.prompt = refund_tools.ChatPromptTemplate.from_messages([
+            ("system", """You are an AI refund processing agent with the following responsibilities:
+            
+1. Analyze refund requests for risk factors using the analyze_refund_risk tool
+2. Make decisions based on company policies:
+   - Approve low-risk, routine refunds automatically
+   - Escalate high-risk, high-value, or suspicious requests to human review
+   - Process approved refunds through the payment gateway
+   
+3. Company policies:
+   - Refunds over $500 require human review
+   - Suspicious keywords (fraud, chargeback, etc.) require human review
+   - Low confidence scores (< 0.7) require human review
+   - All approved refunds must be processed through payment gateway
+   - Pass the request's Order ID to payment_gateway and human_review, so a
+     retried or deferred refund is recognised as the same refund
+   
+4. Human review is asynchronous: after escalating, report the case ID and stop.
+   Do not wait for or assume the human decision.
+5. Always provide clear reasoning for your decisions
+6. Handle payment gateway failures gracefully with appropriate fallbacks
+
+Be professional, thorough, and prioritize both customer satisfaction and fraud prevention."""),
+            refund_tools.MessagesPlaceholder(variable_name="chat_history", optional=True),
+            ("user", "{input}"),
+            refund_tools.MessagesPlaceholder(variable_name="agent_scratchpad")
+        ])
+        
+        # Single-shot prompt for decision_mode="structured"; the reply is
+        # validated against RefundAnalysis instead of being parsed from prose
+        self.decision_prompt = refund_tools.ChatPromptTemplate.from_messages([
+            ("system", """You are an AI refund processing agent. Decide whether a refund should be
+approved, rejected or escalated to human review, using the rule engine analysis
+provided with the request.
+
+Company policies:
+- Approve low-risk, routine refunds
+- Refunds over $500 require human review
+- Suspicious keywords (fraud, chargeback, etc.) require human review
+- Low confidence scores (< 0.7) require human review
+
+Give your decision, a confidence score between 0 and 1, clear reasoning and
+the risk factors you relied on."""),
+            ("user", "{input}")
+        ])
+        self.decision_chain = None
+        if decision_mode == "structured":
+            self.decision_chain = self.decision_prompt | self.llm.with_structured_output(RefundAnalysis)
+        
+        # Retries and duplicate deliveries of an order attach to the running
+        # request or get its stored result instead of running the agent again
+        self.idempotency_index = idempotency_index
+        
+        # Cached agent decisions are reused for equivalent requests; a change to
+        # the prompt, model or rules changes the policy version and invalidates them
+        self.decision_cache = decision_cache
+        active_prompt = self.decision_prompt if decision_mode == "structured" else self.prompt
+        self.policy_version = policy_version or hashlib.sha1(
+            f"{model_name}|{active_prompt.messages[0].prompt.template}|{self.risk_engine.fingerprint}".encode()
+        ).hexdigest()[:12]
+        
+        # Conversation memory carried from one refund to the next:
+        # - "per_request": none, every refund starts from a clean prompt (flat cost)
+        # - "window": the last `memory_window` exchanges
+        # - "summary": a running summary plus recent turns within `memory_token_budget`
+        # - "buffer": every exchange ever processed (unbounded growth)
+        # Shared memory interleaves concurrent async requests; prefer per_request there.
+        self.memory_mode = memory_mode
+        self.memory_window = memory_window
+        self.memory_token_budget = memory_token_budget
+        self.memory = self._create_memory()
+        self.memory_tokens = 0
+        
+        # Create agent
+        self.agent = refund_tools.create_openai_functions_agent(self.llm, self.tools, self.prompt)
+        self.agent_executor = self._create_executor()
+    
+    def _create_memory(self):
+        refund_tools = load_langchain()
+        if self.memory_mode == "per_request":
+            return None
+        if self.memory_mode == "window":
+            return refund_tools.ConversationBufferWindowMemory(k=self.memory_window, memory_key="chat_history",
+                                                               return_messages=True)
+        if self.memory_mode == "summary":
+            return refund_tools.ConversationSummaryBufferMemory(llm=self.llm,
+                                                                max_token_limit=self.memory_token_budget,
+                                                                memory_key="chat_history", return_messages=True)
+        if self.memory_mode == "buffer":
+            return refund_tools.ConversationBufferMemory(memory_key="chat_history", return_messages=True)
+        raise ValueError(f"Unknown memory_mode: {self.memory_mode}")
+    
+    def _create_executor(self):
+        return load_langchain().AgentExecutor(
+            agent=self.agent,
+            tools=self.tools,
+            verbose=True,
+            memory=self.memory,
+            handle_parsing_errors=True
+        )
+    
+    def _report_memory(self) -> None:
+        """Record and print how many tokens of history the next request will carry."""
+        if self.memory is None:
+            return
+        messages = self.memory.load_memory_variables({})["chat_history"]
+        try:
+            self.memory_tokens = self.llm.get_num_tokens_from_messages(messages) if messages else 0
+        except Exception:
+            # The tokenizer may be unavailable offline; reporting must not fail the refund
+            self.memory_tokens = sum(len(str(message.content)) for message in messages) // 4
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Conversation memory ({self.memory_mode}): "
+              f"{len(messages)} messages, {self.memory_tokens} tokens")
+    
+    def process_refund_request(self, refund_request: RefundRequest) -> RefundResult:
+        """
+        Process a refund request through the LangChain agent.
+        
+        This method implements the complete workflow:
+        1. Risk analysis
+        2. Decision making
+        3. Human escalation if needed
+        4. Payment processing with circuit breaker protection
+        """
+        key, duplicate = self._begin_request(refund_request)
+        if duplicate is not None:
+            try:
+                return duplicate.result()
+            except Exception as e:
+                return self._error_result(e)
+        if key is None:
+            return self._process_unique(refund_request)
+        try:
+            result = self._process_unique(refund_request)
+        except BaseException as e:
+            self.idempotency_index.abandon(key, e)
+            raise
+        self.idempotency_index.complete(key, result)
+        return result
+    
+    def _process_unique(self, refund_request: RefundRequest) -> RefundResult:
+        self._print_request_banner(refund_request)
+        
+        try:
+            analysis = self.risk_engine.score_batch([refund_request])[0] if self._scores_locally else None
+            if self.pre_triage and self._triage_lane(analysis):
+                return self._resolve_triaged(refund_request, analysis)
+            
+            cached = self._cached_decision(refund_request)
+            if cached:
+                return self._resolve_cached(refund_request, cached)
+            
+            if self.decision_mode == "structured":
+                decision = self.model_limiter.call_sync(self.decision_chain.invoke, {
+                    "input": self._build_decision_input(refund_request, analysis)
+                }, config={"callbacks": [self.callback]})
+                return self._remember_decision(refund_request,
+                                               self._execute_decision(refund_request, analysis, decision))
+            
+            # Execute the agent
+            # Passed per call so the callback reaches every LLM and tool run
+            result = self.model_limiter.call_sync(self.agent_executor.invoke, {
+                "input": self._build_agent_input(refund_request)
+            }, config={"callbacks": [self.callback]})
+            self._report_memory()
+            return self._remember_decision(refund_request, self._build_result(result.get("output", "")))
+                
+        except Exception as e:
+            print(f"Error processing refund request: {str(e)}")
+            return self._error_result(e)
+    
+    async def aprocess_refund_request(self, refund_request: RefundRequest) -> RefundResult:
+        """Async variant of process_refund_request built on AgentExecutor.ainvoke."""
+        analysis = self.risk_engine.score_batch([refund_request])[0] if self._scores_locally else None
+        return await self._aprocess(refund_request, analysis)
+    
+    async def _aprocess(self, refund_request: RefundRequest,
+                        analysis: Optional[Dict[str, Any]] = None) -> RefundResult:
+        key, duplicate = self._begin_request(refund_request)
+        if duplicate is not None:
+            try:
+                return await asyncio.wrap_future(duplicate)
+            except Exception as e:
+                return self._error_result(e)
+        if key is None:
+            return await self._aprocess_unique(refund_request, analysis)
+        try:
+            result = await self._aprocess_unique(refund_request, analysis)
+        except BaseException as e:
+            self.idempotency_index.abandon(key, e)
+            raise
+        self.idempotency_index.complete(key, result)
+        return result
+    
+    async def _aprocess_unique(self, refund_request: RefundRequest,
+                               analysis: Optional[Dict[str, Any]] = None) -> RefundResult:
+        self._print_request_banner(refund_request)
+        
+        try:
+            if self.pre_triage and analysis is not None and self._triage_lane(analysis):
+                return await self._aresolve_triaged(refund_request, analysis)
+            
+            cached = self._cached_decision(refund_request)
+            if cached:
+                return await self._aresolve_cached(refund_request, cached)
+            
+            if self.decision_mode == "structured":
+                if analysis is None:
+                    analysis = self.risk_engine.score_batch([refund_request])[0]
+                decision = await self.model_limiter.call(self.decision_chain.ainvoke, {
+                    "input": self._build_decision_input(refund_request, analysis)
+                }, config={"callbacks": [self.callback]})
+                return self._remember_decision(refund_request,
+                                               await self._aexecute_decision(refund_request, analysis, decision))
+            
+            result = await self.model_limiter.call(self.agent_executor.ainvoke, {
+                "input": self._build_agent_input(refund_request)
+            }, config={"callbacks": [self.callback]})
+            self._report_memory()
+            return self._remember_decision(refund_request, self._build_result(result.get("output", "")))
+        
+        except Exception as e:
+            print(f"Error processing refund request: {str(e)}")
+            return self._error_result(e)
+    
+    async def aprocess_refund_requests(self,
+                                       refund_requests: Iterable[RefundRequest],
+                                       max_concurrency: int = 10) -> List[RefundResult]:
+        """
+        Process a burst of refund requests concurrently.
+        
+        A fixed pool of `max_concurrency` workers pulls requests from the input
+        one at a time, so no more than that many agent runs are ever in flight
+        and large bursts are consumed lazily instead of being turned into
+        thousands of pending tasks up front (backpressure).
+        
+        Results are returned in the same order as the input. A failure in one
+        request is turned into a "System Error" RefundResult for that request
+        only; the rest of the batch keeps going.
+        
+        With pre_triage or the structured decision mode on, the whole batch is
+        scored by the rule engine in one pass before any worker starts.
+        """
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        if self._default_model_limiter:
+            # Room in the queue for every worker, so none of them is shed
+            self.model_limiter.max_queue = max(self.model_limiter.max_queue, max_concurrency)
+        
+        if self._scores_locally:
+            refund_requests = list(refund_requests)
+            analyses = self.risk_engine.score_batch(refund_requests)
+        else:
+            analyses = None
+        
+        pending = enumerate(refund_requests)
+        results: Dict[int, RefundResult] = {}
+        
+        async def worker():
+            for index, refund_request in pending:
+                try:
+                    analysis = analyses[index] if analyses is not None else None
+                    results[index] = await self._aprocess(refund_request, analysis)
+                except Exception as e:
+                    results[index] = self._error_result(e)
+        
+        await asyncio.gather(*(worker() for _ in range(max_concurrency)))
+        return [results[index] for index in range(len(results))]
+    
+    def close(self) -> None:
+        """Stop taking review decisions pushed by the queue; later ones go to other agents or a poll."""
+        if self.on_review_complete is not None:
+            self.review_queue.remove_listener(self._on_review_decision)
+    
+    def resume_reviewed_refunds(self) -> List[Tuple[str, RefundResult]]:
+        """Poll the review queue and finish every refund a human has decided since the last poll."""
+        return [(case["case_id"], self._complete_review(case)) for case in self.review_queue.poll_decisions()]
+    
+    def _on_review_decision(self, case: Dict[str, Any]) -> None:
+        self.on_review_complete(case["case_id"], self._complete_review(case))
+    
+    def _complete_review(self, case: Dict[str, Any]) -> RefundResult:
+        """
+        Carry out a human decision: approved refunds go through the payment
+        gateway. The result replaces the pending one stored for the order, so
+        a client retry sees the decision.
+        """
+        result = self._carry_out_review(case)
+        if self.idempotency_index is not None and case["order_id"] is not None:
+            self.idempotency_index.update(
+                self.idempotency_index.order_key(case["user_id"], case["order_id"]), result)
+        return result
+    
+    def _carry_out_review(self, case: Dict[str, Any]) -> RefundResult:
+        if case["status"] != "approved":
+            return RefundResult(
+                approved=False,
+                decision_maker="Human Review",
+                review_case_id=case["case_id"],
+                notes=f"Human rejected refund for {case['user_id']} of ${case['amount']:.2f}"
+            )
+        gateway = self._tools_by_name["payment_gateway"]
+        # Keyed by the case's order, as on the agent path, so the order is one refund whichever path pays
+        # or defers it; a case without an order is its own refund
+        key = refund_idempotency_key(case["user_id"], case["amount"], case["order_id"] or case["case_id"])
+        try:
+            output = gateway._format_result(gateway.refund(case["user_id"], case["amount"], key))
+        except Exception as e:
+            output = gateway._handle_failure(e, case["user_id"], case["amount"], key)
+        transaction_id = self._extract_transaction_id(output)
+        return RefundResult(
+            approved=transaction_id is not None,
+            decision_maker="Human Review + Payment Gateway" + ("" if transaction_id else " (deferred)"),
+            transaction_id=transaction_id,
+            review_case_id=case["case_id"],
+            outbox_key=None if transaction_id else self._extract_outbox_key(output),
+            notes=f"Human approved refund for {case['user_id']} of ${case['amount']:.2f}. {output}"
+        )
+    
+    def _begin_request(self, refund_request: RefundRequest) -> Tuple[Optional[bytes], Optional[Future]]:
+        """
+        (key, None) when this call owns the request (key is None without an
+        index or an order ID), or (None, future) for a duplicate.
+        """
+        key = self.idempotency_index.key(refund_request) if self.idempotency_index is not None else None
+        if key is None:
+            return None, None
+        owner, future = self.idempotency_index.begin(key)
+        if owner:
+            return key, None
+        state = "returning the stored result" if future.done() else "attaching to the running request"
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Duplicate refund request for {refund_request.order_id} "
+              f"({refund_request.user_id}): {state}")
+        if future.done() and future.exception() is None and future.result().decision_maker.endswith("(deferred)"):
+            future = self._refresh_deferred(key, future.result())
+        return None, future
+    
+    def _refresh_deferred(self, key: bytes, result: RefundResult) -> Future:
+        """Bring a stored deferral up to date with its outbox row once the drainer has finished with it."""
+        row = self._tools_by_name["payment_gateway"].ledger.get(result.outbox_key)
+        if row is not None and row["status"] == "sent":
+            result = result.model_copy(update={
+                "approved": True,
+                "decision_maker": result.decision_maker.replace(" (deferred)", ""),
+                "transaction_id": row["transaction_id"],
+                "notes": f"{result.notes} Replayed from the outbox. Transaction ID: {row['transaction_id']}"})
+            self.idempotency_index.update(key, result)
+        elif row is not None and row["status"] == "failed":
+            result = result.model_copy(update={
+                "decision_maker": result.decision_maker.replace(" (deferred)", " (failed)"),
+                "notes": f"{result.notes} Replay failed: {row['last_error']}"})
+            self.idempotency_index.update(key, result)
+        future: Future = Future()
+        future.set_result(result)
+        return future
+    
+    @property
+    def _scores_locally(self) -> bool:
+        return self.pre_triage or self.decision_mode == "structured"
+    
+    def _apply_policy(self, refund_request: RefundRequest, analysis: Dict[str, Any],
+                      decision: RefundAnalysis) -> RefundDecision:
+        """Hard policy limits win over the model: they can only move a refund to human review."""
+        if analysis["requires_review"] or refund_request.amount > self.high_value_threshold:
+            return RefundDecision.REVIEW
+        if decision.decision == RefundDecision.APPROVE and decision.confidence < self.confidence_threshold:
+            return RefundDecision.REVIEW
+        return decision.decision
+    
+    def _execute_decision(self, refund_request: RefundRequest, analysis: Dict[str, Any],
+                          decision: RefundAnalysis) -> RefundResult:
+        """Carry out a structured decision; tools are called directly with typed results."""
+        final = self._log_decision(refund_request, analysis, decision)
+        if final != RefundDecision.APPROVE:
+            return self._review_or_reject(refund_request, final, decision)
+        gateway = self._tools_by_name["payment_gateway"]
+        key = self._idempotency_key(refund_request)
+        try:
+            payment = gateway.refund(refund_request.user_id, refund_request.amount, key)
+        except Exception as e:
+            return self._failed_payment_result(
+                gateway._handle_failure(e, refund_request.user_id, refund_request.amount, key))
+        return self._approved_result(payment, decision)
+    
+    async def _aexecute_decision(self, refund_request: RefundRequest, analysis: Dict[str, Any],
+                                 decision: RefundAnalysis) -> RefundResult:
+        final = self._log_decision(refund_request, analysis, decision)
+        if final != RefundDecision.APPROVE:
+            return self._review_or_reject(refund_request, final, decision)
+        gateway = self._tools_by_name["payment_gateway"]
+        key = self._idempotency_key(refund_request)
+        try:
+            payment = await gateway.arefund(refund_request.user_id, refund_request.amount, key)
+        except Exception as e:
+            return self._failed_payment_result(
+                gateway._handle_failure(e, refund_request.user_id, refund_request.amount, key))
+        return self._approved_result(payment, decision)
+    
+    def _log_decision(self, refund_request: RefundRequest, analysis: Dict[str, Any],
+                      decision: RefundAnalysis) -> RefundDecision:
+        final = self._apply_policy(refund_request, analysis, decision)
+        override = f" (policy override: {final.value})" if final != decision.decision else ""
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Structured decision: {decision.decision.value} "
+              f"(confidence {decision.confidence:.2f}){override}")
+        return final
+    
+    def _review_or_reject(self, refund_request: RefundRequest, final: RefundDecision,
+                          decision: RefundAnalysis) -> RefundResult:
+        if final == RefundDecision.REJECT:
+            return RefundResult(approved=False, decision_maker="AI Agent", notes=decision.reasoning)
+        case_id = self._tools_by_name["human_review"].escalate(
+            refund_request.user_id, refund_request.amount, refund_request.reason, decision.reasoning,
+            refund_request.order_id)
+        return self._pending_review_result(case_id, decision.reasoning)
+    
+    def _approved_result(self, payment: Dict[str, Any], decision: RefundAnalysis) -> RefundResult:
+        return RefundResult(
+            approved=True,
+            decision_maker="AI Agent + Payment Gateway",
+            transaction_id=payment["transaction_id"],
+            notes=decision.reasoning
+        )
+    
+    def _idempotency_key(self, refund_request: RefundRequest) -> str:
+        return refund_idempotency_key(refund_request.user_id, refund_request.amount, refund_request.order_id)
+    
+    def _cache_key(self, refund_request: RefundRequest) -> str:
+        return refund_cache_key(refund_request.amount, refund_request.reason, self.policy_version, self.risk_engine)
+    
+    def _cached_decision(self, refund_request: RefundRequest) -> Optional[Dict[str, Any]]:
+        if self.decision_cache is None:
+            return None
+        return self.decision_cache.get(self._cache_key(refund_request))
+    
+    def _remember_decision(self, refund_request: RefundRequest, result: RefundResult) -> RefundResult:
+        """Cache the agent's decision (never its transaction) when the outcome is a clear decision."""
+        if self.decision_cache is None:
+            return result
+        if result.decision_maker == "AI Agent + Payment Gateway" and result.approved:
+            decision = RefundDecision.APPROVE
+        elif result.review_case_id:
+            decision = RefundDecision.REVIEW
+        elif result.decision_maker == "AI Agent" and not result.approved:
+            decision = RefundDecision.REJECT
+        else:
+            return result  # failures, human decisions and incomplete runs are not reusable
+        self.decision_cache.put(self._cache_key(refund_request), {"decision": decision.value, "notes": result.notes})
+        return result
+    
+    def _resolve_cached(self, refund_request: RefundRequest, cached: Dict[str, Any]) -> RefundResult:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Decision cache hit: {cached['decision']}")
+        if cached["decision"] == RefundDecision.APPROVE:
+            output = self._tools_by_name["payment_gateway"]._run(refund_request.user_id, refund_request.amount,
+                                                                 refund_request.order_id)
+        elif cached["decision"] == RefundDecision.REVIEW:
+            output = self._tools_by_name["human_review"]._run(
+                refund_request.user_id, refund_request.amount, refund_request.reason,
+                f"Cached decision: {cached['notes']}", refund_request.order_id)
+        else:
+            output = None
+        return self._build_cached_result(cached, output)
+    
+    async def _aresolve_cached(self, refund_request: RefundRequest, cached: Dict[str, Any]) -> RefundResult:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Decision cache hit: {cached['decision']}")
+        if cached["decision"] == RefundDecision.APPROVE:
+            output = await self._tools_by_name["payment_gateway"]._arun(refund_request.user_id, refund_request.amount,
+                                                                        refund_request.order_id)
+        elif cached["decision"] == RefundDecision.REVIEW:
+            output = await self._tools_by_name["human_review"]._arun(
+                refund_request.user_id, refund_request.amount, refund_request.reason,
+                f"Cached decision: {cached['notes']}", refund_request.order_id)
+        else:
+            output = None
+        return self._build_cached_result(cached, output)
+    
+    def _build_cached_result(self, cached: Dict[str, Any], output: Optional[str]) -> RefundResult:
+        if output is None:
+            return RefundResult(approved=False, decision_maker="AI Agent (cached)", notes=cached["notes"])
+        case_id = self._extract_review_case_id(output)
+        if case_id:
+            return self._pending_review_result(case_id, output)
+        transaction_id = self._extract_transaction_id(output)
+        if transaction_id is None:
+            return self._failed_payment_result(output)
+        return RefundResult(
+            approved=True,
+            decision_maker="AI Agent (cached) + Payment Gateway",
+            transaction_id=transaction_id,
+            notes=output
+        )
+    
+    def _triage_lane(self, analysis: Dict[str, Any]) -> Optional[str]:
+        """Return "approve" or "review" for clear-cut analyses, None if the agent should decide."""
+        if analysis["recommendation"] == "approve":
+            return "approve"
+        if analysis["requires_review"]:
+            return "review"
+        return None
+    
+    def _resolve_triaged(self, refund_request: RefundRequest, analysis: Dict[str, Any]) -> RefundResult:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Pre-triage: {self._triage_lane(analysis)}")
+        if self._triage_lane(analysis) == "approve":
+            output = self._tools_by_name["payment_gateway"]._run(refund_request.user_id, refund_request.amount,
+                                                                 refund_request.order_id)
+        else:
+            output = self._tools_by_name["human_review"]._run(
+                refund_request.user_id, refund_request.amount, refund_request.reason, analysis["reasoning"],
+                refund_request.order_id)
+        return self._build_triaged_result(output)
+    
+    async def _aresolve_triaged(self, refund_request: RefundRequest, analysis: Dict[str, Any]) -> RefundResult:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Pre-triage: {self._triage_lane(analysis)}")
+        if self._triage_lane(analysis) == "approve":
+            output = await self._tools_by_name["payment_gateway"]._arun(refund_request.user_id, refund_request.amount,
+                                                                        refund_request.order_id)
+        else:
+            output = await self._tools_by_name["human_review"]._arun(
+                refund_request.user_id, refund_request.amount, refund_request.reason, analysis["reasoning"],
+                refund_request.order_id)
+        return self._build_triaged_result(output)
+    
+    def _build_triaged_result(self, output: str) -> RefundResult:
+        """Build the result straight from the tool output; no LLM wording to interpret."""
+        transaction_id = self._extract_transaction_id(output)
+        if transaction_id:
+            return RefundResult(
+                approved=True,
+                decision_maker="Rule Engine + Payment Gateway",
+                transaction_id=transaction_id,
+                notes=output
+            )
+        case_id = self._extract_review_case_id(output)
+        if case_id:
+            return self._pending_review_result(case_id, output)
+        outbox_key = self._extract_outbox_key(output)
+        if outbox_key:
+            return self._deferred_result(outbox_key, output)
+        return RefundResult(
+            approved=False,
+            decision_maker="Rule Engine",
+            notes=output
+        )
+    
+    def _print_request_banner(self, refund_request: RefundRequest) -> None:
+        print(f"\n{'='*60}")
+        print(f"Processing Refund Request for {refund_request.user_id}")
+        print(f"Amount: ${refund_request.amount:.2f}")
+        print(f"Reason: {refund_request.reason}")
+        print(f"{'='*60}")
+    
+    def _build_agent_input(self, refund_request: RefundRequest) -> str:
+        """Construct input for the agent."""
+        return f"""
+Process refund request:
+- User ID: {refund_request.user_id}
+- Amount: ${refund_request.amount:.2f}
+- Reason: {refund_request.reason}
+- Order ID: {refund_request.order_id or 'N/A'}
+
+Please analyze this request and take appropriate action according to company policies.
+"""
+    
+    def _build_decision_input(self, refund_request: RefundRequest, analysis: Dict[str, Any]) -> str:
+        """Request details plus the local rule analysis for the single structured call."""
+        return f"""
+Refund request:
+- User ID: {refund_request.user_id}
+- Amount: ${refund_request.amount:.2f}
+- Reason: {refund_request.reason}
+- Order ID: {refund_request.order_id or 'N/A'}
+
+Rule engine analysis:
+{json.dumps(analysis)}
+"""
+    
+    def _build_result(self, output: str) -> RefundResult:
+        """Determine final status based on agent output."""
+        case_id = self._extract_review_case_id(output)
+        outbox_key = self._extract_outbox_key(output)
+        if case_id:
+            return self._pending_review_result(case_id, output)
+        elif outbox_key and not self._extract_transaction_id(output):
+            return self._deferred_result(outbox_key, output)
+        elif "approved" in output.lower() and "transaction" in output.lower():
+            return RefundResult(
+                approved=True,
+                decision_maker="AI Agent + Payment Gateway",
+                transaction_id=self._extract_transaction_id(output),
+                notes=output
+            )
+        elif "human approved" in output.lower():
+            return RefundResult(
+                approved=True,
+                decision_maker="Human Review",
+                notes=output
+            )
+        elif "rejected" in output.lower() or "denied" in output.lower():
+            return RefundResult(
+                approved=False,
+                decision_maker="Human Review" if "human" in output.lower() else "AI Agent",
+                notes=output
+            )
+        else:
+            return RefundResult(
+                approved=False,
+                decision_maker="System",
+                notes=f"Processing incomplete or failed: {output}"
+            )
+    
+    def _pending_review_result(self, case_id: str, output: str) -> RefundResult:
+        return RefundResult(
+            approved=False,
+            decision_maker="Human Review (pending)",
+            review_case_id=case_id,
+            notes=output
+        )
+    
+    def _deferred_result(self, outbox_key: str, output: str,
+                         decision_maker: str = "Payment Gateway (deferred)") -> RefundResult:
+        """An approved refund waiting in the outbox; _begin_request refreshes it once replayed."""
+        return RefundResult(
+            approved=False,
+            decision_maker=decision_maker,
+            outbox_key=outbox_key,
+            notes=output
+        )
+    
+    def _failed_payment_result(self, output: str) -> RefundResult:
+        outbox_key = self._extract_outbox_key(output)
+        if outbox_key:
+            return self._deferred_result(outbox_key, output)
+        return RefundResult(approved=False, decision_maker="System", notes=output)
+    
+    def _error_result(self, error: Exception) -> RefundResult:
+        return RefundResult(
+            approved=False,
+            decision_maker="System Error",
+            notes=f"Failed to process: {str(error)}"
+        )
+    
+    def _extract_transaction_id(self, text: str) -> Optional[str]:
+        """Extract transaction ID from agent output."""
+        match = re.search(r'TXN-\d+', text)
+        return match.group(0) if match else None
+    
+    def _extract_review_case_id(self, text: str) -> Optional[str]:
+        """Extract human review case ID from agent or tool output."""
+        match = re.search(r'CASE-[0-9a-f]+', text)
+        return match.group(0) if match else None
+    
+    def _extract_outbox_key(self, text: str) -> Optional[str]:
+        """Extract the refund outbox key of a deferred payment from agent or tool output."""
+        match = re.search(r'RFD-[0-9a-f]{16}', text)
+        return match.group(0) if match else None
+
+
+# --- Agent Factory and Pool ---
+
+class RefundAgentFactory:
+    """
+    Builds RefundAgents that share the immutable pieces of one prototype.
+    
+    The LLM client, tools, prompts, the agent runnable, the structured decision
+    chain and the policy version are built once; each new agent only gets its
+    own conversation memory and AgentExecutor, which is what a request
+    mutates, and its own review-queue listener, so closing one agent leaves
+    the others listening. Creating an agent is then a shallow copy plus an
+    executor instead of the full RefundAgent constructor.
+    
+    Takes the same keyword arguments as RefundAgent.
+    """
+    
+    def __init__(self, **agent_kwargs):
+        self.prototype = RefundAgent(**agent_kwargs)
+        self._listening: List[RefundAgent] = []
+        self.created = 0
+    
+    def create(self) -> RefundAgent:
+        agent = copy.copy(self.prototype)
+        agent.memory = agent._create_memory()
+        agent.memory_tokens = 0
+        agent.agent_executor = agent._create_executor()
+        if agent.on_review_complete is not None:
+            agent.review_queue.add_listener(agent._on_review_decision)
+            self._listening.append(agent)
+        self.created += 1
+        return agent
+    
+    def pool(self, size: int) -> "RefundAgentPool":
+        return RefundAgentPool(self, size)
+    
+    def close(self) -> None:
+        """Stop the prototype and every agent created from it taking review decisions."""
+        for agent in [self.prototype] + self._listening:
+            agent.close()
+
+class RefundAgentPool:
+    """
+    Fixed set of pre-built agents handed out one request at a time.
+    
+    Needed when agents carry conversation memory (memory_mode other than
+    per_request), so concurrent requests never share a history. acquire()
+    blocks until an agent is free.
+    """
+    
+    def __init__(self, factory: RefundAgentFactory, size: int = 4):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.factory = factory
+        self._idle: "queue.LifoQueue[RefundAgent]" = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put(factory.create())
+    
+    @contextlib.contextmanager
+    def acquire(self, timeout: Optional[float] = None):
+        agent = self._idle.get(timeout=timeout)
+        try:
+            yield agent
+        finally:
+            self._idle.put(agent)
+    
+    def process_refund_request(self, refund_request: RefundRequest) -> RefundResult:
+        with self.acquire() as agent:
+            return agent.process_refund_request(refund_request)
+    
+    @property
+    def idle(self) -> int:
+        return self._idle.qsize()
@@ -0,0 +1,152 @@
+"""
+Offline stand-ins for the refund agent's external services, shared by the
+benchmarks: a scripted chat model that plays the LLM's part, a callback
+that times each stage, and a fake payment gateway with configurable
+latency and failure rate.
+"""
+import asyncio
+import json
+import re
+import time
+from collections import defaultdict
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, FunctionMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+import payment_gateway
+
+
+# --- Scripted chat model ---
+
+class ScriptedRefundChatModel(BaseChatModel):
+    """Plays the agent's part deterministically: analyze, then pay or escalate, then answer."""
+    latency: float = 0.05
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted-refund"
+
+    def bind_tools(self, tools, **kwargs):
+        # Enough for with_structured_output(RefundAnalysis)
+        return self.bind(tools=tools, **kwargs)
+
+    def _next_message(self, messages, tools=None) -> AIMessage:
+        text = next(m.content for m in messages if isinstance(m, HumanMessage))
+        if tools:
+            # Structured mode: echo the rule analysis back as a RefundAnalysis
+            analysis = json.loads(text.split("Rule engine analysis:", 1)[1])
+            args = {"decision": analysis["recommendation"], "confidence": analysis["confidence"],
+                    "reasoning": analysis["reasoning"], "risk_factors": analysis["risk_factors"]}
+            return AIMessage(content="", tool_calls=[{"name": "RefundAnalysis", "args": args, "id": "call_0"}])
+        request = {
+            "user_id": re.search(r"User ID: (\S+)", text).group(1),
+            "amount": float(re.search(r"Amount: \$([\d.]+)", text).group(1)),
+            "reason": re.search(r"Reason: (.*)", text).group(1).strip(),
+        }
+        order_id = re.search(r"Order ID: (\S+)", text).group(1)
+        results = [m for m in messages if isinstance(m, FunctionMessage)]
+        if not results:
+            return self._call("analyze_refund_risk", request)
+
+        last = results[-1]
+        if last.name == "analyze_refund_risk":
+            analysis = json.loads(last.content)
+            args = {"user_id": request["user_id"], "amount": request["amount"]}
+            if order_id != "N/A":
+                args["order_id"] = order_id
+            if analysis["recommendation"] == "approve":
+                return self._call("payment_gateway", args)
+            return self._call("human_review", {**args, "reason": request["reason"],
+                                               "ai_reasoning": analysis["reasoning"]})
+        if last.name == "payment_gateway" and "Transaction ID" in last.content:
+            return AIMessage(content=f"The refund was approved. {last.content}")
+        return AIMessage(content=last.content)
+
+    def _call(self, name, args) -> AIMessage:
+        return AIMessage(content="", additional_kwargs={"function_call": {"name": name, "arguments": json.dumps(args)}})
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._next_message(messages, kwargs.get("tools")))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._next_message(messages, kwargs.get("tools")))])
+
+
+# --- Stage timing ---
+
+class StageTimer(BaseCallbackHandler):
+    """Accumulates wall time per stage from LangChain callbacks plus explicit records."""
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self._started = {}
+
+    def record(self, stage, seconds):
+        self.totals[stage] += seconds
+        self.counts[stage] += 1
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._started[run_id] = ("llm", time.perf_counter())
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._started[run_id] = (f"tool:{serialized.get('name')}", time.perf_counter())
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def _finish(self, run_id):
+        stage, start = self._started.pop(run_id, (None, None))
+        if stage:
+            self.record(stage, time.perf_counter() - start)
+
+    def summary(self, num_requests):
+        return {stage: {"calls": self.counts[stage],
+                        "total_s": round(total, 4),
+                        "per_request_ms": round(1000 * total / num_requests, 3)}
+                for stage, total in sorted(self.totals.items())}
+
+
+def install_fake_gateway(timer, latency, failure_rate, rng):
+    """Swap the payment gateway and retry sleeps for timed, configurable stand-ins."""
+    def gateway(amount, user_id, idempotency_key=None):
+        start = time.perf_counter()
+        time.sleep(latency)
+        timer.record("gateway_attempt", time.perf_counter() - start)
+        if rng.random() < failure_rate:
+            raise ConnectionError("Benchmark gateway failure")
+        return {"status": "success", "transaction_id": f"TXN-{rng.randint(10000, 99999)}", "amount": amount}
+
+    async def agateway(amount, user_id, idempotency_key=None):
+        start = time.perf_counter()
+        await asyncio.sleep(latency)
+        timer.record("gateway_attempt", time.perf_counter() - start)
+        if rng.random() < failure_rate:
+            raise ConnectionError("Benchmark gateway failure")
+        return {"status": "success", "transaction_id": f"TXN-{rng.randint(10000, 99999)}", "amount": amount}
+
+    def retry_sleep(seconds):
+        timer.record("retry_wait", seconds)
+        time.sleep(seconds)
+
+    async def aretry_sleep(seconds):
+        timer.record("retry_wait", seconds)
+        await asyncio.sleep(seconds)
+
+    payment_gateway.mock_payment_gateway_api = gateway
+    payment_gateway.amock_payment_gateway_api = agateway
+    payment_gateway.safe_payment_gateway_call.retry.sleep = retry_sleep
+    payment_gateway.asafe_payment_gateway_call.retry.sleep = aretry_sleep
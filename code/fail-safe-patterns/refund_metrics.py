@@ -0,0 +1,52 @@
+"""
+Metrics for the refund pipeline: the registry every refund component
+records into, the breaker transition listener and the retry hooks.
+"""
+from pybreaker import CircuitBreakerListener
+
+import retry as retry_policy
+from metrics import MetricsRegistry
+
+
+# --- Metrics ---
+
+refund_metrics = MetricsRegistry()
+refund_metrics.describe("refund_llm_call_seconds", "histogram", "Latency of each LLM call made by the refund agent")
+refund_metrics.describe("refund_tool_call_seconds", "histogram", "Latency of each agent tool call")
+refund_metrics.describe("refund_gateway_attempt_seconds", "histogram", "Latency of each payment gateway attempt")
+refund_metrics.describe("refund_retry_wait_seconds", "histogram", "Backoff before each payment gateway retry")
+refund_metrics.describe("refund_retry_budget_tokens", "gauge", "Retries the shared retry budget allows right now")
+refund_metrics.describe("refund_retry_budget_denied_total", "counter", "Retries skipped because the retry budget was spent")
+refund_metrics.describe("refund_breaker_transitions_total", "counter", "Circuit breaker state transitions")
+refund_metrics.describe("refund_breaker_rejections_total", "counter", "Calls rejected by an open circuit breaker")
+refund_metrics.describe("refund_gateway_declines_total", "counter", "Refunds the payment processor declined")
+refund_metrics.describe("refund_fallbacks_total", "counter", "Refunds that fell back instead of being paid out")
+refund_metrics.describe("refund_outbox_deferred_total", "counter", "Refunds written to the outbox for later replay")
+refund_metrics.describe("refund_outbox_replays_total", "counter", "Outbox replay attempts by outcome")
+refund_metrics.describe("refund_idempotency_total", "counter", "Refund requests by idempotency outcome")
+
+class BreakerMetricsListener(CircuitBreakerListener):
+    """Counts state transitions; works with pybreaker and AsyncCircuitBreaker."""
+    
+    def __init__(self, breaker_name: str):
+        self.breaker_name = breaker_name
+    
+    def state_change(self, cb, old_state, new_state):
+        if getattr(old_state, "name", old_state) == getattr(new_state, "name", new_state):
+            return  # breaker.close() on an already closed breaker
+        refund_metrics.inc("refund_breaker_transitions_total", breaker=self.breaker_name,
+                           from_state=getattr(old_state, "name", old_state) or "none",
+                           to_state=getattr(new_state, "name", new_state))
+
+def record_retry_wait(retry_state) -> None:
+    """tenacity before_sleep hook."""
+    refund_metrics.observe("refund_retry_wait_seconds", retry_state.next_action.sleep)
+
+# Payment gateway retries draw on the process-wide budget, so during an outage
+# they stop at a small fraction of recent successful calls instead of
+# multiplying the load, and their backoff is jittered so callers spread out
+payment_gateway_retry_budget = retry_policy.default_retry_budget
+
+def record_retry_budget() -> None:
+    refund_metrics.set("refund_retry_budget_tokens", payment_gateway_retry_budget.remaining)
+    refund_metrics.set("refund_retry_budget_denied_total", payment_gateway_retry_budget.denied)
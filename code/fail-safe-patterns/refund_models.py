@@ -0,0 +1,62 @@
+"""Requests, decisions and results passed through the refund pipeline."""
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+
+# --- Configuration and Models ---
+
+class RefundDecision(str, Enum):
+    APPROVE = "approve"
+    REJECT = "reject"
+    REVIEW = "review"
+
+class RefundRequest(BaseModel):
+    user_id: str = Field(description="User ID requesting refund")
+    amount: float = Field(description="Refund amount")
+    reason: str = Field(description="Reason for refund")
+    order_id: Optional[str] = Field(default=None, description="Order ID if applicable")
+
+class RefundAnalysis(BaseModel):
+    decision: RefundDecision = Field(description="AI decision for refund")
+    confidence: float = Field(description="AI confidence score (0-1)")
+    reasoning: str = Field(description="AI reasoning for the decision")
+    risk_factors: list[str] = Field(default=[], description="Identified risk factors")
+
+class RefundResult(BaseModel):
+    approved: bool = Field(description="Final refund approval status")
+    decision_maker: str = Field(description="Who made the final decision")
+    transaction_id: Optional[str] = Field(default=None, description="Transaction ID if processed")
+    notes: str = Field(default="", description="Additional notes")
+    review_case_id: Optional[str] = Field(default=None, description="Human review case ID while awaiting a decision")
+    outbox_key: Optional[str] = Field(default=None, description="Refund outbox key while the payment awaits replay")
+
+
+# Scenarios used by the demo and the offline benchmark
+DEMO_SCENARIOS = [
+    RefundRequest(
+        user_id="user_001",
+        amount=25.0,
+        reason="Accidental double charge, please refund",
+        order_id="ORDER-123"
+    ),
+    RefundRequest(
+        user_id="user_002", 
+        amount=450.0,
+        reason="Item arrived damaged, requesting full refund",
+        order_id="ORDER-456"
+    ),
+    RefundRequest(
+        user_id="user_003",
+        amount=150.0,
+        reason="Product not as described in listing",
+        order_id="ORDER-789"
+    ),
+    RefundRequest(
+        user_id="user_004",
+        amount=75.0,
+        reason="This is a suspicious refund request for fraudulent purposes",
+        order_id="ORDER-999"
+    )
+]
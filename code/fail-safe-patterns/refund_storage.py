@@ -0,0 +1,567 @@
+"""
+Durable state of the refund pipeline, in SQLite files:
+
+- RefundIdempotencyIndex: results of finished requests, by user and order
+- ReviewQueue: cases waiting for a human decision
+- RefundOutbox and RefundOutboxDrainer: refunds waiting for the payment
+  gateway, and the thread that replays them
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pybreaker import CircuitBreaker, CircuitBreakerError
+
+import payment_gateway
+from refund_metrics import refund_metrics
+from refund_models import RefundRequest, RefundResult
+
+
+# --- Idempotency Index ---
+
+class RefundIdempotencyIndex:
+    """
+    Deduplicates refund requests by (user_id, order_id).
+    
+    The first request for a key owns the work; duplicates that arrive while
+    it runs attach to its future instead of starting another agent run, and
+    duplicates that arrive afterwards get the stored RefundResult back at
+    once. Results live in an LRU hot tier and, with `path`, in a compact
+    SQLite tier (16-byte key digests, results as minimal JSON) that survives
+    restarts.
+    
+    Results that are not final yet are stored too, and the agent replaces
+    them with update(): a pending human review once the reviewer decides, and
+    a refund deferred to the outbox (its result carries the outbox key) once
+    the outbox has replayed it. Only "System" and "System Error" results
+    (processing failed before anything was decided) are not stored, so a
+    client retry of those runs again.
+    """
+    
+    def __init__(self, max_entries: int = 10000, ttl: float = 7 * 24 * 3600, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.attached = 0
+        self.misses = 0
+        self._completed: "OrderedDict[bytes, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._in_flight: Dict[bytes, Future] = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS refund_results "
+                "(key BLOB PRIMARY KEY, result TEXT NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID")
+            self._db.execute("DELETE FROM refund_results WHERE expires_at < ?", (time.time(),))
+    
+    @staticmethod
+    def key(refund_request: RefundRequest) -> Optional[bytes]:
+        """Requests without an order ID cannot be told apart from new ones and are not deduplicated."""
+        if refund_request.order_id is None:
+            return None
+        return RefundIdempotencyIndex.order_key(refund_request.user_id, refund_request.order_id)
+    
+    @staticmethod
+    def order_key(user_id: str, order_id: str) -> bytes:
+        return hashlib.sha1(f"{user_id}|{order_id}".encode()).digest()[:16]
+    
+    def begin(self, key: bytes) -> Tuple[bool, Future]:
+        """
+        Returns (True, future) when the caller owns the work and must call
+        complete() or abandon(), or (False, future) for a completed or
+        in-flight duplicate whose future resolves to its RefundResult.
+        """
+        now = time.time()
+        with self._lock:
+            stored = self._lookup(key, now)
+            if stored is not None:
+                self.hits += 1
+                refund_metrics.inc("refund_idempotency_total", outcome="completed")
+                future: Future = Future()
+                future.set_result(RefundResult.model_validate(stored))
+                return False, future
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.attached += 1
+                refund_metrics.inc("refund_idempotency_total", outcome="in_flight")
+                return False, future
+            self.misses += 1
+            refund_metrics.inc("refund_idempotency_total", outcome="new")
+            future = self._in_flight[key] = Future()
+            return True, future
+    
+    def complete(self, key: bytes, result: RefundResult) -> None:
+        """Resolve the owner's future for attached duplicates and store final results."""
+        with self._lock:
+            future = self._in_flight.pop(key, None)
+            if not result.decision_maker.startswith("System"):
+                self._save(key, result)
+        if future is not None:
+            future.set_result(result)
+    
+    def update(self, key: bytes, result: RefundResult) -> None:
+        """Replace the stored result once the refund has moved on (review decided, deferred refund replayed)."""
+        with self._lock:
+            self._save(key, result)
+    
+    def abandon(self, key: bytes, error: BaseException) -> None:
+        """The owner stopped without a result (e.g. cancelled); attached duplicates see the error."""
+        with self._lock:
+            future = self._in_flight.pop(key, None)
+        if future is not None:
+            future.set_exception(error)
+    
+    def _lookup(self, key: bytes, now: float) -> Optional[Dict[str, Any]]:
+        entry = self._completed.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > now:
+                self._completed.move_to_end(key)
+                return value
+            del self._completed[key]
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT result, expires_at FROM refund_results WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+            if row is not None:
+                value = json.loads(row[0])
+                self._store(key, row[1], value)
+                return value
+        return None
+    
+    def _save(self, key: bytes, result: RefundResult) -> None:
+        expires_at = time.time() + self.ttl
+        value = result.model_dump(exclude_defaults=True)
+        self._store(key, expires_at, value)
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO refund_results (key, result, expires_at) VALUES (?, ?, ?)",
+                             (key, json.dumps(value, separators=(",", ":")), expires_at))
+    
+    def _store(self, key: bytes, expires_at: float, value: Dict[str, Any]) -> None:
+        self._completed[key] = (expires_at, value)
+        self._completed.move_to_end(key)
+        while len(self._completed) > self.max_entries:
+            self._completed.popitem(last=False)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"completed_hits": self.hits, "attached": self.attached, "new": self.misses,
+                "in_flight": len(self._in_flight), "hot_entries": len(self._completed)}
+
+
+# --- Human Review Queue ---
+
+def data_path(env: str, filename: str) -> str:
+    """Path from the `env` variable, else `filename` in the temp directory so the demos leave the CWD clean."""
+    return os.environ.get(env) or os.path.join(tempfile.gettempdir(), filename)
+
+class ReviewQueue:
+    """
+    Persistent (SQLite) queue of refund cases waiting for a human decision.
+    
+    Escalating only writes a row and returns a case ID, so the agent never
+    waits on a person. Decisions come back in one of two ways:
+    - decide() in this process hands the case to one listener on a
+      background thread (round-robin when several agents share the queue)
+    - poll_decisions() picks up decisions written by another process (e.g. a
+      ticketing UI sharing the database file)
+    Each decided case is claimed exactly once, whichever way it is picked up.
+    """
+    
+    def __init__(self, path: Optional[str] = None):
+        # Defaults to REFUND_REVIEW_QUEUE_DB, or a file in the temp directory
+        self.path = path or data_path("REFUND_REVIEW_QUEUE_DB", "refund_review_queue.db")
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS review_cases (
+                case_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                amount REAL NOT NULL,
+                reason TEXT NOT NULL,
+                ai_reasoning TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                reviewer TEXT,
+                created_at TEXT NOT NULL,
+                decided_at TEXT,
+                claimed INTEGER NOT NULL DEFAULT 0,
+                order_id TEXT
+            )""")
+        # Queue files written before cases recorded their order
+        if "order_id" not in {row["name"] for row in self._db.execute("PRAGMA table_info(review_cases)")}:
+            self._db.execute("ALTER TABLE review_cases ADD COLUMN order_id TEXT")
+        self._listeners: List[Callable[[Dict[str, Any]], None]] = []
+        self._next_listener = 0
+        self._notifier = ThreadPoolExecutor(max_workers=1, thread_name_prefix="review-notifier")
+    
+    def submit(self, user_id: str, amount: float, reason: str, ai_reasoning: str,
+               order_id: Optional[str] = None) -> str:
+        """Post a case for review and return its case ID immediately."""
+        case_id = f"CASE-{uuid.uuid4().hex[:12]}"
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO review_cases (case_id, user_id, amount, reason, ai_reasoning, created_at, order_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (case_id, user_id, amount, reason, ai_reasoning, datetime.now().isoformat(), order_id))
+        return case_id
+    
+    def pending(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM review_cases WHERE status = 'pending' ORDER BY created_at").fetchall()
+        return [dict(row) for row in rows]
+    
+    def get(self, case_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM review_cases WHERE case_id = ?", (case_id,)).fetchone()
+        return dict(row) if row else None
+    
+    def decide(self, case_id: str, approved: bool, reviewer: str = "human") -> None:
+        """Record a reviewer's decision and notify listeners."""
+        with self._lock:
+            updated = self._db.execute(
+                "UPDATE review_cases SET status = ?, reviewer = ?, decided_at = ? "
+                "WHERE case_id = ? AND status = 'pending'",
+                ("approved" if approved else "rejected", reviewer, datetime.now().isoformat(), case_id)).rowcount
+        if not updated:
+            raise ValueError(f"No pending review case {case_id}")
+        if self._listeners:
+            self._notifier.submit(self._notify, case_id)
+    
+    def add_listener(self, callback: Callable[[Dict[str, Any]], None]) -> None:
+        """
+        Call `callback(case)` for decisions made through decide(). Each case
+        goes to exactly one listener, so agents sharing the queue never carry
+        out the same decision twice.
+        """
+        with self._lock:
+            self._listeners.append(callback)
+    
+    def remove_listener(self, callback: Callable[[Dict[str, Any]], None]) -> None:
+        with self._lock:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+    
+    def poll_decisions(self) -> List[Dict[str, Any]]:
+        """Claim and return every decided case not yet picked up."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT case_id FROM review_cases WHERE status != 'pending' AND claimed = 0").fetchall()
+        return [case for case in (self._claim(row["case_id"]) for row in rows) if case]
+    
+    def _claim(self, case_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            claimed = self._db.execute(
+                "UPDATE review_cases SET claimed = 1 WHERE case_id = ? AND status != 'pending' AND claimed = 0",
+                (case_id,)).rowcount
+            if not claimed:
+                return None
+            return dict(self._db.execute("SELECT * FROM review_cases WHERE case_id = ?", (case_id,)).fetchone())
+    
+    def _notify(self, case_id: str) -> None:
+        case = self._claim(case_id)
+        if case is None:
+            return
+        with self._lock:
+            if not self._listeners:
+                # Every listener went away since decide(): leave the case for poll_decisions()
+                self._db.execute("UPDATE review_cases SET claimed = 0 WHERE case_id = ?", (case_id,))
+                return
+            listener = self._listeners[self._next_listener % len(self._listeners)]
+            self._next_listener += 1
+        try:
+            listener(case)
+        except Exception as e:
+            print(f"Review listener failed for {case_id}: {str(e)}")
+
+_refund_review_queue: Optional[ReviewQueue] = None
+
+def default_review_queue() -> ReviewQueue:
+    """Module-wide review queue, opened on first use so importing this module creates no database."""
+    global _refund_review_queue
+    if _refund_review_queue is None:
+        _refund_review_queue = ReviewQueue()
+    return _refund_review_queue
+
+
+# --- Refund Outbox ---
+
+def refund_idempotency_key(user_id: str, amount: float, order_id: Optional[str] = None) -> str:
+    """
+    Stable key for one refund. Without an order ID, two deferrals of the same
+    amount for the same user are treated as the same refund.
+    """
+    digest = hashlib.sha1(f"{user_id}|{amount:.2f}|{order_id or ''}".encode()).hexdigest()[:16]
+    return f"RFD-{digest}"
+
+class RefundQueuedError(Exception):
+    """The refund is already in the outbox waiting for replay, so it must not be sent directly."""
+
+class RefundOutbox:
+    """
+    Persistent (SQLite) outbox of refunds the payment gateway could not take,
+    and the ledger of every keyed refund sent to it.
+    
+    When the breaker is open, the gateway is at capacity or it keeps failing
+    after retries, the refund is written here under its idempotency key
+    instead of being dropped; deferring the same key twice keeps one row.
+    A RefundOutboxDrainer replays the rows later. Each row moves through
+    pending -> sending -> sent, or to failed after `max_attempts` replays.
+    A row left in sending by a crashed drainer is picked up again once its
+    lease expires, so the gateway should dedupe on the idempotency key.
+    
+    A direct gateway call claims its key first (claim_direct), which leaves
+    the row in paying until the call completes, fails or is deferred. So a
+    refund the drainer already paid, or still has to replay, is never paid
+    again by another path; a paying row whose caller crashed is replayed
+    once its lease expires.
+    """
+    
+    def __init__(self, path: Optional[str] = None, max_attempts: int = 5, lease: float = 60.0):
+        # Defaults to REFUND_OUTBOX_DB, or a file in the temp directory
+        self.path = path or data_path("REFUND_OUTBOX_DB", "refund_outbox.db")
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS refund_outbox (
+                idempotency_key TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                amount REAL NOT NULL,
+                deferred_reason TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                transaction_id TEXT,
+                next_attempt_at REAL NOT NULL,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )""")
+    
+    def defer(self, user_id: str, amount: float, reason: str, idempotency_key: Optional[str] = None) -> str:
+        """Record a refund for later replay (or hand a direct call's claim over to it) and return its key."""
+        key = idempotency_key or refund_idempotency_key(user_id, amount)
+        now = datetime.now().isoformat()
+        with self._lock:
+            inserted = self._db.execute(
+                "INSERT INTO refund_outbox (idempotency_key, user_id, amount, deferred_reason, "
+                "next_attempt_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (idempotency_key) DO UPDATE SET status = 'pending', "
+                "deferred_reason = excluded.deferred_reason, next_attempt_at = excluded.next_attempt_at, "
+                "updated_at = excluded.updated_at WHERE status = 'paying'",
+                (key, user_id, amount, reason, time.time(), now, now)).rowcount
+        if inserted:
+            refund_metrics.inc("refund_outbox_deferred_total", reason=reason)
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] Refund deferred to outbox: {key} for {user_id} (${amount:.2f})")
+        return key
+    
+    def claim_direct(self, key: str, user_id: str, amount: float) -> Optional[Dict[str, Any]]:
+        """
+        Take `key` for a direct gateway call. Returns None when the caller may
+        send the refund, or the gateway result when it was already paid;
+        raises RefundQueuedError while it waits for replay or another caller
+        is paying it. A refund that failed earlier can be taken again.
+        """
+        now = time.time()
+        stamp = datetime.now().isoformat()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute("SELECT status, transaction_id FROM refund_outbox WHERE idempotency_key = ?",
+                                       (key,)).fetchone()
+                if row is None:
+                    self._db.execute(
+                        "INSERT INTO refund_outbox (idempotency_key, user_id, amount, deferred_reason, status, "
+                        "next_attempt_at, created_at, updated_at) VALUES (?, ?, ?, 'direct', 'paying', ?, ?, ?)",
+                        (key, user_id, amount, now + self.lease, stamp, stamp))
+                elif row["status"] == "failed":
+                    self._db.execute(
+                        "UPDATE refund_outbox SET status = 'paying', attempts = 0, next_attempt_at = ?, updated_at = ? "
+                        "WHERE idempotency_key = ?", (now + self.lease, stamp, key))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        if row is None or row["status"] == "failed":
+            return None
+        if row["status"] == "sent":
+            return {"status": "success", "transaction_id": row["transaction_id"], "amount": amount}
+        state = "queued" if row["status"] == "pending" else "being sent"
+        raise RefundQueuedError(f"Refund {key} is already {state}")
+    
+    def claim(self, limit: int) -> List[Dict[str, Any]]:
+        """Lease up to `limit` due refunds, oldest first, for one replay."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(
+                    "SELECT * FROM refund_outbox WHERE status IN ('pending', 'sending', 'paying') "
+                    "AND next_attempt_at <= ? "
+                    "ORDER BY created_at LIMIT ?", (now, limit)).fetchall()
+                self._db.executemany(
+                    "UPDATE refund_outbox SET status = 'sending', next_attempt_at = ? WHERE idempotency_key = ?",
+                    [(now + self.lease, row["idempotency_key"]) for row in rows])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return [dict(row) for row in rows]
+    
+    def complete(self, key: str, transaction_id: str) -> None:
+        self._update(key, "UPDATE refund_outbox SET status = 'sent', transaction_id = ?, attempts = attempts + 1, "
+                          "updated_at = ? WHERE idempotency_key = ?",
+                     (transaction_id, datetime.now().isoformat(), key))
+    
+    def fail(self, key: str, error: Exception) -> None:
+        """A direct call the gateway refused outright (e.g. declined); a later attempt may claim it again."""
+        self._update(key, "UPDATE refund_outbox SET status = 'failed', last_error = ?, updated_at = ? "
+                          "WHERE idempotency_key = ? AND status = 'paying'",
+                     (str(error), datetime.now().isoformat(), key))
+    
+    def release(self, key: str) -> None:
+        """Hand a claimed refund back untouched (the breaker rejected it before it was sent)."""
+        self._update(key, "UPDATE refund_outbox SET status = 'pending', next_attempt_at = ? "
+                          "WHERE idempotency_key = ? AND status = 'sending'", (time.time(), key))
+    
+    def retry_later(self, key: str, error: Exception, delay: float) -> bool:
+        """Count a failed replay; returns False once the refund has run out of attempts."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE refund_outbox SET attempts = attempts + 1, last_error = ?, next_attempt_at = ?, "
+                "updated_at = ?, status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END "
+                "WHERE idempotency_key = ?",
+                (str(error), time.time() + delay, datetime.now().isoformat(), self.max_attempts, key))
+            row = self._db.execute("SELECT status FROM refund_outbox WHERE idempotency_key = ?", (key,)).fetchone()
+        return row is not None and row["status"] == "pending"
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM refund_outbox WHERE idempotency_key = ?", (key,)).fetchone()
+        return dict(row) if row else None
+    
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) AS n FROM refund_outbox GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+    
+    def _update(self, key: str, sql: str, params: Tuple) -> None:
+        with self._lock:
+            self._db.execute(sql, params)
+
+class RefundOutboxDrainer:
+    """
+    Background thread that replays the outbox through the payment gateway.
+    
+    Every `poll_interval` seconds it claims up to `batch_size` due refunds and
+    sends them no faster than `rate` per second, so a backlog built up during
+    an outage drains at the gateway's capacity instead of all at once.
+    Replays go through `breaker`: while it is open, the first rejection hands
+    the rest of the batch back and the drainer waits for the next poll.
+    pybreaker only lets a trial call through once reset_timeout has passed,
+    so that trial is the first refund of a batch. A failed replay is retried
+    after `retry_wait` * 2**attempts seconds. Every replay is sent as
+    send(amount, user_id, idempotency_key=...), so the gateway can drop a
+    refund it already paid.
+    """
+    
+    def __init__(self,
+                 outbox: RefundOutbox,
+                 send: Optional[Callable[..., Dict[str, Any]]] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 rate: float = 5.0,
+                 batch_size: int = 20,
+                 poll_interval: float = 1.0,
+                 retry_wait: float = 2.0,
+                 on_complete: Optional[Callable[[Dict[str, Any], Dict[str, Any]], None]] = None):
+        self.outbox = outbox
+        # The drainer applies the breaker and its own retry schedule, so it
+        # sends to the bare gateway rather than through safe_payment_gateway_call
+        self.send = send or payment_gateway.mock_payment_gateway_api
+        self.breaker = breaker or payment_gateway.payment_gateway_breaker
+        self.rate = rate
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retry_wait = retry_wait
+        self.on_complete = on_complete
+        self.replayed = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._next_send = time.monotonic()
+    
+    def start(self) -> "RefundOutboxDrainer":
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="refund-outbox-drainer", daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+    
+    def drain_once(self) -> int:
+        """Replay one batch; returns how many refunds went through."""
+        batch = self.outbox.claim(self.batch_size)
+        sent = 0
+        for i, item in enumerate(batch):
+            self._pace()
+            try:
+                result = self.breaker.call(self.send, item["amount"], item["user_id"],
+                                           idempotency_key=item["idempotency_key"])
+            except CircuitBreakerError:
+                # Nothing was sent; wait for the breaker instead of burning attempts
+                for rest in batch[i:]:
+                    self.outbox.release(rest["idempotency_key"])
+                refund_metrics.inc("refund_outbox_replays_total", outcome="breaker_open")
+                break
+            except Exception as e:
+                delay = self.retry_wait * 2 ** item["attempts"]
+                outcome = "retry" if self.outbox.retry_later(item["idempotency_key"], e, delay) else "failed"
+                refund_metrics.inc("refund_outbox_replays_total", outcome=outcome)
+                continue
+            self.outbox.complete(item["idempotency_key"], result["transaction_id"])
+            refund_metrics.inc("refund_outbox_replays_total", outcome="sent")
+            self.replayed += 1
+            sent += 1
+            if self.on_complete is not None:
+                self.on_complete(item, result)
+        return sent
+    
+    def _pace(self) -> None:
+        """Space sends 1/rate seconds apart."""
+        now = time.monotonic()
+        self._next_send = max(self._next_send, now)
+        self._stop.wait(self._next_send - now)
+        self._next_send += 1.0 / self.rate
+    
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.drain_once()
+            except Exception as e:
+                print(f"Refund outbox drainer error: {str(e)}")
+            self._stop.wait(self.poll_interval)
+
+_refund_outbox: Optional[RefundOutbox] = None
+
+def default_refund_outbox() -> RefundOutbox:
+    """Module-wide outbox, opened on first use so importing this module creates no database."""
+    global _refund_outbox
+    if _refund_outbox is None:
+        _refund_outbox = RefundOutbox()
+    return _refund_outbox
@@ -0,0 +1,262 @@
+"""
+The LangChain side of the refund agent: tools for the payment gateway,
+human review and risk analysis, and the callback that logs agent steps and
+times LLM and tool calls.
+
+Importing this module imports LangChain, which takes a couple of seconds;
+refund_agent.py loads it on first use through load_langchain().
+"""
+import asyncio
+import json
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+from langchain.tools import BaseTool
+from langchain.callbacks.base import BaseCallbackHandler
+# Used by RefundAgent through load_langchain(), so the agent module never imports LangChain itself
+from langchain.agents import AgentExecutor, create_openai_functions_agent
+from langchain.tools import StructuredTool
+from langchain.schema import BaseMessage, HumanMessage, AIMessage
+from langchain.memory import (ConversationBufferMemory, ConversationBufferWindowMemory,
+                              ConversationSummaryBufferMemory)
+from langchain_openai import ChatOpenAI
+from langchain_core.language_models import BaseChatModel
+from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain.schema.runnable import RunnableConfig
+from pybreaker import CircuitBreakerError
+
+from concurrency_limiter import ConcurrencyLimitExceeded
+from metrics import MetricsRegistry
+from payment_gateway import RefundDeclinedError, asafe_payment_gateway_call, safe_payment_gateway_call
+from refund_metrics import refund_metrics
+from refund_risk import default_risk_engine, refund_cache_key
+from refund_storage import (RefundOutbox, RefundQueuedError, default_refund_outbox, default_review_queue,
+                            refund_idempotency_key)
+
+
+# --- LangChain Tools ---
+
+class PaymentGatewayTool(BaseTool):
+    """LangChain tool for payment gateway integration."""
+    name: str = "payment_gateway"
+    description: str = ("Process refund through payment gateway. Use when refund is approved. "
+                        "Pass the order ID when the request has one.")
+    gateway_client: Optional[Any] = None  # BatchingPaymentGatewayClient; per-call gateway if None
+    outbox: Optional[Any] = None  # RefundOutbox for deferred refunds; the module-level outbox if None
+    
+    def _run(self, user_id: str, amount: float, order_id: Optional[str] = None) -> str:
+        """Execute the payment gateway call."""
+        # Keyed by order, so a retry or a deferral of the same order is the same refund
+        key = refund_idempotency_key(user_id, amount, order_id)
+        try:
+            return self._format_result(self.refund(user_id, amount, key))
+        except Exception as e:
+            return self._handle_failure(e, user_id, amount, key)
+
+    async def _arun(self, user_id: str, amount: float, order_id: Optional[str] = None) -> str:
+        """Execute the payment gateway call without blocking the event loop."""
+        key = refund_idempotency_key(user_id, amount, order_id)
+        try:
+            return self._format_result(await self.arefund(user_id, amount, key))
+        except Exception as e:
+            return self._handle_failure(e, user_id, amount, key)
+    
+    def refund(self, user_id: str, amount: float, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Typed entry point for code that calls the gateway directly; raises on failure.
+        With a key, the refund is claimed in the outbox first: one already paid
+        is returned without calling the gateway, and one waiting for replay
+        raises RefundQueuedError.
+        """
+        if idempotency_key is None:
+            return self._send(user_id, amount)
+        paid = self.ledger.claim_direct(idempotency_key, user_id, amount)
+        if paid is not None:
+            return paid
+        try:
+            result = self._send(user_id, amount, idempotency_key)
+        except Exception as e:
+            self._unclaim(e, user_id, amount, idempotency_key)
+            raise
+        self.ledger.complete(idempotency_key, result["transaction_id"])
+        return result
+    
+    async def arefund(self, user_id: str, amount: float,
+                      idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        # The ledger writes are single local transactions, so they run inline
+        if idempotency_key is None:
+            return await self._asend(user_id, amount)
+        paid = self.ledger.claim_direct(idempotency_key, user_id, amount)
+        if paid is not None:
+            return paid
+        try:
+            result = await self._asend(user_id, amount, idempotency_key)
+        except Exception as e:
+            self._unclaim(e, user_id, amount, idempotency_key)
+            raise
+        self.ledger.complete(idempotency_key, result["transaction_id"])
+        return result
+    
+    @property
+    def ledger(self) -> RefundOutbox:
+        return self.outbox or default_refund_outbox()
+    
+    def _send(self, user_id: str, amount: float, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        if self.gateway_client is not None:
+            return self.gateway_client.refund(amount, user_id, idempotency_key)
+        return safe_payment_gateway_call(amount, user_id, idempotency_key)
+    
+    async def _asend(self, user_id: str, amount: float,
+                     idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        if self.gateway_client is not None:
+            return await asyncio.wrap_future(self.gateway_client.submit(amount, user_id, idempotency_key))
+        return await asafe_payment_gateway_call(amount, user_id, idempotency_key)
+    
+    def _unclaim(self, error: Exception, user_id: str, amount: float, idempotency_key: str) -> None:
+        """Hand a failed direct call's claim to the drainer if the gateway may take it later, else fail it."""
+        reason = self._deferral_reason(error)
+        if reason is None:
+            self.ledger.fail(idempotency_key, error)
+        else:
+            self.ledger.defer(user_id, amount, reason, idempotency_key)
+    
+    def _format_result(self, result: Dict[str, Any]) -> str:
+        return f"Refund processed successfully. Transaction ID: {result['transaction_id']}"
+    
+    def _handle_failure(self, error: Exception, user_id: str, amount: float,
+                        idempotency_key: Optional[str] = None) -> str:
+        """Defer refunds the gateway may take later to the outbox, then describe what happened."""
+        message = self._format_error(error)
+        reason = self._deferral_reason(error)
+        if reason is None:
+            return message
+        key = self.ledger.defer(user_id, amount, reason, idempotency_key)
+        return f"{message} Outbox key: {key}"
+    
+    @staticmethod
+    def _deferral_reason(error: Exception) -> Optional[str]:
+        if isinstance(error, RefundQueuedError):
+            return "already_queued"
+        if isinstance(error, CircuitBreakerError):
+            return "circuit_open"
+        if isinstance(error, ConcurrencyLimitExceeded):
+            return "at_capacity"
+        if isinstance(error, ConnectionError):
+            return "connection_error"
+        return None
+    
+    def _format_error(self, error: Exception) -> str:
+        if isinstance(error, RefundQueuedError):
+            return f"{str(error)} in the refund outbox and will be replayed from there."
+        if isinstance(error, RefundDeclinedError):
+            refund_metrics.inc("refund_gateway_declines_total")
+            return f"Refund declined by the payment processor: {str(error)}"
+        if isinstance(error, CircuitBreakerError):
+            refund_metrics.inc("refund_breaker_rejections_total", breaker="payment_gateway")
+            refund_metrics.inc("refund_fallbacks_total", reason="circuit_open")
+            return "Payment gateway circuit breaker is OPEN. Refund queued for replay when it closes."
+        if isinstance(error, ConcurrencyLimitExceeded):
+            refund_metrics.inc("refund_fallbacks_total", reason="at_capacity")
+            return f"Payment gateway is at capacity: {str(error)}. Refund queued for retry."
+        if isinstance(error, ConnectionError):
+            refund_metrics.inc("refund_fallbacks_total", reason="connection_error")
+            return f"Payment gateway connection error: {str(error)}. Refund queued for retry."
+        refund_metrics.inc("refund_fallbacks_total", reason="unexpected_error")
+        return f"Unexpected error processing refund: {str(error)}"
+
+class HumanReviewTool(BaseTool):
+    """LangChain tool for human review integration."""
+    name: str = "human_review"
+    description: str = ("Escalate refund decision to human review when needed. "
+                        "Returns immediately with a case ID; the refund stays pending until a human decides. "
+                        "Pass the order ID when the request has one.")
+    review_queue: Optional[Any] = None  # ReviewQueue; the module-level queue if None
+    
+    def _run(self, user_id: str, amount: float, reason: str, ai_reasoning: str,
+             order_id: Optional[str] = None) -> str:
+        """Escalate to human review."""
+        case_id = self.escalate(user_id, amount, reason, ai_reasoning, order_id)
+        return f"Refund for {user_id} of ${amount:.2f} is pending human review. Case ID: {case_id}"
+    
+    def escalate(self, user_id: str, amount: float, reason: str, ai_reasoning: str,
+                 order_id: Optional[str] = None) -> str:
+        """Typed entry point: post the case and return its case ID."""
+        review_queue = self.review_queue or default_review_queue()
+        case_id = review_queue.submit(user_id, amount, reason, ai_reasoning, order_id)
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Human review requested: {case_id} for {user_id} (${amount:.2f})")
+        return case_id
+
+    async def _arun(self, user_id: str, amount: float, reason: str, ai_reasoning: str,
+                    order_id: Optional[str] = None) -> str:
+        """Posting to the queue is a single local write, so it runs inline."""
+        return self._run(user_id, amount, reason, ai_reasoning, order_id)
+
+class RefundAnalysisTool(BaseTool):
+    """LangChain tool for refund risk analysis."""
+    name: str = "analyze_refund_risk"
+    description: str = "Analyze refund request for risk factors and generate recommendation."
+    cache: Optional[Any] = None  # DecisionCache for analyses; uncached if None
+    risk_engine: Optional[Any] = None  # RiskRuleEngine; the module-wide one if None
+    
+    def _run(self, user_id: str, amount: float, reason: str) -> str:
+        """Analyze refund request for risks."""
+        risk_engine = self.risk_engine or default_risk_engine()
+        if self.cache is None:
+            return json.dumps(risk_engine.score(user_id, amount, reason))
+        key = refund_cache_key(amount, reason, f"analysis:{risk_engine.fingerprint}", risk_engine)
+        analysis = self.cache.get(key)
+        if analysis is None:
+            analysis = risk_engine.score(user_id, amount, reason)
+            self.cache.put(key, analysis)
+        return json.dumps(analysis)
+
+    async def _arun(self, user_id: str, amount: float, reason: str) -> str:
+        """Risk analysis is pure CPU work, so the async path just runs it inline."""
+        return self._run(user_id, amount, reason)
+
+
+# --- Agent Callback ---
+
+class RefundAgentCallback(BaseCallbackHandler):
+    """Custom callback handler for logging agent actions and timing LLM and tool calls."""
+    
+    def __init__(self, metrics: Optional[MetricsRegistry] = None):
+        self.metrics = metrics or refund_metrics
+        self._started: Dict[Any, Tuple[str, str, float]] = {}
+    
+    def on_agent_action(self, action, **kwargs):
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Agent Action: {action.tool}")
+        
+    def on_agent_finish(self, finish, **kwargs):
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Agent Finished")
+    
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._started[run_id] = ("refund_llm_call_seconds", "", time.perf_counter())
+    
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._started[run_id] = ("refund_llm_call_seconds", "", time.perf_counter())
+    
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._finish(run_id, "success")
+    
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, "error")
+    
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._started[run_id] = ("refund_tool_call_seconds", (serialized or {}).get("name", "unknown"),
+                                 time.perf_counter())
+    
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._finish(run_id, "success")
+    
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, "error")
+    
+    def _finish(self, run_id, outcome: str) -> None:
+        started = self._started.pop(run_id, None)
+        if started is None:
+            return
+        metric, tool, start = started
+        labels = {"tool": tool} if tool else {}
+        self.metrics.observe(metric, time.perf_counter() - start, outcome=outcome, **labels)
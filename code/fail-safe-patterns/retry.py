@@ -1,14 +1,222 @@
-from tenacity import retry, stop_after_attempt, wait_exponential
-
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
-def call_service():
-    print("Trying service...")
-    # simulate service failure
-    raise Exception("Service unavailable")
-
-try:
-    call_service()
-except Exception as e:
-    print(f"Service failed after retries: {e}")
-    # fallback logic
-    print("Using fallback service")
+"""
+Retries that help with transient faults without amplifying outages.
+
+Plain retries with a fixed or exponential wait make every caller retry in
+lockstep, and during an outage each failed call turns into several, so a
+struggling backend sees two or three times its normal load. Two fixes:
+
+- a retry budget: a process-wide token bucket where every successful call
+  earns `ratio` of a retry and every retry spends one, so retries stay a
+  bounded fraction of successful traffic; when the backend is down nothing
+  is earned and retries stop
+- decorrelated-jitter backoff: each wait is drawn between `base` and three
+  times the previous wait (capped), which spreads callers out instead of
+  synchronizing them
+
+payment_gateway.py imports this module for its payment gateway retries.
+"""
+import functools
+import inspect
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Tuple, Type
+
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+from tenacity.stop import stop_base
+from tenacity.wait import wait_base
+
+
+# --- Retry budget ---
+
+class RetryBudget:
+    """
+    Token bucket shared by every retry in the process.
+
+    Each successful call deposits `ratio` tokens and each retry withdraws one,
+    so retries are limited to about `ratio` of successful calls (10% by
+    default). `min_per_second` tokens trickle in regardless, so a service with
+    little traffic can still retry an occasional failure. The bucket starts
+    full and holds at most `max_tokens`. `clock` can be swapped for a
+    virtual one in simulations.
+    """
+
+    def __init__(self, ratio: float = 0.1, min_per_second: float = 1.0, max_tokens: float = 10.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.clock = clock
+        self.successes = 0
+        self.retries = 0
+        self.denied = 0
+        self._tokens = max_tokens
+        self._refilled_at = clock()
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        """Record a successful call."""
+        with self._lock:
+            self.successes += 1
+            self._add(self.ratio)
+
+    def try_spend(self) -> bool:
+        """Withdraw one retry; False (and nothing withdrawn) when the budget is exhausted."""
+        with self._lock:
+            self._add(0.0)
+            if self._tokens < 1.0:
+                self.denied += 1
+                return False
+            self._tokens -= 1.0
+            self.retries += 1
+            return True
+
+    @property
+    def remaining(self) -> float:
+        """Retries that could be made right now."""
+        with self._lock:
+            self._add(0.0)
+            return self._tokens
+
+    def stats(self) -> Dict[str, Any]:
+        return {"remaining": round(self.remaining, 2), "successes": self.successes,
+                "retries": self.retries, "denied": self.denied}
+
+    def track(self, func: Callable[..., Any]) -> Callable[..., Any]:
+        """Decorator: deposit for every call of `func` that returns (sync or async)."""
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                result = await func(*args, **kwargs)
+                self.deposit()
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            result = func(*args, **kwargs)
+            self.deposit()
+            return result
+        return wrapper
+
+    def _add(self, amount: float) -> None:
+        now = self.clock()
+        self._tokens = min(self.max_tokens,
+                           self._tokens + amount + (now - self._refilled_at) * self.min_per_second)
+        self._refilled_at = now
+
+default_retry_budget = RetryBudget()
+
+
+# --- tenacity building blocks ---
+
+class stop_when_budget_exhausted(stop_base):
+    """
+    Stops when no retry can be withdrawn. Combine it after the attempt limit,
+    stop_after_attempt(n) | stop_when_budget_exhausted(budget), so a token is
+    only spent when a retry is actually going to happen.
+    """
+
+    def __init__(self, budget: RetryBudget = default_retry_budget):
+        self.budget = budget
+
+    def __call__(self, retry_state) -> bool:
+        return not self.budget.try_spend()
+
+def decorrelated_jitter(base: float, cap: float, previous: float, rng: random.Random = random) -> float:
+    """Next wait: uniform between `base` and three times the previous wait, at most `cap`."""
+    return min(cap, rng.uniform(base, max(base, previous) * 3))
+
+class wait_decorrelated_jitter(wait_base):
+    """tenacity wait strategy for decorrelated jitter; the first wait is drawn from [base, 3 * base]."""
+
+    def __init__(self, base: float = 0.5, cap: float = 10.0):
+        self.base = base
+        self.cap = cap
+
+    def __call__(self, retry_state) -> float:
+        # tenacity stores each computed wait in upcoming_sleep before sleeping it
+        return decorrelated_jitter(self.base, self.cap, getattr(retry_state, "upcoming_sleep", 0.0))
+
+def budgeted_retry(attempts: int = 3,
+                   base: float = 0.5,
+                   cap: float = 10.0,
+                   retry_on: Tuple[Type[BaseException], ...] = (Exception,),
+                   budget: RetryBudget = default_retry_budget,
+                   **retry_kwargs) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """tenacity @retry with jittered backoff, limited by `budget`; works on sync and async functions."""
+    def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+        return retry(stop=stop_after_attempt(attempts) | stop_when_budget_exhausted(budget),
+                     wait=wait_decorrelated_jitter(base, cap),
+                     retry=retry_if_exception_type(retry_on),
+                     reraise=True,
+                     **retry_kwargs)(budget.track(func))
+    return decorator
+
+
+if __name__ == "__main__":
+    @budgeted_retry(attempts=3, base=0.5, cap=4)
+    def call_service():
+        print("Trying service...")
+        # simulate service failure
+        raise Exception("Service unavailable")
+
+    try:
+        call_service()
+    except Exception as e:
+        print(f"Service failed after retries: {e}")
+        # fallback logic
+        print("Using fallback service")
+    print(f"Retry budget: {default_retry_budget.stats()}")
+
+    # --- Outage ---
+    # 2000 calls, the first 1000 while the backend is healthy, the rest during
+    # an outage. Count the attempts the backend has to absorb with plain
+    # retries and with a budget. Waits are not slept, to keep the demo fast.
+    def simulate(decorate) -> Tuple[int, int]:
+        attempts = {"healthy": 0, "outage": 0}
+        state = {"down": False}
+
+        def backend():
+            attempts["outage" if state["down"] else "healthy"] += 1
+            if state["down"]:
+                raise ConnectionError("Service unavailable")
+            return "ok"
+
+        call = decorate(backend)
+        call.retry.sleep = lambda seconds: None
+        for i in range(2000):
+            state["down"] = i >= 1000
+            try:
+                call()
+            except ConnectionError:
+                pass
+        return attempts["healthy"], attempts["outage"]
+
+    plain = lambda func: retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10),
+                               retry=retry_if_exception_type(ConnectionError), reraise=True)(func)
+    budget = RetryBudget(ratio=0.1, min_per_second=1.0, max_tokens=10.0)
+    budgeted = budgeted_retry(attempts=3, retry_on=(ConnectionError,), budget=budget)
+
+    print("\n1000 calls while healthy, then 1000 during an outage:")
+    for label, decorate in [("plain retries (3 attempts)", plain), ("retry budget (10%)", budgeted)]:
+        healthy, outage = simulate(decorate)
+        print(f"  {label:<28} backend attempts during outage: {outage:>5} ({outage / 1000:.2f}x the calls)")
+    print(f"  budget after the outage: {budget.stats()}")
+
+    # --- Lockstep vs jitter ---
+    # 1000 callers fail at the same moment: when does each one retry?
+    callers = 1000
+    exponential = wait_exponential(multiplier=1, min=2, max=10)
+
+    class _State:
+        attempt_number = 1
+        upcoming_sleep = 0.0
+
+    fixed_waits = [exponential(_State()) for _ in range(callers)]
+    jitter_waits = [wait_decorrelated_jitter(base=0.5, cap=10)(_State()) for _ in range(callers)]
+    print(f"\nFirst retry of {callers} callers that failed together:")
+    for label, waits in [("wait_exponential", fixed_waits), ("decorrelated jitter", jitter_waits)]:
+        busiest = max(sum(1 for w in waits if second <= w < second + 0.1) for second in
+                      [i / 10 for i in range(0, 100)])
+        print(f"  {label:<22} busiest 100 ms window: {busiest:>4} retries")
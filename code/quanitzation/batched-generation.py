@@ -0,0 +1,429 @@
+"""
+Small generation engine for the quantized model: dynamic batching, prompt
+prefix KV-cache reuse, and several decoding configs served from one prefill.
+
+llm-quantization.py calls generate() three times for the same prompt (greedy,
+then sampled twice), and every call tokenizes the prompt and runs the full
+prefill again. Here:
+
+- concurrent submit() calls are grouped into batches (up to max_batch_size
+  prompts, or whatever arrived within max_wait)
+- each prompt is prefilled once; the KV state of its block-aligned prefixes
+  is cached (LRU, bounded by a token budget), so a long shared system prompt
+  is computed once and later prompts only prefill their own suffix
+- every decoding config of a prompt becomes its own row in the decode batch,
+  all starting from that single prefill
+
+Compared against sequential generate() calls for throughput and
+time-to-first-token:
+
+    python batched-generation.py                     # distilgpt2, dynamic int8
+    python batched-generation.py --backend fp32 --prompts 8
+    python batched-generation.py --random            # offline: random small GPT-2
+"""
+import argparse
+import os
+import queue
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+from transformers import AutoTokenizer, DynamicCache, GPT2Config, GPT2LMHeadModel
+from transformers.generation.streamers import BaseStreamer
+
+from quantization_backends import BACKENDS
+
+# Legacy KV format: one (key, value) pair per layer, each [batch, heads, seq, head_dim]
+KV = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+@dataclass
+class DecodingConfig:
+    max_new_tokens: int = 20
+    temperature: float = 0.0  # 0 means greedy
+    top_k: int = 0
+    top_p: float = 1.0
+    seed: Optional[int] = None
+
+GREEDY = DecodingConfig()
+SAMPLED = DecodingConfig(temperature=0.7, top_k=50, top_p=0.95)
+
+
+def _to_legacy(past) -> KV:
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    if hasattr(past, "layers"):  # transformers 5 dropped the legacy conversion
+        return tuple((layer.keys, layer.values) for layer in past.layers)
+    return past
+
+def _from_legacy(kv: Optional[KV]):
+    if kv is None:
+        return None
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(kv)
+    return DynamicCache(kv)
+
+
+# --- Prefix KV cache ---
+
+class PrefixCache:
+    """
+    LRU cache of prompt-prefix KV state, keyed by block-aligned token prefixes.
+
+    Each entry is its own copy of the prefix KV rather than a view into the
+    prompt that produced it, so an entry that outlives its longer siblings
+    does not keep the whole prompt's KV alive, and the token budget is what
+    is actually held. Prefixes of one prompt therefore cost the sum of their
+    lengths; a larger block_size stores fewer of them.
+    """
+
+    def __init__(self, block_size: int = 32, max_tokens: int = 16384):
+        self.block_size = block_size
+        self.max_tokens = max_tokens
+        self._entries: "OrderedDict[Tuple[int, ...], KV]" = OrderedDict()
+        self._tokens = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+
+    def lookup(self, ids: Sequence[int]) -> Tuple[int, Optional[KV]]:
+        """Longest cached prefix shorter than the prompt (its last token must still be run for logits)."""
+        length = (len(ids) - 1) // self.block_size * self.block_size
+        while length > 0:
+            key = tuple(ids[:length])
+            kv = self._entries.get(key)
+            if kv is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.hit_tokens += length
+                return length, kv
+            length -= self.block_size
+        self.misses += 1
+        return 0, None
+
+    def store(self, ids: Sequence[int], kv: KV) -> None:
+        for length in range(self.block_size, len(ids) + 1, self.block_size):
+            key = tuple(ids[:length])
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                continue
+            self._entries[key] = tuple((k[:, :, :length].clone(), v[:, :, :length].clone()) for k, v in kv)
+            self._tokens += length
+        while self._tokens > self.max_tokens and self._entries:
+            key, _ = self._entries.popitem(last=False)
+            self._tokens -= len(key)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# --- Engine ---
+
+@dataclass
+class GenerationResult:
+    completions: List[str]  # one per decoding config, in order
+    prompt_tokens: int
+    cached_prefix: int  # prompt tokens whose KV came from the prefix cache
+    first_token_s: float  # submit() to first token
+
+@dataclass
+class _Request:
+    prompt_ids: List[int]
+    configs: List[DecodingConfig]
+    future: Future
+    submitted: float = field(default_factory=time.perf_counter)
+    first_token_s: Optional[float] = None
+    cached_prefix: int = 0
+
+class GenerationEngine:
+    """
+    Background thread that batches submitted prompts and decodes them together.
+
+    submit() returns a Future that resolves to a GenerationResult. Each batch
+    runs one prefill for all of its prompts (each prompt only its uncached
+    suffix) and then decodes every (prompt, config) row together.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int = 8, max_wait: float = 0.01,
+                 prefix_cache: Optional[PrefixCache] = None):
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.prefix_cache = prefix_cache or PrefixCache()
+        self.batches = 0
+        self._queue: "queue.Queue[Optional[_Request]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name="generation-engine", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt: str, configs: Sequence[DecodingConfig] = (GREEDY,)) -> Future:
+        request = _Request(prompt_ids=self.tokenizer.encode(prompt), configs=list(configs), future=Future())
+        self._queue.put(request)
+        return request.future
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _loop(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._queue.put(None)  # finish this batch, then stop
+                    break
+                batch.append(request)
+            try:
+                with torch.no_grad():
+                    self._run_batch(batch)
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def _prefill(self, batch: List[_Request]) -> Tuple[KV, torch.Tensor, torch.Tensor]:
+        """
+        One forward pass over the uncached suffixes of every prompt in the batch.
+
+        Row i is laid out as [pad | cached prefix i | pad | suffix i]: cached
+        prefixes are left-padded to the longest one and suffixes to the longest
+        suffix, and the attention mask hides both pads. Returns the batch KV,
+        that mask, and the last-token logits of every row.
+        """
+        lookups = [self.prefix_cache.lookup(request.prompt_ids) for request in batch]
+        cached = [length for length, _ in lookups]
+        suffixes = [len(request.prompt_ids) - c for request, c in zip(batch, cached)]
+        P, S = max(cached), max(suffixes)
+
+        input_ids = torch.zeros(len(batch), S, dtype=torch.long)
+        position_ids = torch.zeros(len(batch), S, dtype=torch.long)
+        attention_mask = torch.zeros(len(batch), P + S, dtype=torch.long)
+        for i, (request, c, s) in enumerate(zip(batch, cached, suffixes)):
+            request.cached_prefix = c
+            input_ids[i, S - s:] = torch.tensor(request.prompt_ids[c:])
+            position_ids[i, S - s:] = torch.arange(c, c + s)
+            attention_mask[i, P - c:P] = 1
+            attention_mask[i, P + S - s:] = 1
+
+        past = None
+        if P:
+            template = next(kv for _, kv in lookups if kv is not None)
+            past = tuple(
+                tuple(torch.cat([F.pad(kv[layer][part], (0, 0, P - c, 0)) if kv is not None
+                                 else template[layer][part].new_zeros(*template[layer][part].shape[:2], P,
+                                                                      template[layer][part].shape[-1])
+                                 for c, (_, kv) in zip(cached, lookups)])
+                      for part in (0, 1))
+                for layer in range(len(template)))
+
+        out = self.model(input_ids=input_ids, past_key_values=_from_legacy(past), attention_mask=attention_mask,
+                         position_ids=position_ids, use_cache=True)
+        kv = _to_legacy(out.past_key_values)
+
+        # Cache each prompt's own KV, without the pad columns
+        for i, (request, c, s) in enumerate(zip(batch, cached, suffixes)):
+            self.prefix_cache.store(request.prompt_ids, tuple(
+                tuple(torch.cat([t[i:i + 1, :, P - c:P], t[i:i + 1, :, P + S - s:]], dim=2) for t in (k, v))
+                for k, v in kv))
+        return kv, attention_mask, out.logits[:, -1]
+
+    def _run_batch(self, batch: List[_Request]) -> None:
+        self.batches += 1
+        kv, attention_mask, prefill_logits = self._prefill(batch)
+
+        # One decode row per (request, config), all continuing from the batch prefill
+        rows = [(i, config) for i, request in enumerate(batch) for config in request.configs]
+        index = torch.tensor([i for i, _ in rows])
+        lengths = torch.tensor([len(batch[i].prompt_ids) for i, _ in rows])
+        kv = tuple((k.index_select(0, index), v.index_select(0, index)) for k, v in kv)
+        attention_mask = attention_mask.index_select(0, index)
+
+        generators = [torch.Generator().manual_seed(config.seed) if config.seed is not None else None
+                      for _, config in rows]
+        next_ids = self._select(prefill_logits.index_select(0, index), [config for _, config in rows], generators)
+        now = time.perf_counter()
+        for request in batch:
+            request.first_token_s = now - request.submitted
+
+        outputs: List[List[int]] = [[int(token)] for token in next_ids]
+        max_new = max(config.max_new_tokens for _, config in rows)
+        eos = self.tokenizer.eos_token_id
+        past = _from_legacy(kv)
+        for step in range(1, max_new):
+            attention_mask = torch.cat([attention_mask, torch.ones(len(rows), 1, dtype=torch.long)], dim=1)
+            out = self.model(input_ids=next_ids.unsqueeze(1), past_key_values=past,
+                             attention_mask=attention_mask,
+                             position_ids=(lengths + step - 1).unsqueeze(1), use_cache=True)
+            past = out.past_key_values
+            next_ids = self._select(out.logits[:, -1], [config for _, config in rows], generators)
+            for r, token in enumerate(next_ids.tolist()):
+                config, generated = rows[r][1], outputs[r]
+                if len(generated) < config.max_new_tokens and (eos is None or generated[-1] != eos):
+                    generated.append(token)
+            if all(len(generated) >= config.max_new_tokens or generated[-1] == eos
+                   for generated, (_, config) in zip(outputs, rows)):
+                break
+
+        completions = [[] for _ in batch]
+        for (i, _), generated in zip(rows, outputs):
+            completions[i].append(self.tokenizer.decode(generated))
+        for request, texts in zip(batch, completions):
+            request.future.set_result(GenerationResult(completions=texts, prompt_tokens=len(request.prompt_ids),
+                                                       cached_prefix=request.cached_prefix,
+                                                       first_token_s=request.first_token_s))
+
+    @staticmethod
+    def _select(logits: torch.Tensor, configs: List[DecodingConfig], generators) -> torch.Tensor:
+        """Greedy rows take the argmax; sampled rows apply temperature, top-k and top-p."""
+        chosen = logits.argmax(dim=-1)
+        for r, config in enumerate(configs):
+            if config.temperature <= 0:
+                continue
+            row = logits[r].float() / config.temperature
+            if config.top_k:
+                kth = torch.topk(row, min(config.top_k, row.numel())).values[-1]
+                row = row.masked_fill(row < kth, float("-inf"))
+            if config.top_p < 1.0:
+                sorted_logits, order = torch.sort(row, descending=True)
+                cumulative = sorted_logits.softmax(-1).cumsum(-1)
+                drop = cumulative - sorted_logits.softmax(-1) > config.top_p  # keep the token that crosses top_p
+                row[order[drop]] = float("-inf")
+            chosen[r] = torch.multinomial(row.softmax(-1), 1, generator=generators[r])[0]
+        return chosen
+
+
+# --- Baseline ---
+
+class _FirstTokenStreamer(BaseStreamer):
+    """generate() puts the prompt first, then each new token; record when the first token arrives."""
+
+    def __init__(self):
+        self.calls = 0
+        self.first_token_at: Optional[float] = None
+
+    def put(self, value):
+        self.calls += 1
+        if self.calls == 2 and self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+    def end(self):
+        pass
+
+def sequential_generate(model, tokenizer, prompts: List[str], configs: List[DecodingConfig]):
+    """One generate() per prompt and config, as llm-quantization.py does."""
+    start = time.perf_counter()
+    ttfts = []
+    for prompt in prompts:
+        prompt_start = time.perf_counter()
+        for config in configs:
+            streamer = _FirstTokenStreamer()
+            if config.seed is not None:
+                torch.manual_seed(config.seed)
+            model.generate(torch.tensor([tokenizer.encode(prompt)]), max_new_tokens=config.max_new_tokens,
+                           do_sample=config.temperature > 0, temperature=config.temperature or None,
+                           top_k=config.top_k or None, top_p=config.top_p if config.temperature > 0 else None,
+                           pad_token_id=tokenizer.eos_token_id, streamer=streamer)
+            if config is configs[0]:
+                # From this prompt's own start, not the run's: earlier prompts are not its latency
+                ttfts.append(streamer.first_token_at - prompt_start)
+    return time.perf_counter() - start, ttfts
+
+
+# --- Demo ---
+
+class ByteTokenizer:
+    """Offline stand-in tokenizer for --random: one token per UTF-8 byte."""
+    eos_token_id = None
+
+    def encode(self, text: str) -> List[int]:
+        return list(text.encode())
+
+    def decode(self, ids: List[int]) -> str:
+        return bytes(ids).decode(errors="replace")
+
+SYSTEM_PROMPT = (
+    "You are a helpful assistant for an engineering team. Answer questions about model quantization, "
+    "inference performance and deployment clearly and briefly. Prefer concrete numbers, mention trade-offs "
+    "between memory, latency and accuracy, and say so when a measurement is needed to decide.\n\n"
+)
+QUESTIONS = [
+    "Question: What does int8 quantization change about a model?\nAnswer:",
+    "Question: Why is the first token slower than the following ones?\nAnswer:",
+    "Question: When does batching improve throughput?\nAnswer:",
+    "Question: What is a KV cache?\nAnswer:",
+    "Question: How do per-channel scales help with outliers?\nAnswer:",
+    "Question: Why can a smaller model load faster?\nAnswer:",
+    "Question: What does perplexity measure?\nAnswer:",
+    "Question: When is int4 a good idea?\nAnswer:",
+]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="distilgpt2")
+    parser.add_argument("--random", action="store_true", help="offline: random small GPT-2 with byte-level tokens")
+    parser.add_argument("--backend", default="dynamic-int8", choices=[b for b in BACKENDS if b != "mmap-int8"])
+    parser.add_argument("--prompts", type=int, default=len(QUESTIONS))
+    parser.add_argument("--new-tokens", type=int, default=20)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.random:
+            torch.manual_seed(0)
+            source = os.path.join(tmp, "checkpoint")
+            GPT2LMHeadModel(GPT2Config(n_layer=4, n_embd=256, n_head=4, n_positions=1024, vocab_size=256,
+                                       bos_token_id=None, eos_token_id=None)).save_pretrained(source)
+            tokenizer = ByteTokenizer()
+        else:
+            source = args.model
+            tokenizer = AutoTokenizer.from_pretrained(source)
+        model = BACKENDS[args.backend](source)
+
+    # Greedy plus two sampled variants of every prompt, as in llm-quantization.py
+    configs = [DecodingConfig(max_new_tokens=args.new_tokens),
+               DecodingConfig(max_new_tokens=args.new_tokens, temperature=0.7, top_k=50, top_p=0.95, seed=1),
+               DecodingConfig(max_new_tokens=args.new_tokens, temperature=0.7, top_k=50, top_p=0.95, seed=2)]
+    prompts = [SYSTEM_PROMPT + QUESTIONS[i % len(QUESTIONS)] for i in range(args.prompts)]
+    generations = len(prompts) * len(configs) * args.new_tokens
+
+    print(f"{len(prompts)} prompts sharing a {len(tokenizer.encode(SYSTEM_PROMPT))}-token system prompt, "
+          f"{len(configs)} decoding configs each, backend {args.backend}")
+
+    elapsed, ttfts = sequential_generate(model, tokenizer, prompts, configs)
+    print(f"\nSequential generate(): {elapsed:.2f}s, {generations / elapsed:.1f} tokens/s, "
+          f"mean TTFT {1000 * sum(ttfts) / len(ttfts):.0f} ms")
+
+    engine = GenerationEngine(model, tokenizer, max_batch_size=args.max_batch_size)
+    engine.submit(SYSTEM_PROMPT + "Question: warm-up\nAnswer:", configs[:1]).result()  # also caches the system prompt
+    start = time.perf_counter()
+    futures = [engine.submit(prompt, configs) for prompt in prompts]
+    results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+    engine.close()
+
+    print(f"Batched engine:        {elapsed:.2f}s, {generations / elapsed:.1f} tokens/s, "
+          f"mean TTFT {1000 * sum(r.first_token_s for r in results) / len(results):.0f} ms "
+          f"({engine.batches - 1} batches, prefix cache reused "
+          f"{sum(r.cached_prefix for r in results)} of {sum(r.prompt_tokens for r in results)} prompt tokens)")
+
+    print(f"\n--- {QUESTIONS[0].splitlines()[0]} ---")
+    for label, text in zip(["greedy", "sampled (seed 1)", "sampled (seed 2)"], results[0].completions):
+        print(f"[{label}] {text.strip()}")
+
+
+if __name__ == "__main__":
+    main()
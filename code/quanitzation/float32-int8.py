@@ -1,27 +1,89 @@
-import numpy as np
+import os
+import tempfile
+import tracemalloc
 from decimal import Decimal
-# Original high-precision decimal input
-original = Decimal('3.1415')
-
-# Convert to float32 (NumPy) and then to Python float
-float32_val_np = np.float32(original)
-float32_val = float(float32_val_np)  # convert to Python float
-stored_as_decimal = Decimal(repr(float32_val))  # get full precision
-
-# Int8 conversion
-int8_val_np = np.int8(round(original))
-int8_val = int(int8_val_np)
-stored_as_int8_decimal = Decimal(int8_val)
-
-# Print results
-print("Original Decimal         :", original)
-print()
-print("Float32 stored value     :", stored_as_decimal)
-print("Float32 raw float        :", repr(float32_val))
-print("Loss due to float32      :", original - stored_as_decimal)
-print("Memory used (float32)    :", float32_val_np.nbytes, "bytes")
-print()
-print("Int8 stored value        :", int8_val)
-print("Int8 as Decimal          :", stored_as_int8_decimal)
-print("Loss due to int8         :", original - stored_as_int8_decimal)
-print("Memory used (int8)       :", int8_val_np.nbytes, "bytes")
+
+import numpy as np
+
+from quantization_toolkit import compression_report, print_report_row, quantize, quantized_payload_shape
+
+
+if __name__ == "__main__":
+    # Original high-precision decimal input
+    original = Decimal('3.1415')
+
+    # Convert to float32 (NumPy) and then to Python float
+    float32_val_np = np.float32(original)
+    float32_val = float(float32_val_np)  # convert to Python float
+    stored_as_decimal = Decimal(repr(float32_val))  # get full precision
+
+    # Int8 conversion
+    int8_val_np = np.int8(round(original))
+    int8_val = int(int8_val_np)
+    stored_as_int8_decimal = Decimal(int8_val)
+
+    # Print results
+    print("Original Decimal         :", original)
+    print()
+    print("Float32 stored value     :", stored_as_decimal)
+    print("Float32 raw float        :", repr(float32_val))
+    print("Loss due to float32      :", original - stored_as_decimal)
+    print("Memory used (float32)    :", float32_val_np.nbytes, "bytes")
+    print()
+    print("Int8 stored value        :", int8_val)
+    print("Int8 as Decimal          :", stored_as_int8_decimal)
+    print("Loss due to int8         :", original - stored_as_int8_decimal)
+    print("Memory used (int8)       :", int8_val_np.nbytes, "bytes")
+
+    # --- Whole weight matrices ---
+    # A weight matrix like a transformer's MLP projection: mostly small values,
+    # a few output channels with much larger magnitudes (outliers). A single
+    # scale for the whole tensor wastes most int8 levels on those outliers.
+    rng = np.random.default_rng(0)
+    weights = rng.normal(0, 0.02, size=(3072, 768)).astype(np.float32)
+    weights[rng.choice(3072, 8, replace=False)] *= 20
+    activations = np.maximum(rng.normal(0.5, 1.0, size=(512, 768)), 0).astype(np.float32)
+
+    print(f"\nWeight matrix {weights.shape} float32: {weights.nbytes / 1e6:.2f} MB")
+    print(f"{'scheme':<34}{'size':>12}{'saved':>9}{'max err':>12}{'mean err':>12}{'SNR':>12}")
+    configs = [
+        ("int8 symmetric per-tensor", dict(bits=8)),
+        ("int8 symmetric per-channel", dict(bits=8, axis=0)),
+        ("int8 asymmetric per-channel", dict(bits=8, symmetric=False, axis=0)),
+        ("int4 symmetric per-channel", dict(bits=4, axis=0)),
+        ("int4 symmetric group(128)", dict(bits=4, group_size=128)),
+        ("int4 asymmetric group(64)", dict(bits=4, symmetric=False, group_size=64)),
+    ]
+    for label, config in configs:
+        print_report_row(label, compression_report(weights, quantize(weights, **config)))
+
+    print(f"\nReLU activations {activations.shape} (all >= 0):")
+    for label, config in [("int8 symmetric per-tensor", dict(bits=8)),
+                          ("int8 asymmetric per-tensor", dict(bits=8, symmetric=False))]:
+        print_report_row(label, compression_report(activations, quantize(activations, **config)))
+
+    # --- Larger than RAM ---
+    # Memory-mapped input and outputs are processed 256 rows at a time, so the
+    # Python heap stays at a few chunk-sized buffers however big the file is.
+    rows, cols, chunk = 16384, 4096, 256
+    with tempfile.TemporaryDirectory() as tmp:
+        src = np.lib.format.open_memmap(os.path.join(tmp, "weights.npy"), mode="w+",
+                                        dtype=np.float32, shape=(rows, cols))
+        for start in range(0, rows, chunk):
+            src[start:start + chunk] = rng.normal(0, 0.02, size=(min(chunk, rows - start), cols))
+        src.flush()
+
+        payload = np.lib.format.open_memmap(os.path.join(tmp, "weights.int4.npy"), mode="w+", dtype=np.uint8,
+                                            shape=quantized_payload_shape(src.shape, 4))
+        restored = np.lib.format.open_memmap(os.path.join(tmp, "restored.npy"), mode="w+",
+                                             dtype=np.float32, shape=src.shape)
+        tracemalloc.start()
+        qt = quantize(src, bits=4, group_size=128, chunk_rows=chunk, out=payload)
+        report = compression_report(src, qt, chunk_rows=chunk, x_hat=restored)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(f"\nMemory-mapped {src.shape} float32 ({src.nbytes / 1e6:.0f} MB on disk), chunks of {chunk} rows:")
+        print_report_row("int4 symmetric group(128)", report)
+        print(f"Peak heap while streaming: {peak / 1e6:.1f} MB")
+        del src, payload, restored, qt
@@ -0,0 +1,239 @@
+"""
+Int8 matrix multiplication in NumPy: int8 x int8 products accumulated in
+int32, with the rescale to float32 fused into the tile epilogue.
+
+float32-int8.py shows the storage side of int8 (1 byte instead of 4). Here the
+arithmetic happens in quantized form, as in an int8 inference kernel:
+
+    y = x @ W.T + b
+      ~ s_x * s_w * (sum_k (q_x - z_x) * q_w) + b
+      = s_x * s_w * (q_x @ q_w.T - z_x * colsum(q_w)) + b
+
+- weights are quantized once, symmetric per output channel (s_w, z_w = 0)
+- activations are quantized at call time, one scale (and zero point) per row
+  (token), so no calibration data is needed ("dynamic" quantization)
+- the GEMM walks the output in block_m x block_n tiles and the reduction in
+  block_k slices, so only one tile of int8 operands is widened at a time
+  and the working set stays cache-sized
+- the epilogue subtracts the zero-point correction, multiplies by the row and
+  column scales and adds the bias while the tile is still hot
+
+NumPy has no int8 GEMM that uses BLAS: np.matmul on int32 arrays is a plain C
+loop and far slower than sgemm. Each block_k slice is therefore multiplied as
+float32 through BLAS, which is exact as long as every partial sum stays below
+2**24 (at most 1024 products of -128 * -128), and the exact integer result is
+added to the int32 accumulator. The result is bit-identical to an int32 GEMM.
+
+    python int8-matmul.py
+"""
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+import quantization_toolkit as qt
+
+# Largest reduction slice whose float32 partial sums are still exact integers.
+# Both operands may hold -128 (asymmetric activations, or weights not quantized
+# here), so the largest product is 128 * 128 and 1024 of them reach 2**24.
+MAX_EXACT_K = 2 ** 24 // (128 * 128)
+
+
+# --- GEMM ---
+
+def int8_gemm(a_q: np.ndarray,
+              w_q: np.ndarray,
+              a_scale: Optional[np.ndarray] = None,
+              a_zero: Optional[np.ndarray] = None,
+              w_scale: Optional[np.ndarray] = None,
+              w_colsum: Optional[np.ndarray] = None,
+              bias: Optional[np.ndarray] = None,
+              block_m: int = 256,
+              block_n: int = 512,
+              block_k: int = 1024,
+              out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    a_q (M, K) int8 times w_q (N, K) int8, transposed: the int32 accumulator
+    a_q @ w_q.T, or with a_scale (M,) and w_scale (N,) given, the rescaled
+    float32 result. a_zero (M,) needs w_colsum (N,), the int32 row sums of w_q.
+    """
+    if block_k > MAX_EXACT_K:
+        raise ValueError(f"block_k must be at most {MAX_EXACT_K} for exact accumulation")
+    (m, k), n = a_q.shape, w_q.shape[0]
+    if w_q.shape[1] != k:
+        raise ValueError(f"inner dimensions differ: {a_q.shape} and {w_q.shape}")
+    rescale = a_scale is not None
+    if out is None:
+        out = np.empty((m, n), dtype=np.float32 if rescale else np.int32)
+
+    # Scratch buffers reused for every tile
+    bm, bn, bk = min(block_m, m), min(block_n, n), min(block_k, k)
+    acc = np.empty((bm, bn), dtype=np.int32)
+    partial = np.empty((bm, bn), dtype=np.float32)
+    a_tile = np.empty((bm, bk), dtype=np.float32)
+    w_tile = np.empty((bn, bk), dtype=np.float32)
+
+    for m0 in range(0, m, bm):
+        m1 = min(m0 + bm, m)
+        for n0 in range(0, n, bn):
+            n1 = min(n0 + bn, n)
+            c = acc[:m1 - m0, :n1 - n0]
+            p = partial[:m1 - m0, :n1 - n0]
+            c.fill(0)
+            for k0 in range(0, k, bk):
+                k1 = min(k0 + bk, k)
+                a = a_tile[:m1 - m0, :k1 - k0]
+                w = w_tile[:n1 - n0, :k1 - k0]
+                np.copyto(a, a_q[m0:m1, k0:k1], casting="unsafe")
+                np.copyto(w, w_q[n0:n1, k0:k1], casting="unsafe")
+                np.matmul(a, w.T, out=p)
+                np.add(c, p, out=c, casting="unsafe")  # p holds exact integers
+
+            if not rescale:
+                out[m0:m1, n0:n1] = c
+                continue
+            # Fused epilogue: zero-point correction, row and column scales, bias
+            if a_zero is not None:
+                c -= np.multiply.outer(a_zero[m0:m1], w_colsum[n0:n1])
+            o = out[m0:m1, n0:n1]
+            np.multiply(c, a_scale[m0:m1, None], out=o, dtype=np.float32)
+            np.multiply(o, w_scale[None, n0:n1], out=o)
+            if bias is not None:
+                np.add(o, bias[None, n0:n1], out=o)
+    return out
+
+def int32_reference(a_q: np.ndarray, w_q: np.ndarray) -> np.ndarray:
+    """Plain integer GEMM (no BLAS) to check int8_gemm against."""
+    return a_q.astype(np.int32) @ w_q.astype(np.int32).T
+
+
+# --- Layer ---
+
+class QuantizedLinear:
+    """
+    y = x @ weight.T + bias with int8 weights (per output channel) and int8
+    activations quantized per row on every call.
+
+    Asymmetric activations use all 256 levels for lopsided inputs such as
+    post-GELU values; symmetric ones skip the zero-point correction.
+    """
+
+    def __init__(self, weight: np.ndarray, bias: Optional[np.ndarray] = None,
+                 symmetric_activations: bool = False, **blocks: int):
+        self.weight = qt.quantize(np.ascontiguousarray(weight, dtype=np.float32), bits=8, axis=0)
+        self.w_scale = self.weight.scale.reshape(-1)
+        self.w_colsum = self.weight.data.sum(axis=1, dtype=np.int32)
+        self.bias = None if bias is None else np.asarray(bias, dtype=np.float32)
+        self.symmetric_activations = symmetric_activations
+        self.blocks = blocks
+        self.out_features, self.in_features = weight.shape
+
+    def quantize_input(self, x: np.ndarray) -> qt.QuantizedTensor:
+        return qt.quantize(x, bits=8, symmetric=self.symmetric_activations, axis=0)
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        lead = x.shape[:-1]
+        x2 = np.ascontiguousarray(x, dtype=np.float32).reshape(-1, self.in_features)
+        xq = self.quantize_input(x2)
+        y = int8_gemm(xq.data, self.weight.data,
+                      a_scale=xq.scale.reshape(-1),
+                      a_zero=None if self.symmetric_activations else xq.zero_point.reshape(-1),
+                      w_scale=self.w_scale, w_colsum=self.w_colsum, bias=self.bias, **self.blocks)
+        return y.reshape(lead + (self.out_features,))
+
+    @property
+    def nbytes(self) -> int:
+        return self.weight.nbytes + (0 if self.bias is None else self.bias.nbytes)
+
+
+# --- Benchmark ---
+
+def best_of(fn: Callable[[], np.ndarray], repeats: int = 5) -> Tuple[float, np.ndarray]:
+    """Fastest of several runs, in milliseconds, and the last result."""
+    best, result = float("inf"), None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return 1000 * best, result
+
+def compare(m: int, k: int, n: int, rng: np.random.Generator, repeats: int = 5) -> Dict[str, float]:
+    """float32 np.matmul against the int8 layer on a transformer-like weight and activation."""
+    weight = rng.normal(0, 0.02, size=(n, k)).astype(np.float32)
+    bias = rng.normal(0, 0.01, size=n).astype(np.float32)
+    x = rng.normal(0, 1.0, size=(m, k)).astype(np.float32)
+    layer = QuantizedLinear(weight, bias)
+    weight_t = np.ascontiguousarray(weight.T)
+
+    fp32_ms, reference = best_of(lambda: np.matmul(x, weight_t) + bias, repeats)
+    int8_ms, y = best_of(lambda: layer(x), repeats)
+    xq = layer.quantize_input(x)
+    gemm_ms, _ = best_of(lambda: int8_gemm(xq.data, layer.weight.data, a_scale=xq.scale.reshape(-1),
+                                           a_zero=xq.zero_point.reshape(-1), w_scale=layer.w_scale,
+                                           w_colsum=layer.w_colsum, bias=bias), repeats)
+    return {
+        "fp32_ms": fp32_ms,
+        "int8_ms": int8_ms,
+        "gemm_ms": gemm_ms,
+        "fp32_weight_mb": (weight.nbytes + bias.nbytes) / 1e6,
+        "int8_weight_mb": layer.nbytes / 1e6,
+        **qt.error_metrics(reference, y),
+    }
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+
+    # --- Exactness ---
+    # The blocked float32 path must match a plain int32 GEMM bit for bit,
+    # including a reduction long enough to need several block_k slices.
+    a_q = rng.integers(-128, 128, size=(67, 2500), dtype=np.int8)
+    w_q = rng.integers(-128, 128, size=(45, 2500), dtype=np.int8)
+    a_q[0], w_q[0] = -128, -128  # one output sums 2500 products of 128 * 128
+    exact = np.array_equal(int8_gemm(a_q, w_q, block_m=16, block_n=32, block_k=MAX_EXACT_K),
+                           int32_reference(a_q, w_q))
+    print(f"int8 GEMM vs int32 reference on (67 x 2500) @ (2500 x 45), worst-case values: "
+          f"{'bit-identical' if exact else 'MISMATCH'}")
+
+    # --- Accuracy and speed across shapes ---
+    # (tokens, in, out): single-token decode, small batches and a prefill,
+    # with GPT-2 small projection sizes (768 <-> 3072) and a 4096 square layer
+    shapes = [(1, 768, 768), (1, 768, 3072), (8, 768, 3072), (32, 3072, 768),
+              (128, 768, 3072), (512, 768, 768), (256, 4096, 4096)]
+    print(f"\n{'M x K x N':<20}{'fp32':>10}{'int8':>10}{'gemm':>10}{'ratio':>8}"
+          f"{'weights':>16}{'max err':>11}{'SNR':>10}")
+    for m, k, n in shapes:
+        r = compare(m, k, n, rng)
+        print(f"{f'{m} x {k} x {n}':<20}{r['fp32_ms']:>8.2f}ms{r['int8_ms']:>8.2f}ms{r['gemm_ms']:>8.2f}ms"
+              f"{r['int8_ms'] / r['fp32_ms']:>7.1f}x{r['fp32_weight_mb']:>7.1f} -> {r['int8_weight_mb']:>4.1f}MB"
+              f"{r['max_abs_error']:>11.5f}{r['snr_db']:>8.1f}dB")
+    print("int8 = activation quantization + GEMM + fused rescale; gemm = GEMM + rescale alone")
+
+    # --- Tile sizes ---
+    # Small tiles pay Python loop and BLAS call overhead on every slice; larger
+    # ones let sgemm work on bigger blocks but widen more int8 data at once.
+    m, k, n = 256, 4096, 4096
+    x = rng.normal(0, 1.0, size=(m, k)).astype(np.float32)
+    weight = rng.normal(0, 0.02, size=(n, k)).astype(np.float32)
+    print(f"\nTile sizes for {m} x {k} x {n} (block_m, block_n, block_k):")
+    for blocks in [(32, 64, 128), (64, 128, 256), (128, 256, 512), (256, 512, 1024), (256, 4096, 1024)]:
+        layer = QuantizedLinear(weight, block_m=blocks[0], block_n=blocks[1], block_k=blocks[2])
+        ms, _ = best_of(lambda: layer(x), 3)
+        print(f"  {str(blocks):<20}{ms:>8.1f} ms")
+
+    # --- A quantized MLP block ---
+    # GPT-2's feed-forward block: 768 -> 3072, GELU, 3072 -> 768. The GELU
+    # output is lopsided (mostly >= 0), where asymmetric activations help.
+    def gelu(v: np.ndarray) -> np.ndarray:
+        return 0.5 * v * (1 + np.tanh(0.7978845608 * (v + 0.044715 * v ** 3)))
+
+    w_fc = rng.normal(0, 0.02, size=(3072, 768)).astype(np.float32)
+    w_proj = rng.normal(0, 0.02, size=(768, 3072)).astype(np.float32)
+    hidden = rng.normal(0, 1.0, size=(64, 768)).astype(np.float32)
+    reference = gelu(hidden @ w_fc.T) @ w_proj.T
+    print("\nMLP block 768 -> 3072 -> 768 on 64 tokens, error against float32:")
+    for label, symmetric in [("symmetric activations", True), ("asymmetric activations", False)]:
+        fc = QuantizedLinear(w_fc, symmetric_activations=symmetric)
+        proj = QuantizedLinear(w_proj, symmetric_activations=symmetric)
+        metrics = qt.error_metrics(reference, proj(gelu(fc(hidden))))
+        print(f"  {label:<24} max err {metrics['max_abs_error']:.5f}, SNR {metrics['snr_db']:.1f} dB")
@@ -0,0 +1,231 @@
+"""
+CPU benchmark for quantized inference of distilgpt2 (or any GPT-2 style model).
+
+llm-quantization.py compares FP32 and bitsandbytes 4-bit by
+get_memory_footprint() and one generate() output, and the 4-bit path needs a
+GPU to mean much. This harness runs CPU-only backends side by side:
+
+- fp32:          the model as loaded
+- bf16:          weights and activations in bfloat16
+- dynamic-int8:  torch.ao.quantization.quantize_dynamic on every Linear
+                 (GPT-2's Conv1D layers are converted to Linear first)
+- numpy-int8:    weight-only int8, per-channel scales (quantization_toolkit.py)
+- numpy-int4:    weight-only int4, group-wise scales (quantization_toolkit.py)
+- mmap-int8:     numpy-int8 loaded from a memory-mapped quantized weight
+                 store (weight_store.py) instead of from_pretrained
+
+Every backend runs in a fresh process and reports load time, peak RSS, model
+size, perplexity on perplexity-sample.txt, and time-to-first-token plus decode
+tokens/sec for each batch size and prompt length. A backend that crashes or
+runs past --timeout is reported as failed and the others still run.
+
+    python quantization-benchmark.py
+    python quantization-benchmark.py --backends fp32,dynamic-int8 --batch-sizes 1,8 --output results.json
+    python quantization-benchmark.py --random   # offline: random small GPT-2, byte-level tokens
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from transformers import AutoModelForCausalLM, AutoTokenizer, GPT2Config, GPT2LMHeadModel
+
+import weight_store as store
+from quantization_backends import BACKENDS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_PATH = os.path.join(HERE, "perplexity-sample.txt")
+
+# --- Measurements ---
+
+def model_size_mb(model: nn.Module) -> float:
+    """Serialized state dict (includes dynamic-int8 packed weights) plus numpy-quantized weights."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    numpy_weights = sum(module.weight_q.nbytes for module in model.modules()
+                        if isinstance(module, store.QuantizedLinear))
+    return (buffer.getbuffer().nbytes + numpy_weights) / 1e6
+
+def perplexity(model: nn.Module, ids: torch.Tensor, max_length: int, stride: int) -> float:
+    """Sliding-window perplexity: each token is scored once, with up to max_length tokens of context."""
+    total_nll, scored, prev_end = 0.0, 0, 0
+    with torch.no_grad():
+        for begin in range(0, len(ids) - 1, stride):
+            end = min(begin + max_length, len(ids))
+            window = ids[begin:end].unsqueeze(0)
+            logits = model(window).logits[0, :-1].float()
+            nll = F.cross_entropy(logits, window[0, 1:], reduction="none")
+            new = nll if begin == 0 else nll[-(end - prev_end):]
+            total_nll += new.sum().item()
+            scored += new.numel()
+            prev_end = end
+            if end == len(ids):
+                break
+    return float(torch.exp(torch.tensor(total_nll / scored)))
+
+def generation_timings(model: nn.Module, vocab_size: int, batch_size: int, prompt_len: int,
+                       new_tokens: int) -> Dict[str, float]:
+    """Greedy decoding by hand: prefill (time to first token), then cached one-token steps."""
+    prompt = torch.randint(0, vocab_size, (batch_size, prompt_len), generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        start = time.perf_counter()
+        out = model(prompt, use_cache=True)
+        next_ids = out.logits[:, -1].argmax(-1, keepdim=True)
+        ttft = time.perf_counter() - start
+
+        past = out.past_key_values
+        start = time.perf_counter()
+        for _ in range(new_tokens - 1):
+            out = model(next_ids, past_key_values=past, use_cache=True)
+            past = out.past_key_values
+            next_ids = out.logits[:, -1].argmax(-1, keepdim=True)
+        decode = time.perf_counter() - start
+    return {"ttft_ms": 1000 * ttft, "tokens_per_s": batch_size * (new_tokens - 1) / decode}
+
+def run_backend(backend: str, source: str, token_ids: List[int], args: Dict[str, Any], results) -> None:
+    """Runs in a fresh process so load time and peak RSS belong to this backend alone."""
+    torch.set_num_threads(args["threads"])
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    model = BACKENDS[backend](source)
+    load_s = time.perf_counter() - start
+
+    # Warm-up so one-off allocations do not land in the first measured run
+    generation_timings(model, model.config.vocab_size, 1, 8, 2)
+
+    ids = torch.tensor(token_ids)
+    result = {
+        "backend": backend,
+        "load_s": load_s,
+        "model_mb": model_size_mb(model),
+        "perplexity": perplexity(model, ids, args["max_length"], args["stride"]),
+        "generation": [dict(batch_size=b, prompt_len=l,
+                            **generation_timings(model, model.config.vocab_size, b, l, args["new_tokens"]))
+                       for b in args["batch_sizes"] for l in args["prompt_lens"]],
+    }
+    # ru_maxrss is KB on Linux; includes the interpreter and torch import
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result["import_rss_mb"] = baseline_rss / 1024
+    results.put(result)
+
+def measure(backend: str, source: str, token_ids: List[int], args: Dict[str, Any]) -> Dict[str, Any]:
+    """Raises RuntimeError if the child exits without a result or runs past args["timeout"]."""
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(target=run_backend, args=(backend, source, token_ids, args, results))
+    process.start()
+    deadline = time.monotonic() + args["timeout"]
+    while True:
+        try:
+            result = results.get(timeout=1.0)
+            break
+        except queue.Empty:
+            # A child that crashed (segfault, OOM kill, exception) never puts a result
+            if process.exitcode is not None:
+                raise RuntimeError(f"{backend} exited with code {process.exitcode} before reporting")
+            if time.monotonic() > deadline:
+                process.terminate()
+                process.join()
+                raise RuntimeError(f"{backend} did not finish within {args['timeout']:g}s")
+    process.join()
+    return result
+
+
+# --- Report ---
+
+def print_tables(results: List[Dict[str, Any]]) -> None:
+    print(f"\n{'backend':<14}{'load':>9}{'peak RSS':>12}{'model':>11}{'perplexity':>12}")
+    for r in results:
+        print(f"{r['backend']:<14}{r['load_s']:>8.2f}s{r['peak_rss_mb']:>10.0f}MB{r['model_mb']:>9.1f}MB"
+              f"{r['perplexity']:>12.2f}")
+
+    shapes = [(g["batch_size"], g["prompt_len"]) for g in results[0]["generation"]]
+    header = "".join(f"{f'b{b} x {l}':>20}" for b, l in shapes)
+    print("\nTime to first token (ms) / decode tokens per second")
+    print(f"{'backend':<14}{header}")
+    for r in results:
+        cells = "".join(f"{g['ttft_ms']:>10.1f} /{g['tokens_per_s']:>7.1f}" for g in r["generation"])
+        print(f"{r['backend']:<14}{cells}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="distilgpt2")
+    parser.add_argument("--random", action="store_true",
+                        help="offline: random small GPT-2 with byte-level tokens (perplexity is not meaningful)")
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--batch-sizes", default="1,4,8")
+    parser.add_argument("--prompt-lens", default="32,128")
+    parser.add_argument("--new-tokens", type=int, default=32)
+    parser.add_argument("--max-length", type=int, default=256, help="perplexity context window")
+    parser.add_argument("--stride", type=int, default=128, help="perplexity window stride")
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds per backend before it counts as failed")
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    with open(SAMPLE_PATH) as f:
+        text = f.read()
+    settings = {
+        "batch_sizes": [int(b) for b in args.batch_sizes.split(",")],
+        "prompt_lens": [int(l) for l in args.prompt_lens.split(",")],
+        "new_tokens": args.new_tokens,
+        "max_length": args.max_length,
+        "stride": args.stride,
+        "threads": args.threads,
+        "timeout": args.timeout,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.random:
+            torch.manual_seed(0)
+            model = GPT2LMHeadModel(GPT2Config(n_layer=4, n_embd=256, n_head=4, n_positions=512, vocab_size=256,
+                                                bos_token_id=None, eos_token_id=None))
+            token_ids = list(text.encode())
+            source = os.path.join(tmp, "checkpoint")
+            model.save_pretrained(source)
+        else:
+            source = args.model
+            token_ids = AutoTokenizer.from_pretrained(source)(text)["input_ids"]
+            model = AutoModelForCausalLM.from_pretrained(source)
+
+        # mmap-int8 loads a store written once, as a deployment would
+        store_path = os.path.join(tmp, "model.qws")
+        if "mmap-int8" in args.backends.split(","):
+            store.save_model_to_store(model, store_path, bits=8)
+        del model
+
+        results, failed = [], []
+        for backend in args.backends.split(","):
+            print(f"Benchmarking {backend}...")
+            try:
+                results.append(measure(backend, store_path if backend == "mmap-int8" else source, token_ids,
+                                       settings))
+            except RuntimeError as e:
+                print(f"  FAILED: {e}")
+                failed.append(str(e))
+
+    print(f"\n{args.model if not args.random else 'random GPT-2'}: {len(token_ids)} sample tokens, "
+          f"{args.new_tokens} new tokens per run, {args.threads} threads")
+    if results:
+        print_tables(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results, "failed": failed}, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    if failed:
+        sys.exit(f"\n{len(failed)} backend(s) failed: " + "; ".join(failed))
+
+
+if __name__ == "__main__":
+    main()
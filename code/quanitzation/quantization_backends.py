@@ -0,0 +1,58 @@
+"""
+CPU inference backends for a GPT-2 style checkpoint, by name: fp32, bf16,
+torch dynamic int8, the NumPy weight-only int8 and int4 layers, and the
+memory-mapped quantized weight store. Each loader takes a model id or path
+(the store file for mmap-int8) and returns a model ready for inference.
+"""
+from typing import Callable, Dict
+
+import torch
+import torch.nn as nn
+from transformers import AutoModelForCausalLM
+from transformers.pytorch_utils import Conv1D
+
+from weight_store import load_model_from_store, quantize_model_in_memory
+
+
+# --- Backends ---
+
+def conv1d_to_linear(model: nn.Module) -> nn.Module:
+    """GPT-2's Conv1D computes x @ W + b with W as (in, out); quantize_dynamic only knows nn.Linear."""
+    for name, module in list(model.named_modules()):
+        if isinstance(module, Conv1D):
+            linear = nn.Linear(*module.weight.shape)
+            linear.weight = nn.Parameter(module.weight.detach().t().contiguous())
+            linear.bias = module.bias
+            parent_name, _, child = name.rpartition(".")
+            setattr(model.get_submodule(parent_name) if parent_name else model, child, linear)
+    return model
+
+def load_fp32(source: str) -> nn.Module:
+    return AutoModelForCausalLM.from_pretrained(source).eval()
+
+def load_bf16(source: str) -> nn.Module:
+    return AutoModelForCausalLM.from_pretrained(source, torch_dtype=torch.bfloat16).eval()
+
+def load_dynamic_int8(source: str) -> nn.Module:
+    model = conv1d_to_linear(AutoModelForCausalLM.from_pretrained(source).eval())
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+def load_numpy_int8(source: str) -> nn.Module:
+    return quantize_model_in_memory(AutoModelForCausalLM.from_pretrained(source), bits=8)
+
+def load_numpy_int4(source: str) -> nn.Module:
+    return quantize_model_in_memory(AutoModelForCausalLM.from_pretrained(source), bits=4, group_size=64)
+
+def load_mmap_int8(source: str) -> nn.Module:
+    # source is the store file written by the parent process
+    model, _ = load_model_from_store(source)
+    return model
+
+BACKENDS: Dict[str, Callable[[str], nn.Module]] = {
+    "fp32": load_fp32,
+    "bf16": load_bf16,
+    "dynamic-int8": load_dynamic_int8,
+    "numpy-int8": load_numpy_int8,
+    "numpy-int4": load_numpy_int4,
+    "mmap-int8": load_mmap_int8,
+}
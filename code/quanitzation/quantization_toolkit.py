@@ -0,0 +1,241 @@
+"""
+Vectorized NumPy quantization of float32 tensors to int8 and packed int4:
+symmetric or asymmetric, per-tensor, per-channel or group-wise scales,
+processed in row chunks so memory-mapped inputs larger than RAM stream
+through a few chunk-sized buffers.
+
+float32-int8.py walks through the precision loss and the schemes on sample
+weights; weight_store.py and int8-matmul.py build on these functions.
+"""
+from dataclasses import dataclass
+from typing import Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+
+# --- Quantization parameters ---
+# Every value is stored as a signed integer q and recovered as
+#   x ~= (q - zero_point) * scale
+# Symmetric quantization keeps zero_point at 0 and uses a range that is the
+# same on both sides (-127..127 for int8); asymmetric quantization shifts the
+# range with a zero point so lopsided data (e.g. post-ReLU activations) uses
+# all 256 levels.
+#
+# Granularity decides how many values share one scale:
+# - per-tensor:  axis=None, group_size=None  (one scale for everything)
+# - per-channel: axis=0                      (one scale per output channel/row)
+# - group-wise:  group_size=128              (one scale per 128 consecutive
+#                                             values along the last axis)
+
+def qrange(bits: int, symmetric: bool) -> Tuple[int, int]:
+    if bits not in (4, 8):
+        raise ValueError("bits must be 4 or 8")
+    qmax = 2 ** (bits - 1) - 1
+    return (-qmax if symmetric else -qmax - 1), qmax
+
+@dataclass
+class QuantizedTensor:
+    data: np.ndarray        # int8, or uint8 holding two int4 values per byte
+    scale: np.ndarray       # float32, broadcastable against the work view
+    zero_point: np.ndarray  # int32, all zeros for symmetric
+    shape: Tuple[int, ...]  # original shape
+    bits: int
+    symmetric: bool
+    axis: Optional[int] = None
+    group_size: Optional[int] = None
+
+    @property
+    def nbytes(self) -> int:
+        """Payload plus scales (and zero points when they are needed)."""
+        return self.data.nbytes + self.scale.nbytes + (0 if self.symmetric else self.zero_point.nbytes)
+
+    @property
+    def granularity(self) -> str:
+        if self.group_size:
+            return f"group({self.group_size})"
+        return "per-tensor" if self.axis is None else f"per-channel(axis={self.axis})"
+
+
+def _work_view(x: np.ndarray, axis: Optional[int], group_size: Optional[int]) -> Tuple[np.ndarray, Tuple[int, ...]]:
+    """
+    Reshape x (without copying, for contiguous input) so every scale group lies
+    along the reduced axes, and return the view plus the axes to reduce over.
+    Chunking always runs along axis 0 of this view.
+    """
+    if axis is not None and group_size is not None:
+        raise ValueError("use either axis (per-channel) or group_size (group-wise), not both")
+    if x.ndim == 1:
+        x = x.reshape(1, -1)
+        axis = None if axis is None else axis + 1
+    if group_size is not None:
+        if x.shape[-1] % group_size:
+            raise ValueError(f"last dimension {x.shape[-1]} is not a multiple of group_size {group_size}")
+        x = x.reshape(x.shape[:-1] + (x.shape[-1] // group_size, group_size))
+        return x, (x.ndim - 1,)
+    if axis is None:
+        return x, tuple(range(x.ndim))
+    axis = axis % x.ndim
+    return x, tuple(a for a in range(x.ndim) if a != axis)
+
+def _chunks(rows: int, chunk_rows: Optional[int]) -> Iterator[Tuple[int, int]]:
+    step = chunk_rows or rows or 1
+    for start in range(0, rows, step):
+        yield start, min(start + step, rows)
+
+def _rows(param: np.ndarray, start: int, stop: int) -> np.ndarray:
+    """Slice a per-row parameter to a chunk; parameters shared by all rows pass through."""
+    return param if param.shape[0] == 1 else param[start:stop]
+
+def _minmax(xv: np.ndarray, reduce_axes: Tuple[int, ...], chunk_rows: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """Streaming min/max over the reduced axes, one chunk of rows at a time."""
+    shape = tuple(1 if a in reduce_axes else n for a, n in enumerate(xv.shape))
+    lo = np.full(shape, np.inf, dtype=np.float32)
+    hi = np.full(shape, -np.inf, dtype=np.float32)
+    for start, stop in _chunks(xv.shape[0], chunk_rows):
+        chunk = xv[start:stop]
+        target = slice(None) if 0 in reduce_axes else slice(start, stop)
+        np.minimum(lo[target], chunk.min(axis=reduce_axes, keepdims=True), out=lo[target])
+        np.maximum(hi[target], chunk.max(axis=reduce_axes, keepdims=True), out=hi[target])
+    return lo, hi
+
+def compute_qparams(lo: np.ndarray, hi: np.ndarray, bits: int, symmetric: bool) -> Tuple[np.ndarray, np.ndarray]:
+    qmin, qmax = qrange(bits, symmetric)
+    if symmetric:
+        scale = np.maximum(np.abs(lo), np.abs(hi)) / qmax
+        zero_point = np.zeros(scale.shape, dtype=np.int32)
+    else:
+        # Zero must be exactly representable (padding, ReLU outputs)
+        lo, hi = np.minimum(lo, 0), np.maximum(hi, 0)
+        scale = (hi - lo) / (qmax - qmin)
+        zero_point = np.clip(np.rint(qmin - lo / np.where(scale > 0, scale, 1.0)), qmin, qmax).astype(np.int32)
+    scale = np.where(scale > 0, scale, 1.0).astype(np.float32)  # all-zero groups
+    return scale, zero_point
+
+
+# --- Quantize / dequantize ---
+# Both run chunk by chunk with one reused scratch buffer per call, writing
+# straight into the output with ufunc out= arguments. Inputs and outputs can be
+# np.memmap arrays, so tensors larger than RAM stream through a bounded amount
+# of memory.
+
+def _pack_int4(q: np.ndarray, out: np.ndarray, scratch: np.ndarray) -> None:
+    """Pack pairs along the last axis: even element in the low nibble, odd in the high."""
+    u = q.view(np.uint8)
+    np.bitwise_and(u[..., 0::2], 0x0F, out=out)
+    np.left_shift(u[..., 1::2], 4, out=scratch)
+    np.bitwise_or(out, scratch, out=out)
+
+def _unpack_int4(packed: np.ndarray, out: np.ndarray) -> None:
+    u = out.view(np.uint8)
+    np.bitwise_and(packed, 0x0F, out=u[..., 0::2])
+    np.right_shift(packed, 4, out=u[..., 1::2])
+    # Sign-extend the 4-bit two's complement values
+    np.bitwise_xor(out, 8, out=out)
+    np.subtract(out, 8, out=out)
+
+def quantize(x: np.ndarray,
+             bits: int = 8,
+             symmetric: bool = True,
+             axis: Optional[int] = None,
+             group_size: Optional[int] = None,
+             chunk_rows: Optional[int] = None,
+             out: Optional[np.ndarray] = None) -> QuantizedTensor:
+    """
+    Quantize a float array to int8 or packed int4.
+
+    `chunk_rows` bounds the working memory to that many rows of the work view
+    (rows of a weight matrix); `out` may be a preallocated (memory-mapped)
+    payload array, see quantized_payload_shape().
+    """
+    qmin, qmax = qrange(bits, symmetric)
+    xv, reduce_axes = _work_view(x, axis, group_size)
+    if bits == 4 and xv.shape[-1] % 2:
+        raise ValueError("int4 packing needs an even number of values along the last axis")
+
+    scale, zero_point = compute_qparams(*_minmax(xv, reduce_axes, chunk_rows), bits, symmetric)
+    if out is None:
+        out = np.empty(quantized_payload_shape(x.shape, bits), dtype=np.int8 if bits == 8 else np.uint8)
+    data = out.reshape(xv.shape[:-1] + (xv.shape[-1] * bits // 8,))
+
+    rows = chunk_rows or xv.shape[0]
+    buf = np.empty((min(rows, xv.shape[0]),) + xv.shape[1:], dtype=np.float32)
+    if bits == 4:
+        ibuf = np.empty(buf.shape, dtype=np.int8)
+        scratch = np.empty(buf.shape[:-1] + (buf.shape[-1] // 2,), dtype=np.uint8)
+    for start, stop in _chunks(xv.shape[0], chunk_rows):
+        n = stop - start
+        b = buf[:n]
+        np.divide(xv[start:stop], _rows(scale, start, stop), out=b)
+        np.rint(b, out=b)
+        if not symmetric:
+            np.add(b, _rows(zero_point, start, stop), out=b)
+        np.clip(b, qmin, qmax, out=b)
+        if bits == 8:
+            np.copyto(data[start:stop], b, casting="unsafe")
+        else:
+            np.copyto(ibuf[:n], b, casting="unsafe")
+            _pack_int4(ibuf[:n], data[start:stop], scratch[:n])
+
+    return QuantizedTensor(data=out, scale=scale, zero_point=zero_point, shape=tuple(x.shape),
+                           bits=bits, symmetric=symmetric, axis=axis, group_size=group_size)
+
+def quantized_payload_shape(shape: Tuple[int, ...], bits: int) -> Tuple[int, ...]:
+    """Shape of the stored payload: the original shape, last axis halved for int4."""
+    if len(shape) == 1:
+        shape = (1,) + tuple(shape)
+    return tuple(shape[:-1]) + (shape[-1] * bits // 8,)
+
+def dequantize(qt: QuantizedTensor,
+               chunk_rows: Optional[int] = None,
+               out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Reconstruct float32 values, written chunk by chunk into `out`."""
+    if out is None:
+        out = np.empty(qt.shape, dtype=np.float32)
+    ov, _ = _work_view(out, qt.axis, qt.group_size)
+    data = qt.data.reshape(ov.shape[:-1] + (ov.shape[-1] * qt.bits // 8,))
+
+    if qt.bits == 4:
+        ibuf = np.empty((min(chunk_rows or ov.shape[0], ov.shape[0]),) + ov.shape[1:], dtype=np.int8)
+    for start, stop in _chunks(ov.shape[0], chunk_rows):
+        q = data[start:stop]
+        if qt.bits == 4:
+            q = ibuf[:stop - start]
+            _unpack_int4(data[start:stop], q)
+        np.subtract(q, _rows(qt.zero_point, start, stop), out=ov[start:stop], dtype=np.float32)
+        np.multiply(ov[start:stop], _rows(qt.scale, start, stop), out=ov[start:stop])
+    return out
+
+
+# --- Error metrics ---
+
+def error_metrics(x: np.ndarray, x_hat: np.ndarray, chunk_rows: Optional[int] = None) -> Dict[str, float]:
+    """Max/mean absolute error and signal-to-quantization-noise ratio, streamed over rows."""
+    x2, x_hat2 = x.reshape(x.shape[0], -1), x_hat.reshape(x_hat.shape[0], -1)
+    max_abs, sum_abs, signal, noise = 0.0, 0.0, 0.0, 0.0
+    for start, stop in _chunks(x2.shape[0], chunk_rows):
+        a = x2[start:stop].astype(np.float64)
+        err = a - x_hat2[start:stop]
+        np.abs(err, out=err)
+        max_abs = max(max_abs, float(err.max()))
+        sum_abs += float(err.sum())
+        noise += float(np.dot(err.ravel(), err.ravel()))
+        signal += float(np.dot(a.ravel(), a.ravel()))
+    return {
+        "max_abs_error": max_abs,
+        "mean_abs_error": sum_abs / x.size,
+        "snr_db": float("inf") if noise == 0 else 10 * np.log10(signal / noise),
+    }
+
+def compression_report(x: np.ndarray, qt: QuantizedTensor, chunk_rows: Optional[int] = None,
+                       x_hat: Optional[np.ndarray] = None) -> Dict[str, float]:
+    x_hat = dequantize(qt, chunk_rows=chunk_rows, out=x_hat)
+    return {
+        "original_mb": x.nbytes / 1e6,
+        "quantized_mb": qt.nbytes / 1e6,
+        "memory_saved_pct": 100 * (1 - qt.nbytes / x.nbytes),
+        **error_metrics(x, x_hat, chunk_rows),
+    }
+
+def print_report_row(label: str, report: Dict[str, float]) -> None:
+    print(f"{label:<34}{report['quantized_mb']:>9.2f} MB {report['memory_saved_pct']:>7.1f}%"
+          f"{report['max_abs_error']:>12.5f}{report['mean_abs_error']:>12.6f}{report['snr_db']:>9.2f} dB")
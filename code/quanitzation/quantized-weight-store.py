@@ -0,0 +1,131 @@
+"""
+Load time and memory of the quantize-once, memory-mapped weight store
+(weight_store.py) against from_pretrained plus quantization at load time,
+as llm-quantization.py does on every run. The store is mapped by several
+worker processes to show its pages being shared through the page cache.
+
+Runs offline with a randomly initialized small GPT-2 by default:
+
+    python quantized-weight-store.py
+    python quantized-weight-store.py --model distilgpt2 --bits 4 --group-size 64
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+from transformers import AutoModelForCausalLM, GPT2LMHeadModel
+
+from weight_store import load_model_from_store, quantize_model_in_memory, save_model_to_store, small_gpt2_config
+
+
+# --- Load time and memory ---
+
+def _rss_mb() -> Dict[str, float]:
+    """Current and shared resident memory (Linux), plus peak RSS."""
+    usage = {"peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            # Skip the leading address-range line; keep "Key:   123 kB" lines
+            fields = dict(line.split(":", 1) for line in f if line.split(":", 1)[0].replace("_", "").isalpha())
+        kb = lambda key: int(fields.get(key, "0 kB").split()[0])
+        usage["rss_mb"] = kb("Rss") / 1024
+        usage["shared_mb"] = (kb("Shared_Clean") + kb("Shared_Dirty")) / 1024
+        usage["private_mb"] = (kb("Private_Clean") + kb("Private_Dirty")) / 1024
+    except OSError:
+        pass
+    return usage
+
+def _measure(kind: str, source: str, bits: int, group_size: Optional[int], symmetric: bool, results) -> None:
+    """Runs in a fresh process so the parent's memory does not count."""
+    torch.set_num_threads(1)
+    start = time.perf_counter()
+    if kind == "store":
+        model, store = load_model_from_store(source)
+    else:
+        model = quantize_model_in_memory(AutoModelForCausalLM.from_pretrained(source),
+                                         bits=bits, group_size=group_size, symmetric=symmetric)
+    loaded = time.perf_counter()
+    after_load = _rss_mb()
+
+    input_ids = torch.randint(0, model.config.vocab_size, (1, 16), generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        logits = model(input_ids).logits
+    first = time.perf_counter()
+
+    results.put({"kind": kind, "load_s": loaded - start, "first_forward_s": first - loaded,
+                 "after_load": after_load, "after_forward": _rss_mb(),
+                 "logits": logits[0, -1].numpy().tolist()})
+
+def measure_in_subprocess(kind: str, source: str, bits: int, group_size: Optional[int], symmetric: bool,
+                          workers: int = 1) -> list:
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    processes = [ctx.Process(target=_measure, args=(kind, source, bits, group_size, symmetric, results))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    measurements = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return measurements
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", help="Hugging Face model id or path (default: random small GPT-2, offline)")
+    parser.add_argument("--bits", type=int, default=8, choices=(4, 8))
+    parser.add_argument("--group-size", type=int, help="group-wise scales instead of per-channel")
+    parser.add_argument("--asymmetric", action="store_true")
+    parser.add_argument("--store", help="store file to write (default: temporary)")
+    parser.add_argument("--workers", type=int, default=2, help="processes that map the same store")
+    args = parser.parse_args()
+    symmetric = not args.asymmetric
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.model:
+            source = args.model
+            model = AutoModelForCausalLM.from_pretrained(source)
+        else:
+            # Offline stand-in for a downloaded checkpoint
+            torch.manual_seed(0)
+            model = GPT2LMHeadModel(small_gpt2_config())
+            source = os.path.join(tmp, "checkpoint")
+            model.save_pretrained(source)
+
+        store_path = args.store or os.path.join(tmp, "model.qws")
+        start = time.perf_counter()
+        size = save_model_to_store(model, store_path, bits=args.bits, group_size=args.group_size,
+                                   symmetric=symmetric)
+        print(f"Quantized once into {store_path}: {size / 1e6:.2f} MB in {time.perf_counter() - start:.2f}s "
+              f"(fp32 parameters: {sum(p.numel() for p in model.parameters()) * 4 / 1e6:.2f} MB)")
+
+        model.eval()
+        input_ids = torch.randint(0, model.config.vocab_size, (1, 16), generator=torch.Generator().manual_seed(0))
+        with torch.no_grad():
+            reference = model(input_ids).logits[0, -1].numpy()
+        del model
+
+        baseline = measure_in_subprocess("pretrained", source, args.bits, args.group_size, symmetric)[0]
+        mapped = measure_in_subprocess("store", store_path, args.bits, args.group_size, symmetric,
+                                       workers=args.workers)
+
+    print(f"\n{'load path':<38}{'load':>9}{'1st fwd':>10}{'RSS':>10}{'shared':>10}{'private':>10}")
+    for label, run in [("from_pretrained + runtime quantization", baseline)] + \
+                      [(f"mmap store (worker {i + 1})", run) for i, run in enumerate(mapped)]:
+        memory = run["after_forward"]
+        print(f"{label:<38}{run['load_s']:>8.2f}s{run['first_forward_s']:>9.3f}s"
+              f"{memory.get('rss_mb', memory['peak_rss_mb']):>8.1f}MB"
+              f"{memory.get('shared_mb', float('nan')):>8.1f}MB{memory.get('private_mb', float('nan')):>8.1f}MB")
+
+    logits = np.array(mapped[0]["logits"])
+    print(f"\nLast-token logits vs fp32: max abs diff {np.abs(logits - reference).max():.4f}, "
+          f"same argmax: {int(logits.argmax()) == int(reference.argmax())}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Offline tests for weight_store.py on a randomly initialized small GPT-2.
+
+    python -m pytest code/quanitzation/test_quantized_weight_store.py
+"""
+import os
+import struct
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+from transformers import GPT2LMHeadModel
+
+import weight_store as store
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    return GPT2LMHeadModel(store.small_gpt2_config(n_layer=2, n_embd=64, n_head=2, n_positions=64,
+                                                   vocab_size=512)).eval()
+
+@pytest.fixture
+def input_ids():
+    return torch.randint(0, 512, (2, 12), generator=torch.Generator().manual_seed(0))
+
+def logits(model, input_ids):
+    with torch.no_grad():
+        return model(input_ids).logits
+
+def _copy(model):
+    clone = GPT2LMHeadModel(model.config).eval()
+    clone.load_state_dict(model.state_dict())
+    return clone
+
+
+@pytest.mark.parametrize("bits,group_size,symmetric", [(8, None, True), (8, None, False), (4, 32, True)])
+def test_round_trip_matches_fp32_and_runtime_quantization(model, input_ids, tmp_path, bits, group_size, symmetric):
+    path = str(tmp_path / "model.qws")
+    store.save_model_to_store(model, path, bits=bits, group_size=group_size, symmetric=symmetric)
+    loaded, mapped = store.load_model_from_store(path)
+
+    reference = logits(model, input_ids)
+    got = logits(loaded, input_ids)
+    tolerance = 0.05 if bits == 8 else 0.5
+    assert (got - reference).abs().max() < tolerance
+
+    # Same quantization as the load-time path it replaces
+    runtime = store.quantize_model_in_memory(_copy(model), bits=bits, group_size=group_size, symmetric=symmetric)
+    assert torch.allclose(got, logits(runtime, input_ids), atol=1e-5)
+
+    del loaded
+    mapped.close()
+
+def test_store_is_smaller_and_every_linear_stays_quantized(model, tmp_path):
+    path = str(tmp_path / "model.qws")
+    size = store.save_model_to_store(model, path, bits=8)
+    fp32_bytes = sum(p.numel() for p in model.parameters()) * 4
+    assert size == os.path.getsize(path) < fp32_bytes
+
+    loaded, mapped = store.load_model_from_store(path)
+    linears = [m for m in loaded.modules() if isinstance(m, store.QuantizedLinear)]
+    assert len(linears) == 4 * model.config.n_layer  # c_attn, c_proj, mlp.c_fc, mlp.c_proj
+    assert all(m.weight_q.data.dtype == np.int8 for m in linears)
+    del loaded, linears
+    mapped.close()
+
+def test_load_is_zero_copy(model, tmp_path):
+    path = str(tmp_path / "model.qws")
+    store.save_model_to_store(model, path, bits=8)
+    loaded, mapped = store.load_model_from_store(path)
+    mapping = np.frombuffer(mapped._mmap, dtype=np.uint8)
+
+    linear = next(m for m in loaded.modules() if isinstance(m, store.QuantizedLinear))
+    assert np.shares_memory(linear.weight_q.data, mapping)
+    assert np.shares_memory(loaded.transformer.wte.weight.numpy(), mapping)
+    del loaded, linear, mapping
+    mapped.close()
+
+def test_tied_weights_are_stored_once(model, tmp_path):
+    path = str(tmp_path / "model.qws")
+    store.save_model_to_store(model, path)
+    loaded, mapped = store.load_model_from_store(path)
+    assert "lm_head.weight" not in mapped
+    assert mapped.metadata["aliases"] == {"lm_head.weight": "transformer.wte.weight"}
+    assert loaded.lm_head.weight.data_ptr() == loaded.transformer.wte.weight.data_ptr()
+    del loaded
+    mapped.close()
+
+def test_payloads_are_aligned(model, tmp_path):
+    path = str(tmp_path / "model.qws")
+    store.save_model_to_store(model, path, alignment=128)
+    with store.QuantizedWeightStore(path) as mapped:
+        assert mapped.alignment == 128
+        offsets = [record[0] for entry in mapped.entries.values() for record in entry["arrays"].values()]
+        assert all(offset % 128 == 0 for offset in offsets)
+
+def test_rejects_foreign_or_newer_files(model, tmp_path):
+    path = str(tmp_path / "model.qws")
+    store.save_model_to_store(model, path)
+    with open(path, "r+b") as f:
+        header = bytearray(f.read(store.HEADER.size))
+        f.seek(0)
+        f.write(b"NOTSTORE")
+    with pytest.raises(ValueError, match="not a quantized weight store"):
+        store.QuantizedWeightStore(path)
+
+    with open(path, "r+b") as f:
+        struct.pack_into("<I", header, 8, store.VERSION + 1)
+        f.write(header)
+    with pytest.raises(ValueError, match="format version"):
+        store.QuantizedWeightStore(path)
+
+@pytest.mark.parametrize("bits,kwargs", [(8, {"axis": 0}), (8, {"axis": None}), (4, {"group_size": 16}),
+                                         (8, {"axis": 0, "symmetric": False})])
+@pytest.mark.parametrize("block_rows", [1, 7, 64, 1000])
+def test_quantized_linear_blocks_match_full_dequantize(bits, kwargs, block_rows):
+    weight = np.random.default_rng(0).standard_normal((96, 64)).astype(np.float32)
+    q = store.qt.quantize(weight, bits=bits, **kwargs)
+    bias = torch.randn(96)
+    x = torch.randn(2, 3, 64)
+    expected = F.linear(x, torch.from_numpy(store.qt.dequantize(q)), bias)
+    assert torch.allclose(store.QuantizedLinear(q, bias, block_rows=block_rows)(x), expected, atol=1e-5)
@@ -0,0 +1,308 @@
+"""
+Quantize-once, memory-mapped weight store for GPT-2 style models.
+
+llm-quantization.py loads the full model with from_pretrained and quantizes it
+at load time, on every run. Here the weights are quantized once into a single
+file laid out as
+
+    [64-byte header][tensor payloads, each aligned][JSON index]
+
+The header holds a magic string, the format version, the payload alignment,
+the tensor count and where the index lives. The index records, for every
+tensor, the offset, dtype and shape of its arrays plus its quantization
+parameters. Linear weights are stored as int8 or packed int4 with per-channel
+or group-wise scales (see quantization_toolkit.py); embeddings, biases and
+LayerNorm parameters are stored as raw float32.
+
+Loading maps the file with mmap and wraps every array with np.frombuffer and
+torch.from_numpy, so nothing is read or copied up front. Pages are faulted in
+the first time a layer runs and, being read-only and file-backed, are shared
+through the page cache by every worker process that opens the same store.
+
+quantized-weight-store.py measures load time and memory against
+from_pretrained, and quantization-benchmark.py compares it with the other
+quantized backends.
+"""
+import dataclasses
+import json
+import mmap
+import struct
+import warnings
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from accelerate import init_empty_weights
+from transformers import AutoConfig, AutoModelForCausalLM, GPT2Config
+from transformers.pytorch_utils import Conv1D
+
+import quantization_toolkit as qt
+
+
+# --- On-disk format ---
+
+MAGIC = b"QWSTORE\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIQQ")  # magic, version, alignment, tensor count, index offset, index length
+HEADER_SIZE = 64
+
+def _write_aligned(f, array: np.ndarray, alignment: int) -> list:
+    """Pad to the alignment, write the array's bytes, and return its [offset, dtype, shape] record."""
+    f.write(b"\0" * (-f.tell() % alignment))
+    offset = f.tell()
+    array = np.ascontiguousarray(array)
+    f.write(memoryview(array).cast("B"))
+    return [offset, array.dtype.str, list(array.shape)]
+
+def write_store(path: str,
+                tensors: Iterable[Tuple[str, np.ndarray, bool]],
+                bits: int = 8,
+                group_size: Optional[int] = None,
+                symmetric: bool = True,
+                alignment: int = 64,
+                metadata: Optional[Dict[str, Any]] = None) -> int:
+    """
+    Write (name, float array, quantize?) entries to a store file and return its
+    size. Quantized tensors use per-channel scales along axis 0 unless
+    group_size is given.
+    """
+    entries = []
+    with open(path, "wb") as f:
+        f.write(b"\0" * HEADER_SIZE)
+        for name, array, quantize in tensors:
+            if not quantize:
+                entries.append({"name": name, "shape": list(array.shape), "bits": 32,
+                                "arrays": {"data": _write_aligned(f, array.astype(np.float32, copy=False), alignment)}})
+                continue
+            q = qt.quantize(array, bits=bits, symmetric=symmetric,
+                            axis=None if group_size else 0, group_size=group_size)
+            arrays = {"data": _write_aligned(f, q.data, alignment), "scale": _write_aligned(f, q.scale, alignment)}
+            if not symmetric:
+                arrays["zero_point"] = _write_aligned(f, q.zero_point, alignment)
+            entries.append({"name": name, "shape": list(q.shape), "bits": bits, "symmetric": symmetric,
+                            "axis": q.axis, "group_size": group_size, "arrays": arrays})
+
+        index = json.dumps({"tensors": entries, "metadata": metadata or {}}).encode()
+        f.write(b"\0" * (-f.tell() % alignment))
+        index_offset = f.tell()
+        f.write(index)
+        size = f.tell()
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, alignment, len(entries), index_offset, len(index)))
+    return size
+
+class QuantizedWeightStore:
+    """
+    Read-only, memory-mapped view of a store file.
+
+    Arrays returned by raw() and quantized() are views into the mapping; drop
+    them (and any model built from them) before calling close().
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.alignment, count, index_offset, index_length = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a quantized weight store")
+        if version != VERSION:
+            raise ValueError(f"{path} has store format version {version}, expected {VERSION}")
+        index = json.loads(self._mmap[index_offset:index_offset + index_length])
+        self.metadata: Dict[str, Any] = index["metadata"]
+        self.entries: Dict[str, Dict[str, Any]] = {entry["name"]: entry for entry in index["tensors"]}
+        assert len(self.entries) == count
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _view(self, record: list) -> np.ndarray:
+        offset, dtype, shape = record
+        return np.frombuffer(self._mmap, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+    def is_quantized(self, name: str) -> bool:
+        return self.entries[name]["bits"] != 32
+
+    def raw(self, name: str) -> np.ndarray:
+        """Zero-copy float32 view of an unquantized tensor."""
+        entry = self.entries[name]
+        if entry["bits"] != 32:
+            raise ValueError(f"{name} is quantized; use quantized() or tensor()")
+        return self._view(entry["arrays"]["data"])
+
+    def quantized(self, name: str):
+        """QuantizedTensor whose payload and scales are views into the mapping."""
+        entry = self.entries[name]
+        arrays = {key: self._view(record) for key, record in entry["arrays"].items()}
+        zero_point = arrays.get("zero_point")
+        if zero_point is None:
+            zero_point = np.zeros(arrays["scale"].shape, dtype=np.int32)
+        return qt.QuantizedTensor(data=arrays["data"], scale=arrays["scale"], zero_point=zero_point,
+                                  shape=tuple(entry["shape"]), bits=entry["bits"], symmetric=entry["symmetric"],
+                                  axis=entry["axis"], group_size=entry["group_size"])
+
+    def tensor(self, name: str) -> np.ndarray:
+        """float32 values: a view for raw tensors, a fresh array for quantized ones."""
+        return qt.dequantize(self.quantized(name)) if self.is_quantized(name) else self.raw(name)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._mmap)
+
+    def close(self) -> None:
+        self._mmap.close()
+        self._file.close()
+
+
+# --- PyTorch models ---
+
+def _from_mmap(array: np.ndarray) -> torch.Tensor:
+    # The mapping is read-only; inference never writes to weights, so share it as is
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        return torch.from_numpy(array)
+
+def _weight_rows(weight, start: int, stop: int):
+    """QuantizedTensor for output rows [start, stop); payload and scales are views, nothing is copied."""
+    rows = lambda param: param if param.shape[0] == 1 else param[start:stop]
+    return dataclasses.replace(weight, data=weight.data[start:stop], scale=rows(weight.scale),
+                               zero_point=rows(weight.zero_point), shape=(stop - start,) + tuple(weight.shape[1:]))
+
+class QuantizedLinear(nn.Module):
+    """
+    nn.Linear replacement whose weight stays quantized (and, when loaded from a
+    store, memory-mapped).
+
+    Each forward pass dequantizes `block_rows` output rows at a time into one
+    float32 buffer, reused across blocks, and multiplies that block, so no more than
+    block_rows x in_features floats of weight exist at once instead of a full
+    fp32 copy per layer. The price is compute: every call still dequantizes
+    the whole weight, block by block, so a decode step costs more than fp32
+    (see int8-matmul.py for a kernel that multiplies the int8 values directly).
+    """
+
+    def __init__(self, weight, bias: Optional[torch.Tensor] = None, block_rows: int = 256):
+        super().__init__()
+        self.weight_q = weight
+        self.out_features, self.in_features = weight.shape
+        self.bias = nn.Parameter(bias, requires_grad=False) if bias is not None else None
+        self.block_rows = block_rows
+        self.blocks = [(start, min(start + block_rows, self.out_features), _weight_rows(
+                           weight, start, min(start + block_rows, self.out_features)))
+                       for start in range(0, self.out_features, block_rows)]
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        out = x.new_empty(x.shape[:-1] + (self.out_features,))
+        buffer = np.empty((min(self.block_rows, self.out_features), self.in_features), dtype=np.float32)
+        for start, stop, block in self.blocks:
+            weight = qt.dequantize(block, out=buffer[:stop - start])
+            bias = self.bias[start:stop] if self.bias is not None else None
+            out[..., start:stop] = F.linear(x, torch.from_numpy(weight), bias)
+        return out
+
+    def extra_repr(self) -> str:
+        return (f"in_features={self.in_features}, out_features={self.out_features}, "
+                f"bits={self.weight_q.bits}, {self.weight_q.granularity}")
+
+def _linear_weights(model: nn.Module) -> Dict[str, Tuple[str, bool]]:
+    """
+    weight name -> (module name, is Conv1D) for every Linear / GPT-2 Conv1D.
+    The output projection stays float: it is usually tied to the token embeddings.
+    """
+    head = model.get_output_embeddings()
+    return {f"{name}.weight": (name, isinstance(module, Conv1D))
+            for name, module in model.named_modules()
+            if isinstance(module, (nn.Linear, Conv1D)) and module is not head}
+
+def _linear_weight_array(module: nn.Module) -> np.ndarray:
+    weight = module.weight.detach().float().cpu().numpy()
+    # GPT-2's Conv1D stores (in, out); keep everything in nn.Linear's (out, in) layout
+    return np.ascontiguousarray(weight.T) if isinstance(module, Conv1D) else weight
+
+def _replace_module(model: nn.Module, name: str, module: nn.Module) -> None:
+    parent_name, _, child = name.rpartition(".")
+    setattr(model.get_submodule(parent_name) if parent_name else model, child, module)
+
+def save_model_to_store(model: nn.Module, path: str, bits: int = 8, group_size: Optional[int] = None,
+                        symmetric: bool = True, alignment: int = 64) -> int:
+    """Quantize the model's linear layers once and write the whole model to a store."""
+    linear = _linear_weights(model)
+    modules = dict(model.named_modules())
+    seen: Dict[int, str] = {}
+    aliases: Dict[str, str] = {}
+
+    def tensors():
+        for name, param in model.named_parameters(remove_duplicate=False):
+            if param.data_ptr() in seen:
+                aliases[name] = seen[param.data_ptr()]  # tied weights are stored once
+                continue
+            seen[param.data_ptr()] = name
+            if name in linear:
+                yield name, _linear_weight_array(modules[linear[name][0]]), True
+            else:
+                yield name, param.detach().float().cpu().numpy(), False
+
+    entries = list(tensors())
+    metadata = {"config": json.loads(model.config.to_json_string()), "aliases": aliases}
+    return write_store(path, entries, bits=bits, group_size=group_size, symmetric=symmetric,
+                       alignment=alignment, metadata=metadata)
+
+def load_model_from_store(path: str) -> Tuple[nn.Module, QuantizedWeightStore]:
+    """
+    Build the model skeleton without allocating weights, then point every
+    parameter at the mapped file: quantized linears become QuantizedLinear,
+    everything else a zero-copy tensor over the mapping.
+    """
+    store = QuantizedWeightStore(path)
+    config_dict = dict(store.metadata["config"])
+    config = AutoConfig.for_model(config_dict.pop("model_type"), **config_dict)
+    with init_empty_weights():  # parameters on the meta device, buffers (causal mask) real
+        model = AutoModelForCausalLM.from_config(config)
+
+    for name, module in list(model.named_modules()):
+        weight_name = f"{name}.weight"
+        if isinstance(module, (nn.Linear, Conv1D)) and weight_name in store and store.is_quantized(weight_name):
+            bias = _from_mmap(store.raw(f"{name}.bias")) if f"{name}.bias" in store else None
+            _replace_module(model, name, QuantizedLinear(store.quantized(weight_name), bias))
+
+    for name, param in list(model.named_parameters()):
+        if param.is_meta and name in store:
+            module_name, _, attr = name.rpartition(".")
+            setattr(model.get_submodule(module_name), attr,
+                    nn.Parameter(_from_mmap(store.raw(name)), requires_grad=False))
+    model.tie_weights()
+
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise ValueError(f"store {path} has no weights for {missing}")
+    return model.eval(), store
+
+def quantize_model_in_memory(model: nn.Module, bits: int = 8, group_size: Optional[int] = None,
+                             symmetric: bool = True) -> nn.Module:
+    """The load-time path this store replaces: quantize every linear layer after from_pretrained."""
+    for weight_name, (name, _) in _linear_weights(model).items():
+        module = model.get_submodule(name)
+        weight = qt.quantize(_linear_weight_array(module), bits=bits, symmetric=symmetric,
+                             axis=None if group_size else 0, group_size=group_size)
+        bias = module.bias.detach() if module.bias is not None else None
+        _replace_module(model, name, QuantizedLinear(weight, bias))
+    return model.eval()
+
+
+def small_gpt2_config(**overrides) -> GPT2Config:
+    settings = dict(n_layer=4, n_embd=256, n_head=4, n_positions=256, vocab_size=8192)
+    settings.update(overrides)
+    # GPT-2's default special token id (50256) is outside a small vocabulary
+    last_token = settings["vocab_size"] - 1
+    return GPT2Config(bos_token_id=last_token, eos_token_id=last_token, **settings)